@@ -26,11 +26,22 @@ API_KEY_EXCLUDED_ENDPOINTS = [item.strip() for item in os.environ.get('API_KEY_E
 SALT_SECRET = os.environ.get("SALT_SECRET")
 API_KEY_TABLE_NAME = os.environ.get("API_KEY_TABLE_NAME", None)
 BENCHMARK_MODE = os.environ["BENCHMARK_MODE"] == "true"
+KEYS_URL = 'https://cognito-idp.{}.amazonaws.com/{}/.well-known/jwks.json'.format(REGION, USER_POOL_ID)
+# Minimum time between jwks.json downloads triggered by tokens with an unknown kid
+JWKS_MIN_REFRESH_INTERVAL = 60
 
 authorized_cache_value = "authorized"
 unauthorized_cache_value = "unauthorized"
 
 secrets_manager_client = boto3.client("secretsmanager")
+# Kept for the lifetime of the warm container
+api_key_table = boto3.resource('dynamodb').Table(API_KEY_TABLE_NAME) if API_KEY_TABLE_NAME else None
+
+http_session = requests.Session()
+
+# kid -> constructed public key of the user pool, loaded on first use and on an unknown kid
+public_keys = {}
+public_keys_fetched_at = None
 
 print("AdminList:", ADMIN_LIST)
 print("CognitoDomainPrefix:", COGNITO_DOMAIN_PREFIX)
@@ -84,7 +95,7 @@ def get_user_info_cognito(authorization_header):
     }
 
     # Make the HTTP GET request to the User Info endpoint
-    response = requests.get(url, headers=headers, timeout=60)
+    response = http_session.get(url, headers=headers, timeout=60)
     print(f'response: {response}. response.status_code: {response.status_code}')
     # Check if the request was successful
     if response.status_code == 200:
@@ -95,21 +106,32 @@ def get_user_info_cognito(authorization_header):
 
         return response.status_code, response.text  # Returns error status and message if not successful
 
-def validateJWT(token, app_client_id, keys):
+def load_public_keys():
+    global public_keys, public_keys_fetched_at
+    public_keys_fetched_at = time.monotonic()
+    with urllib.request.urlopen(KEYS_URL) as f:
+        response = f.read()
+    keys = json.loads(response.decode('utf-8'))['keys']
+    public_keys = {key['kid']: jwk.construct(key) for key in keys}
+
+def get_public_key(kid):
+    public_key = public_keys.get(kid)
+    if public_key is None:
+        # The user pool may have rotated its keys, download them again but not more than once per interval
+        if public_keys_fetched_at is None or time.monotonic() - public_keys_fetched_at >= JWKS_MIN_REFRESH_INTERVAL:
+            load_public_keys()
+            public_key = public_keys.get(kid)
+    return public_key
+
+def validateJWT(token, app_client_id):
     # get the kid from the headers prior to verification
     headers = jwt.get_unverified_headers(token)
     kid = headers['kid']
-    # search for the kid in the downloaded public keys
-    key_index = -1
-    for i in range(len(keys)):
-        if kid == keys[i]['kid']:
-            key_index = i
-            break
-    if key_index == -1:
+    # look up the constructed public key for the kid
+    public_key = get_public_key(kid)
+    if public_key is None:
         logger.info('Public key not found in jwks.json')
         return False
-    # construct the public key
-    public_key = jwk.construct(keys[key_index])
     # get the last two sections of the token,
     # message and signature (encoded in base64)
     message, encoded_signature = str(token).rsplit('.', 1)
@@ -146,14 +168,8 @@ def query_by_api_key_hash(api_key_hash):
     Returns:
         dict: A dictionary containing the username and api_key_name if found; otherwise, None.
     """
-    # Initialize a DynamoDB resource. Make sure AWS credentials and region are configured.
-    dynamodb = boto3.resource('dynamodb')
-
-    # Access the DynamoDB table
-    table = dynamodb.Table(API_KEY_TABLE_NAME)
-
     # Perform the query using the secondary index
-    response = table.query(
+    response = api_key_table.query(
         IndexName='ApiKeyValueHashIndex',  # The name of the secondary index
         KeyConditionExpression='api_key_value_hash = :hash_value',
         ExpressionAttributeValues={
@@ -237,12 +253,6 @@ def auth_handler(event, current_method):
                 logger.error("unexpected cached auth value.")
                 return unauthorized_response()
 
-
-        keys_url = 'https://cognito-idp.{}.amazonaws.com/{}/.well-known/jwks.json'.format(REGION, USER_POOL_ID)
-        with urllib.request.urlopen(keys_url) as f:
-            response = f.read()
-        keys = json.loads(response.decode('utf-8'))['keys']
-        
         is_api_key = False
         #authenticate against cognito user pool using the key
         if bearer_token.startswith("sk-"):
@@ -254,7 +264,7 @@ def auth_handler(event, current_method):
             user_name = response['username']
         else:
             #JWT
-            response = validateJWT(bearer_token, APP_CLIENT_ID, keys)
+            response = validateJWT(bearer_token, APP_CLIENT_ID)
             #get authenticated claims
             if not response:
                 cache_unauthorized(bearer_token, current_method)
@@ -0,0 +1,281 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from fastapi import HTTPException, status
+from api.metrics import increment, register_collector
+
+# Maximum concurrent Bedrock calls per worker, as JSON maps of model id or region to a limit. "*" sets the limit of
+# models or regions that are not listed. Unlisted without "*", or 0, means unlimited.
+MODEL_CONCURRENCY_LIMITS = json.loads(os.environ.get("MODEL_CONCURRENCY_LIMITS", "{}"))
+REGION_CONCURRENCY_LIMITS = json.loads(os.environ.get("REGION_CONCURRENCY_LIMITS", "{}"))
+# Maximum concurrent Bedrock calls of one user per worker, 0 for unlimited
+PRINCIPAL_CONCURRENCY_LIMIT = int(os.environ.get("PRINCIPAL_CONCURRENCY_LIMIT", "0"))
+# Requests allowed to wait for each limit. Once the queue is full further requests are rejected immediately.
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "50"))
+# Longest a request waits for all of its limits together before it is rejected
+ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", "2"))
+# Adaptive (AIMD) limit per region and model: it grows by one slot per limit's worth of successful calls and is cut
+# by ADAPTIVE_CONCURRENCY_DECREASE when Bedrock throttles or the time to first token rises.
+ADAPTIVE_CONCURRENCY = os.environ.get("ADAPTIVE_CONCURRENCY", "false").lower() == "true"
+ADAPTIVE_CONCURRENCY_INITIAL = float(os.environ.get("ADAPTIVE_CONCURRENCY_INITIAL", "20"))
+ADAPTIVE_CONCURRENCY_MIN = float(os.environ.get("ADAPTIVE_CONCURRENCY_MIN", "2"))
+ADAPTIVE_CONCURRENCY_MAX = float(os.environ.get("ADAPTIVE_CONCURRENCY_MAX", "500"))
+ADAPTIVE_CONCURRENCY_DECREASE = float(os.environ.get("ADAPTIVE_CONCURRENCY_DECREASE", "0.7"))
+# Average time to first token above this multiple of the lowest recent one counts as congestion
+ADAPTIVE_LATENCY_TOLERANCE = float(os.environ.get("ADAPTIVE_LATENCY_TOLERANCE", "2"))
+ADAPTIVE_LATENCY_ALPHA = 0.2
+# How fast the lowest time to first token drifts up, so one lucky sample does not stay the baseline forever
+ADAPTIVE_BASELINE_DRIFT = 1.01
+
+MODEL = "model"
+REGION = "region"
+REGION_MODEL = "region_model"
+PRINCIPAL = "principal"
+
+# (scope, key) -> ConcurrencyLimiter. Principal limiters are dropped again once idle.
+limiters = {}
+
+
+class AdmissionRejected(HTTPException):
+    """Raised when a limit is exhausted. scope tells which, so a call can still go to another region."""
+
+    def __init__(self, scope, status_code, detail):
+        super().__init__(status_code=status_code, detail=detail, headers={"Retry-After": "1"})
+        self.scope = scope
+
+
+class ConcurrencyLimiter:
+    """Bounds concurrent calls, with a bounded FIFO queue of callers waiting for a free slot.
+
+    A released slot is handed directly to the oldest waiter, so a new caller cannot overtake the queue.
+    """
+    __slots__ = ("scope", "key", "limit", "queue_size", "in_flight", "waiters")
+
+    def __init__(self, scope, key, limit, queue_size):
+        self.scope = scope
+        self.key = key
+        self.limit = limit
+        self.queue_size = queue_size
+        self.in_flight = 0
+        # Futures of waiting callers, resolved with True when handed a slot and False when their wait expired
+        self.waiters = deque()
+
+    def is_idle(self):
+        return self.in_flight == 0 and not self.waiters
+
+    async def acquire(self, timeout):
+        """
+        Take a slot, waiting up to timeout seconds for one.
+
+        Returns:
+            str: None if a slot was taken, otherwise "queue_full" or "timeout".
+        """
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+            return None
+        if len(self.waiters) >= self.queue_size or timeout <= 0:
+            return "queue_full"
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.waiters.append(future)
+        expiry = loop.call_later(timeout, self._expire, future)
+        try:
+            return None if await future else "timeout"
+        except asyncio.CancelledError:
+            if future.cancelled():
+                if future in self.waiters:
+                    self.waiters.remove(future)
+            elif future.result():
+                # Handed a slot just as the caller went away, pass it on
+                self.release()
+            raise
+        finally:
+            expiry.cancel()
+
+    def _expire(self, future):
+        if not future.done():
+            self.waiters.remove(future)
+            future.set_result(False)
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def set_limit(self, limit):
+        self.limit = limit
+        self._wake()
+
+    def _wake(self):
+        # A lowered limit leaves the queue waiting until enough calls finished
+        while self.waiters and self.in_flight < self.limit:
+            future = self.waiters.popleft()
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(True)
+
+
+class AdaptiveConcurrencyLimiter(ConcurrencyLimiter):
+    """A limiter whose limit follows Bedrock's capacity: additive increase on success, multiplicative decrease on
+    throttling or on a rising time to first token."""
+    __slots__ = ("latency", "baseline_latency", "last_decrease")
+
+    def __init__(self, scope, key, limit, queue_size):
+        super().__init__(scope, key, limit, queue_size)
+        self.latency = None
+        self.baseline_latency = None
+        self.last_decrease = 0.0
+
+    def on_success(self, started_at, time_to_first_token=None):
+        if time_to_first_token is not None:
+            if self.latency is None:
+                self.latency = self.baseline_latency = time_to_first_token
+            else:
+                self.latency += ADAPTIVE_LATENCY_ALPHA * (time_to_first_token - self.latency)
+                self.baseline_latency = min(time_to_first_token, self.baseline_latency * ADAPTIVE_BASELINE_DRIFT)
+            if self.latency > self.baseline_latency * ADAPTIVE_LATENCY_TOLERANCE:
+                self.decrease(started_at, "latency")
+                return
+        # Only grow a limit that is actually used, an idle limit says nothing about capacity
+        if self.in_flight >= self.limit / 2:
+            self.set_limit(min(ADAPTIVE_CONCURRENCY_MAX, self.limit + 1 / self.limit))
+
+    def decrease(self, started_at, reason):
+        # Calls that started before the last decrease saw the old limit, the congestion they report is already handled
+        if started_at < self.last_decrease:
+            return
+        self.last_decrease = time.monotonic()
+        self.set_limit(max(ADAPTIVE_CONCURRENCY_MIN, self.limit * ADAPTIVE_CONCURRENCY_DECREASE))
+        increment("gateway_adaptive_concurrency_decreases_total", key=self.key, reason=reason)
+
+
+class AdmissionSlot:
+    """The limiter slots held by one Bedrock call. release() may be called more than once."""
+    __slots__ = ("held",)
+
+    def __init__(self):
+        self.held = []
+
+    def release(self):
+        held, self.held = self.held, []
+        for limiter in reversed(held):
+            limiter.release()
+            if limiter.scope == PRINCIPAL and limiter.is_idle():
+                limiters.pop((PRINCIPAL, limiter.key), None)
+
+
+def get_configured_limit(limits, key):
+    return int(limits.get(key, limits.get("*", 0)) or 0)
+
+
+def get_limiter(scope, key, limit, limiter_class=ConcurrencyLimiter):
+    limiter = limiters.get((scope, key))
+    if limiter is None:
+        limiter = limiters[(scope, key)] = limiter_class(scope, key, limit, ADMISSION_QUEUE_SIZE)
+    return limiter
+
+
+def get_region_model_key(region, model_id):
+    return f"{region}/{model_id}"
+
+
+def get_request_limiters(region, model_id, user_name):
+    # Always acquired in the same order, so two requests never wait on each other's slots
+    request_limiters = []
+    if PRINCIPAL_CONCURRENCY_LIMIT:
+        request_limiters.append(get_limiter(PRINCIPAL, user_name, PRINCIPAL_CONCURRENCY_LIMIT))
+    model_limit = get_configured_limit(MODEL_CONCURRENCY_LIMITS, model_id)
+    if model_limit:
+        request_limiters.append(get_limiter(MODEL, model_id, model_limit))
+    region_limit = get_configured_limit(REGION_CONCURRENCY_LIMITS, region)
+    if region_limit:
+        request_limiters.append(get_limiter(REGION, region, region_limit))
+    if ADAPTIVE_CONCURRENCY:
+        request_limiters.append(get_limiter(
+            REGION_MODEL, get_region_model_key(region, model_id), ADAPTIVE_CONCURRENCY_INITIAL, AdaptiveConcurrencyLimiter
+        ))
+    return request_limiters
+
+
+async def acquire_admission_slot(region, model_id, user_name):
+    """
+    Admit a Bedrock call against the concurrency limits of its model, region and user.
+
+    Args:
+        region (str): The region the call goes to.
+        model_id (str): The Bedrock model id.
+        user_name (str): The user the call is made for.
+
+    Returns:
+        AdmissionSlot: The held slots, to be released once the call and its stream are done.
+
+    Raises:
+        AdmissionRejected: 429 if the user's limit is exhausted, 503 if the model's or region's is.
+    """
+    slot = AdmissionSlot()
+    start = time.monotonic()
+    deadline = start + ADMISSION_MAX_WAIT_SECONDS
+    try:
+        for limiter in get_request_limiters(region, model_id, user_name):
+            rejection = await limiter.acquire(deadline - time.monotonic())
+            if rejection:
+                # Principal keys are user names, keep them out of the metric labels
+                metric_key = "" if limiter.scope == PRINCIPAL else limiter.key
+                increment("gateway_admission_rejected_total", scope=limiter.scope, key=metric_key, reason=rejection)
+                slot.release()
+                raise_rejection(limiter)
+            slot.held.append(limiter)
+    except asyncio.CancelledError:
+        slot.release()
+        raise
+
+    increment("gateway_admission_admitted_total")
+    increment("gateway_admission_wait_seconds_total", time.monotonic() - start)
+    return slot
+
+
+def record_call_success(region, model_id, started_at, time_to_first_token=None):
+    """Feed a successful Bedrock call, started at the monotonic time started_at, to the adaptive limit of its region
+    and model. Only streams have a time to first token, the full response time of other calls depends too much on the
+    output length."""
+    limiter = limiters.get((REGION_MODEL, get_region_model_key(region, model_id)))
+    if limiter is not None:
+        limiter.on_success(started_at, time_to_first_token)
+
+
+def record_call_throttled(region, model_id, started_at):
+    limiter = limiters.get((REGION_MODEL, get_region_model_key(region, model_id)))
+    if limiter is not None:
+        limiter.decrease(started_at, "throttled")
+
+
+def raise_rejection(limiter):
+    if limiter.scope == PRINCIPAL:
+        raise AdmissionRejected(PRINCIPAL, status.HTTP_429_TOO_MANY_REQUESTS, "Too many concurrent requests")
+    raise AdmissionRejected(
+        limiter.scope,
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        f"Too many concurrent requests for {limiter.scope} {limiter.key}, please retry",
+    )
+
+
+def collect_admission_metrics():
+    principal_in_flight = 0
+    principal_queued = 0
+    for limiter in list(limiters.values()):
+        if limiter.scope == PRINCIPAL:
+            principal_in_flight += limiter.in_flight
+            principal_queued += len(limiter.waiters)
+            continue
+        labels = {"scope": limiter.scope, "key": limiter.key}
+        yield "gateway_admission_in_flight", "gauge", labels, limiter.in_flight
+        yield "gateway_admission_queue_depth", "gauge", labels, len(limiter.waiters)
+        yield "gateway_admission_limit", "gauge", labels, limiter.limit
+    if PRINCIPAL_CONCURRENCY_LIMIT:
+        yield "gateway_admission_in_flight", "gauge", {"scope": PRINCIPAL, "key": ""}, principal_in_flight
+        yield "gateway_admission_queue_depth", "gauge", {"scope": PRINCIPAL, "key": ""}, principal_queued
+
+
+register_collector(collect_admission_metrics)
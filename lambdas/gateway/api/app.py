@@ -1,27 +1,48 @@
+import gc
 import logging
+from typing import Annotated
 
-from api.quota import write_quota_updates_to_dynamo
+from api.quota import write_quota_updates_to_dynamo, replay_quota_journal
+from api.clients import close_async_clients
+from api.request_details import start_request_details_writer, stop_request_details_writer
+from api.metrics import render_metrics
+from api.loop_monitor import start_loop_lag_monitor, stop_loop_lag_monitor
+from api.auth import api_key_auth
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import PlainTextResponse
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from mangum import Mangum
 from contextlib import asynccontextmanager
 from anyio import to_thread
 from apscheduler.schedulers.background import BackgroundScheduler
 
 from api.routers import model, chat, embeddings
-from api.setting import API_ROUTE_PREFIX, TITLE, DESCRIPTION, SUMMARY, VERSION
+from api.setting import API_ROUTE_PREFIX, TITLE, DESCRIPTION, SUMMARY, VERSION, METRICS_USERS
 
 scheduler = BackgroundScheduler()
+security = HTTPBearer()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     to_thread.current_default_thread_limiter().total_tokens = 1000
+    replay_quota_journal()
     scheduler.add_job(write_quota_updates_to_dynamo, 'interval', minutes=10)
     scheduler.start()
+    await start_request_details_writer()
+    await start_loop_lag_monitor()
+    # What is allocated by now lives as long as the worker. Frozen, it is no longer scanned by the full garbage
+    # collections that the allocations of large embeddings requests trigger, which otherwise pause the loop.
+    gc.freeze()
     yield
+    await stop_loop_lag_monitor()
+    await stop_request_details_writer()
+    scheduler.shutdown(wait=False)
+    # Don't lose the spend accumulated since the last scheduled flush on deploys and scale-in
+    await to_thread.run_sync(write_quota_updates_to_dynamo)
+    await close_async_clients()
 
 config = {
     "title": TITLE,
@@ -56,6 +77,21 @@ async def health():
     return {"status": "OK"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics(
+        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]
+    ):
+    """Gateway metrics in the Prometheus text format, for the users in METRICS_USERS"""
+    principal, error_response = await api_key_auth(credentials)
+    if error_response:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key or JWT Cognito Access Token"
+        )
+    if principal["username"] not in METRICS_USERS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed to read the gateway metrics")
+    return render_metrics()
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
     return PlainTextResponse(str(exc), status_code=400)
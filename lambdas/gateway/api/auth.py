@@ -5,39 +5,53 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import json
 import os
-import requests
+import asyncio
+import httpx
 import hashlib
 import botocore
-from cachetools import TTLCache
+from jose import jwk, jwt, JWTError
+from jose.utils import base64url_decode
+import time
 import traceback
-from api.clients import get_dynamo_db_client
+from api.cache import AsyncCache
+from api.clients import get_async_dynamo_db_resource
 
 ## BEGIN ENVIORNMENT VARIABLES #################################################
 COGNITO_DOMAIN_PREFIX = os.environ.get("COGNITO_DOMAIN_PREFIX")
 REGION = os.environ.get("REGION")
 API_KEY_TABLE_NAME = os.environ.get("API_KEY_TABLE_NAME", None)
 SALT_SECRET = os.environ.get("SALT_SECRET")
+USER_POOL_ID = os.environ.get("USER_POOL_ID")
+APP_CLIENT_ID = os.environ.get("APP_CLIENT_ID")
+# Claims checked in order for the user name of a Cognito access token
+COGNITO_USER_NAME_CLAIMS = [item.strip() for item in os.environ.get("COGNITO_USER_NAME_CLAIMS", "email,preferred_username").split(",") if item.strip()]
+# Access tokens usually carry none of the claims above, so by default the userInfo endpoint is asked once per user
+COGNITO_USER_INFO_FALLBACK = os.environ.get("COGNITO_USER_INFO_FALLBACK", "true").lower() == "true"
+# Minimum time between JWKS downloads triggered by tokens with an unknown kid
+JWKS_MIN_REFRESH_INTERVAL = float(os.environ.get("JWKS_MIN_REFRESH_INTERVAL", "60"))
+COGNITO_HTTP_TIMEOUT = float(os.environ.get("COGNITO_HTTP_TIMEOUT", "5"))
 
-cache = TTLCache(maxsize=10000, ttl=1200)
-api_key_name_cache = TTLCache(maxsize=10000, ttl=1200)
+# Principal records by hashed API key or by Cognito access token, shared by every route. Tokens that do not
+# resolve to a principal are cached briefly, the key index is eventually consistent for new keys.
+principal_cache = AsyncCache("principal", maxsize=10000, ttl=1200, negative_ttl=60)
 
-authorized_cache_value = "authorized"
-unauthorized_cache_value = "unauthorized"
+# User names resolved through the userInfo endpoint, by the token's sub, so new tokens of a known user skip the call
+cognito_user_name_cache = AsyncCache("cognito_user_name", maxsize=10000, ttl=1200)
 
-security = HTTPBearer()
-secrets_manager_client = boto3.client("secretsmanager")
-
-def add_to_api_key_cache(key, value):
-    cache[key] = value
+COGNITO_ISSUER = f"https://cognito-idp.{REGION}.amazonaws.com/{USER_POOL_ID}"
+JWKS_URL = f"{COGNITO_ISSUER}/.well-known/jwks.json"
 
-def get_from_api_key_cache(key):
-    return cache.get(key, None)
+# kid -> constructed public key of the user pool
+jwks_keys = {}
+jwks_fetched_at = None
+jwks_lock = asyncio.Lock()
 
-def add_to_cache(key, value):
-    cache[key] = value
+API_KEY_STATUS_ACTIVE = "active"
 
-def get_from_cache(key):
-    return cache.get(key, None)
+security = HTTPBearer()
+secrets_manager_client = boto3.client("secretsmanager")
+# Pooled connections for the JWKS and userInfo endpoints
+http_client = httpx.AsyncClient(timeout=COGNITO_HTTP_TIMEOUT)
 
 def unauthorized_response():
     return (None, {
@@ -45,53 +59,70 @@ def unauthorized_response():
                     "body": json.dumps({"message": "Unauthorized"})
     })
 
-def authorized_response(user_name):
-    return (user_name, None)
+def authorized_response(principal):
+    return (principal, None)
 
-def get_cached_authorization(token, current_method):
-    return get_from_cache(token+current_method)
+def build_principal(user_name, api_key_name=None, expiration_timestamp=None, status=API_KEY_STATUS_ACTIVE):
+    """
+    Build the principal record authorization is evaluated against.
 
-def cache_authorized(token, current_method, user_name):
-    add_to_cache(token+current_method, authorized_cache_value + ":" + user_name)
+    Args:
+        user_name (str): The user the token belongs to.
+        api_key_name (str): The name of the API key, None for Cognito access tokens.
+        expiration_timestamp: Epoch seconds after which the key or token is no longer valid.
+        status (str): The key status, only active keys are authorized.
+
+    Returns:
+        dict: username, api_key_name, expiration_timestamp and status of the caller.
+    """
+    return {
+        "username": user_name,
+        "api_key_name": api_key_name,
+        "expiration_timestamp": expiration_timestamp,
+        "status": status,
+    }
 
-def cache_unauthorized(token, current_method):
-    add_to_cache(token+current_method, unauthorized_cache_value)
+def is_principal_authorized(principal):
+    # Every API route is open to any valid principal, only the key's own state can deny it
+    if principal["status"] != API_KEY_STATUS_ACTIVE:
+        return False
+    expiration_timestamp = principal["expiration_timestamp"]
+    if expiration_timestamp and float(expiration_timestamp) < time.time():
+        return False
+    return True
 
-def api_key_auth(
-    credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
-    current_method
+async def api_key_auth(
+    credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]
 ):
-    #print(f'current_method: {current_method}')
+    """
+    Resolve the caller's principal and authorize it, the same for every route.
+
+    Returns:
+        tuple: The principal record and None if authorized, otherwise None and an error response.
+    """
     bearer_token = credentials.credentials
-    cached_auth_response = get_cached_authorization(bearer_token, current_method)
-    if cached_auth_response:
-        #print(f'auth cache hit')
-        if cached_auth_response.startswith(authorized_cache_value):
-            user_name = cached_auth_response.split(":")[1]
-            return authorized_response(user_name)
-        elif cached_auth_response.startswith(unauthorized_cache_value):
-            return unauthorized_response()
-        else:
-            return unauthorized_response()
+    is_api_key = bearer_token.startswith("sk-")
+    cache_key = hash_api_key(bearer_token) if is_api_key else bearer_token
 
-    #print(f'not using the cache')
+    if is_api_key:
+        load_principal = lambda: get_api_key_principal(cache_key)
+    else:
+        load_principal = lambda: get_cognito_principal(bearer_token)
     try:
-        if bearer_token.startswith("sk-"):
-            user_name = get_user_name_api_key(bearer_token)
-        else:
-            user_name = get_user_name(bearer_token)
-        if not user_name:
-            cache_unauthorized(bearer_token, current_method)
-            return unauthorized_response()
-        #print(f'Found user_name {user_name}. Access granted.')
-        cache_authorized(bearer_token, current_method, user_name)
-        return authorized_response(user_name)
+        principal = await principal_cache.get(cache_key, load_principal)
     except Exception as e:
         print(f'Error when trying to authenticate: {e}')
         traceback.print_exc()
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key or JWT Cognito Access Token"
         )
+    if not principal:
+        return unauthorized_response()
+
+    if not is_principal_authorized(principal):
+        return unauthorized_response()
+    #print(f'Found user_name {user_name}. Access granted.')
+    return authorized_response(principal)
 
 def get_salt():
     try:
@@ -110,11 +141,7 @@ def get_salt():
     
 SALT = get_salt()
 
-#ToDo: Use username to look up whether user has exceeded thier ratelimit
-def has_exceeded_rate_limit(user_name):
-    return False
-
-def query_by_api_key_hash(api_key_hash):
+async def query_by_api_key_hash(api_key_hash):
     """
     Query DynamoDB by api_key_value_hash using the secondary index and extract specific attributes.
 
@@ -125,12 +152,12 @@ def query_by_api_key_hash(api_key_hash):
         dict: A dictionary containing the username and api_key_name if found; otherwise, None.
     """
 
-    dynamodb = get_dynamo_db_client()
+    dynamodb = await get_async_dynamo_db_resource()
     # Access the DynamoDB table
-    table = dynamodb.Table(API_KEY_TABLE_NAME)
+    table = await dynamodb.Table(API_KEY_TABLE_NAME)
 
     # Perform the query using the secondary index
-    response = table.query(
+    response = await table.query(
         IndexName='ApiKeyValueHashIndex',  # The name of the secondary index
         KeyConditionExpression='api_key_value_hash = :hash_value',
         ExpressionAttributeValues={
@@ -146,18 +173,91 @@ def query_by_api_key_hash(api_key_hash):
     else:
         return None
     
-def get_user_name(authorization_header):
-    user_info = get_user_info_cognito(authorization_header)
+async def get_cognito_principal(access_token):
+    if not USER_POOL_ID:
+        # No user pool to verify against, let Cognito validate the token
+        user_name = await get_user_name_from_user_info(access_token)
+        return build_principal(user_name) if user_name else None
+
+    claims = await verify_cognito_access_token(access_token)
+    if not claims:
+        return None
+    user_name = await get_cognito_user_name(access_token, claims)
+    if not user_name:
+        return None
+    return build_principal(user_name, expiration_timestamp=claims["exp"])
+
+async def get_cognito_user_name(access_token, claims):
+    for claim in COGNITO_USER_NAME_CLAIMS:
+        if claims.get(claim):
+            return claims[claim]
+    if not COGNITO_USER_INFO_FALLBACK:
+        return claims.get("username")
+    return await cognito_user_name_cache.get(claims["sub"], lambda: get_user_name_from_user_info(access_token))
+
+async def get_user_name_from_user_info(access_token):
+    user_info = await get_user_info_cognito(access_token)
     if user_info:
         if "email" in user_info:
-            user_name = user_info['email']
+            return user_info['email']
         elif "preferred_username" in user_info:
-            user_name = user_info['preferred_username']
+            return user_info['preferred_username']
         else:
-            user_name = user_info["username"]
-        return user_name
+            return user_info["username"]
     return None
 
+async def verify_cognito_access_token(access_token):
+    """
+    Verify a Cognito access token locally against the user pool's JWKS.
+
+    Args:
+        access_token (str): The bearer token.
+
+    Returns:
+        dict: The token's claims if the signature, expiry, issuer, client and token use check out, otherwise None.
+    """
+    try:
+        headers = jwt.get_unverified_headers(access_token)
+        public_key = await get_jwks_key(headers.get("kid"))
+        if not public_key:
+            print('Public key not found in jwks.json')
+            return None
+        message, encoded_signature = access_token.rsplit('.', 1)
+        if not public_key.verify(message.encode("utf8"), base64url_decode(encoded_signature.encode("utf-8"))):
+            print('Signature verification failed')
+            return None
+        claims = jwt.get_unverified_claims(access_token)
+    except (JWTError, ValueError) as e:
+        print(f'Malformed access token: {e}')
+        return None
+
+    if time.time() > claims.get("exp", 0):
+        return None
+    if claims.get("iss") != COGNITO_ISSUER or claims.get("token_use") != "access":
+        return None
+    if claims.get("client_id") != APP_CLIENT_ID:
+        print('Token was not issued for this client')
+        return None
+    return claims
+
+async def get_jwks_key(kid):
+    key = jwks_keys.get(kid)
+    if key is not None:
+        return key
+    async with jwks_lock:
+        # Unknown kid, the pool may have rotated its keys. Download them again, but not more than once per interval.
+        if kid not in jwks_keys and (jwks_fetched_at is None or time.monotonic() - jwks_fetched_at >= JWKS_MIN_REFRESH_INTERVAL):
+            await refresh_jwks()
+    return jwks_keys.get(kid)
+
+async def refresh_jwks():
+    global jwks_keys, jwks_fetched_at
+    jwks_fetched_at = time.monotonic()
+    response = await http_client.get(JWKS_URL)
+    response.raise_for_status()
+    jwks_keys = {key["kid"]: jwk.construct(key) for key in response.json()["keys"]}
+    print(f'Loaded {len(jwks_keys)} keys from {JWKS_URL}')
+
 def hash_api_key(api_key_value):
     """
     Generates a SHA-256 hash of the API key value, using a salt.
@@ -174,23 +274,18 @@ def hash_api_key(api_key_value):
     hasher.update(salted_input.encode('utf-8'))  # Ensure the input is encoded to bytes
     return hasher.hexdigest()
 
-def get_user_name_api_key(authorization_header):
-    hashed_api_key_value = hash_api_key(authorization_header)
-    api_key_document = query_by_api_key_hash(hashed_api_key_value)
-    return api_key_document.get('username')
-
-def get_api_key_name(api_key):
-    hashed_api_key_value = hash_api_key(api_key)
-    cached_api_key_name = get_from_api_key_cache(hashed_api_key_value)
-    if cached_api_key_name:
-        return cached_api_key_name
-    
-    api_key_document = query_by_api_key_hash(hashed_api_key_value)
-    api_key_name = api_key_document.get('api_key_name')
-    add_to_api_key_cache(hashed_api_key_value, api_key_name)
-    return api_key_name
+async def get_api_key_principal(hashed_api_key_value):
+    api_key_document = await query_by_api_key_hash(hashed_api_key_value)
+    if not api_key_document:
+        return None
+    return build_principal(
+        api_key_document.get('username'),
+        api_key_name=api_key_document.get('api_key_name'),
+        expiration_timestamp=api_key_document.get('expiration_timestamp'),
+        status=api_key_document.get('status', API_KEY_STATUS_ACTIVE)
+    )
 
-def get_user_info_cognito(authorization_header):
+async def get_user_info_cognito(authorization_header):
     url = f'https://{COGNITO_DOMAIN_PREFIX}.auth.{REGION}.amazoncognito.com/oauth2/userInfo'
 
     # Set the headers with the access token
@@ -199,7 +294,7 @@ def get_user_info_cognito(authorization_header):
     }
 
     # Make the HTTP GET request to the User Info endpoint
-    response = requests.get(url, headers=headers, timeout=60)
+    response = await http_client.get(url, headers=headers)
 
     # Check if the request was successful
     if response.status_code == 200:
@@ -0,0 +1,123 @@
+import asyncio
+import random
+import time
+from cachetools import LRUCache
+from api.metrics import register_collector
+
+# Every AsyncCache by name, for the metrics endpoint
+caches = {}
+
+
+class AsyncCache:
+    """Cache for async lookups against DynamoDB, SSM and Cognito.
+
+    - Concurrent misses for a key share one load (single flight), so an expiring hot key costs one call.
+    - After soft_ttl an entry is still served while one background refresh replaces it. Only entries past
+      ttl, or never loaded, make callers wait.
+    - Expiry times are jittered down by up to `jitter`, so entries loaded together do not expire together.
+    - A loader result of None is cached for negative_ttl seconds, or not at all when negative_ttl is None.
+      Loader exceptions are never cached.
+    """
+
+    def __init__(self, name, maxsize=10000, ttl=1200, soft_ttl=None, negative_ttl=None, jitter=0.1):
+        self.name = name
+        self.entries = LRUCache(maxsize=maxsize)
+        self.ttl = ttl
+        self.soft_ttl = soft_ttl if soft_ttl is not None else ttl * 0.75
+        self.negative_ttl = negative_ttl
+        self.jitter = jitter
+        # key -> Task of the load or refresh in progress
+        self.loads = {}
+        self.stats = {"hits": 0, "stale_hits": 0, "negative_hits": 0, "misses": 0, "loads": 0, "refreshes": 0, "load_errors": 0}
+        caches[name] = self
+
+    def _expiry(self, ttl):
+        return time.monotonic() + ttl * (1 - random.random() * self.jitter)
+
+    def set(self, key, value):
+        if value is None:
+            if self.negative_ttl is None:
+                self.entries.pop(key, None)
+                return
+            deadline = self._expiry(self.negative_ttl)
+            self.entries[key] = (None, deadline, deadline)
+        else:
+            self.entries[key] = (value, self._expiry(self.soft_ttl), self._expiry(self.ttl))
+
+    def peek(self, key):
+        """Return the cached value for key without loading it, None if it is not cached or expired."""
+        entry = self.entries.get(key)
+        if entry and time.monotonic() < entry[2]:
+            return entry[0]
+        return None
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    async def get(self, key, loader):
+        """
+        Return the cached value for key, loading it with loader on a miss.
+
+        Args:
+            key: The cache key.
+            loader: A zero argument coroutine function returning the value, or None if it does not exist.
+
+        Returns:
+            The cached or loaded value, None for a (cached) miss.
+        """
+        entry = self.entries.get(key)
+        if entry:
+            value, soft_deadline, hard_deadline = entry
+            now = time.monotonic()
+            if now < hard_deadline:
+                if value is None:
+                    self.stats["negative_hits"] += 1
+                elif now < soft_deadline:
+                    self.stats["hits"] += 1
+                else:
+                    self.stats["stale_hits"] += 1
+                    self._start_load(key, loader, refresh=True)
+                return value
+
+        self.stats["misses"] += 1
+        # Shielded, so a caller that goes away does not cancel the load the other callers are waiting on
+        return await asyncio.shield(self._start_load(key, loader, refresh=False))
+
+    def _start_load(self, key, loader, refresh):
+        task = self.loads.get(key)
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            return task
+        task = asyncio.get_running_loop().create_task(self._load(key, loader, refresh))
+        self.loads[key] = task
+        task.add_done_callback(lambda _: self._load_done(key, task))
+        return task
+
+    def _load_done(self, key, task):
+        if self.loads.get(key) is task:
+            del self.loads[key]
+        if not task.cancelled():
+            # Retrieve the exception so a refresh nobody awaits does not log it as never retrieved
+            task.exception()
+
+    async def _load(self, key, loader, refresh):
+        self.stats["refreshes" if refresh else "loads"] += 1
+        try:
+            value = await loader()
+        except Exception as e:
+            self.stats["load_errors"] += 1
+            if refresh:
+                # The stale entry keeps being served until it hard expires
+                print(f'Failed to refresh {self.name} cache entry: {e}')
+            raise
+        self.set(key, value)
+        return value
+
+
+def collect_cache_metrics():
+    for cache in list(caches.values()):
+        for stat, value in cache.stats.items():
+            yield f"gateway_cache_{stat}_total", "counter", {"cache": cache.name}, value
+        yield "gateway_cache_entries", "gauge", {"cache": cache.name}, len(cache.entries)
+
+
+register_collector(collect_cache_metrics)
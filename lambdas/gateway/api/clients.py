@@ -1,10 +1,50 @@
+import asyncio
+from contextlib import AsyncExitStack
 import botocore
 import boto3
+import aioboto3
 
 client_config = botocore.config.Config(
             max_pool_connections=1000,
         )
 dynamodb = boto3.resource('dynamodb', config=client_config)
+# Plain low level client, thread safe and without the resource's attribute value transformation
+dynamodb_client = boto3.client('dynamodb', config=client_config)
+
+# Async clients are long lived and shared by every request handled by this worker's event loop.
+async_session = aioboto3.Session()
+async_exit_stack = AsyncExitStack()
+async_clients = {}
+async_clients_lock = asyncio.Lock()
 
 def get_dynamo_db_client():
-    return dynamodb
\ No newline at end of file
+    return dynamodb
+
+def get_dynamo_db_low_level_client():
+    return dynamodb_client
+
+async def get_async_dynamo_db_resource():
+    return await _get_or_create_async("resource", "dynamodb")
+
+async def get_async_client(service_name, region_name=None, endpoint_url=None):
+    return await _get_or_create_async("client", service_name, region_name, endpoint_url)
+
+async def _get_or_create_async(kind, service_name, region_name=None, endpoint_url=None):
+    key = (kind, service_name, region_name, endpoint_url)
+    if key in async_clients:
+        return async_clients[key]
+
+    async with async_clients_lock:
+        if key not in async_clients:  # Double-check after acquiring the lock
+            factory = async_session.resource if kind == "resource" else async_session.client
+            kwargs = {"config": client_config}
+            if region_name:
+                kwargs["region_name"] = region_name
+            if endpoint_url:
+                kwargs["endpoint_url"] = endpoint_url
+            async_clients[key] = await async_exit_stack.enter_async_context(factory(service_name, **kwargs))
+    return async_clients[key]
+
+async def close_async_clients():
+    await async_exit_stack.aclose()
+    async_clients.clear()
@@ -0,0 +1,158 @@
+import asyncio
+import os
+from api.metrics import increment, register_collector
+from api.response_cache import get_request_hash
+
+# Opt-in single flight: identical requests arriving while one is still calling Bedrock wait for that call instead of
+# making their own. Whether different users' requests are merged follows RESPONSE_CACHE_SCOPE.
+REQUEST_COALESCING = os.environ.get("REQUEST_COALESCING", "false").lower() == "true"
+
+# coalescing key -> SharedCall or SharedStream
+in_flight = {}
+
+
+def get_coalescing_key(kind, request, user_name):
+    """
+    Args:
+        kind (str): The kind of call, only calls of the same kind are merged.
+        request: The parsed Bedrock request, JSON serializable.
+        user_name (str): The user the request is made for.
+
+    Returns:
+        str: The coalescing key of the request, or None if coalescing is disabled.
+    """
+    if not REQUEST_COALESCING:
+        return None
+    return get_request_hash(f"coalesce:{kind}", user_name, request)
+
+
+class SharedCall:
+    """One upstream call awaited by every identical request. It is cancelled once no request waits for it anymore."""
+    __slots__ = ("kind", "task", "subscribers")
+
+    def __init__(self, kind, task):
+        self.kind = kind
+        self.task = task
+        self.subscribers = 0
+
+
+class SharedStream:
+    """The events of one upstream stream. Every subscriber gets the events published so far, then the live tail."""
+    __slots__ = ("kind", "task", "subscribers", "events", "done", "error", "changed")
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.task = None
+        self.subscribers = 0
+        self.events = []
+        self.done = False
+        self.error = None
+        # Replaced on every change, so a subscriber waits on the event current when it ran out of events
+        self.changed = asyncio.Event()
+
+    def publish(self, event):
+        self.events.append(event)
+        self._notify()
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def subscribe(self):
+        index = 0
+        while True:
+            while index < len(self.events):
+                yield self.events[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self.changed.wait()
+
+
+def _start(key, shared, coroutine):
+    shared.task = asyncio.ensure_future(coroutine)
+    in_flight[key] = shared
+
+    def on_done(task):
+        if in_flight.get(key) is shared:
+            del in_flight[key]
+        if isinstance(shared, SharedStream) and not shared.done:
+            shared.finish(asyncio.CancelledError() if task.cancelled() else task.exception())
+
+    shared.task.add_done_callback(on_done)
+
+
+def leave(shared):
+    """Unsubscribe from a SharedCall or SharedStream, cancelling its upstream call if nobody is left."""
+    shared.subscribers -= 1
+    if shared.subscribers == 0 and not shared.task.done():
+        shared.task.cancel()
+
+
+async def coalesce(kind, key, call):
+    """
+    Run call() once for all requests with the same key that arrive while it is running.
+
+    Args:
+        kind (str): The kind of call, for the metrics.
+        key (str): The coalescing key, None to always call.
+        call: Function returning the coroutine making the upstream call.
+
+    Returns:
+        tuple: The result of the call, and True if this request joined another request's call.
+    """
+    if key is None:
+        return await call(), False
+    shared = in_flight.get(key)
+    coalesced = isinstance(shared, SharedCall) and not shared.task.done()
+    if coalesced:
+        increment("gateway_coalesced_requests_total", kind=kind)
+    else:
+        shared = SharedCall(kind, None)
+        _start(key, shared, call())
+    shared.subscribers += 1
+    try:
+        return await asyncio.shield(shared.task), coalesced
+    finally:
+        leave(shared)
+
+
+def join_stream(kind, key, publish):
+    """
+    Subscribe to the stream of an identical request in flight, or start one. Call leave() once done with it.
+
+    Args:
+        kind (str): The kind of stream, for the metrics.
+        key (str): The coalescing key.
+        publish: Function taking the SharedStream and returning the coroutine that reads the upstream stream into it.
+
+    Returns:
+        tuple: The SharedStream, and True if this request joined another request's stream.
+    """
+    shared = in_flight.get(key)
+    coalesced = isinstance(shared, SharedStream) and not shared.done
+    if coalesced:
+        increment("gateway_coalesced_requests_total", kind=kind)
+    else:
+        shared = SharedStream(kind)
+        _start(key, shared, publish(shared))
+    shared.subscribers += 1
+    return shared, coalesced
+
+
+def collect_coalescing_metrics():
+    counts = {}
+    for shared in list(in_flight.values()):
+        counts[shared.kind] = counts.get(shared.kind, 0) + 1
+    for kind, count in counts.items():
+        yield "gateway_coalescing_in_flight", "gauge", {"kind": kind}, count
+
+
+register_collector(collect_coalescing_metrics)
@@ -0,0 +1,168 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Rows are only marked as used again after this long, so hits rarely need a write
+ACCESS_UPDATE_INTERVAL_SECONDS = 60
+# Writes between checks of the total size
+EVICTION_CHECK_WRITES = 200
+# Share of max_bytes kept after an eviction, so the next one is some writes away
+EVICTION_LOW_WATERMARK = 0.9
+# Keys per SELECT, below SQLite's limit on query parameters
+QUERY_BATCH_SIZE = 500
+
+
+class DiskCache:
+    """Key value cache in an SQLite file, shared by every worker process on the host and kept across restarts.
+
+    The database runs in WAL mode, so readers in one worker do not block the writer in another. Every write is its
+    own transaction, so a crash never leaves a partial entry behind. A file that is found corrupt is moved
+    aside and the cache starts empty. Least recently used rows are evicted once the total exceeds max_bytes.
+
+    The methods block, call them from a worker thread.
+    """
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.connection = None
+        self.writes_since_check = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            if connection.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+                raise sqlite3.DatabaseError("quick_check failed")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    def _get_connection(self):
+        if self.connection is None:
+            try:
+                self.connection = self._connect()
+            except sqlite3.OperationalError:
+                # Locked by another worker for now, not corrupt. Try again on the next call.
+                raise
+            except sqlite3.DatabaseError as e:
+                self._recover(e)
+                self.connection = self._connect()
+        return self.connection
+
+    def _recover(self, error):
+        print(f'Disk cache {self.path} is corrupt, starting with an empty cache: {error}')
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+        if os.path.exists(self.path):
+            os.replace(self.path, self.path + ".corrupt")
+
+    def _run(self, operation):
+        with self.lock:
+            try:
+                return operation(self._get_connection())
+            except sqlite3.OperationalError as e:
+                # Busy or locked by another worker, the cache is best effort
+                print(f'Disk cache {self.path} unavailable: {e}')
+                return None
+            except sqlite3.DatabaseError as e:
+                self._recover(e)
+                return None
+
+    def get(self, key):
+        """
+        Returns:
+            bytes: The value stored for key, None if it is missing or expired.
+        """
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        """
+        Returns:
+            list: The value stored for each key, None where it is missing or expired.
+        """
+        def operation(connection):
+            now = time.time()
+            found = {}
+            expired = []
+            touched = []
+            for start in range(0, len(keys), QUERY_BATCH_SIZE):
+                batch = keys[start:start + QUERY_BATCH_SIZE]
+                rows = connection.execute(
+                    f"SELECT key, value, created, accessed FROM entries WHERE key IN ({','.join('?' * len(batch))})", batch
+                )
+                for key, value, created, accessed in rows:
+                    if now - created > self.ttl:
+                        expired.append((key,))
+                        continue
+                    found[key] = value
+                    if now - accessed > ACCESS_UPDATE_INTERVAL_SECONDS:
+                        touched.append((now, key))
+            if expired:
+                connection.executemany("DELETE FROM entries WHERE key = ?", expired)
+            if touched:
+                connection.executemany("UPDATE entries SET accessed = ? WHERE key = ?", touched)
+            return [found.get(key) for key in keys]
+        values = self._run(operation)
+        return values if values is not None else [None] * len(keys)
+
+    def set(self, key, value):
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        """Store (key, value) pairs in one transaction. Values larger than max_bytes are skipped."""
+        items = [(key, value) for key, value in items if len(value) <= self.max_bytes]
+        if not items:
+            return
+
+        def operation(connection):
+            now = time.time()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    [(key, value, len(value), now, now) for key, value in items],
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            self.writes_since_check += len(items)
+            if self.writes_since_check >= EVICTION_CHECK_WRITES:
+                self.writes_since_check = 0
+                self._evict(connection)
+        self._run(operation)
+
+    def _evict(self, connection):
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes * EVICTION_LOW_WATERMARK
+        keys = []
+        for key, size in connection.execute("SELECT key, size FROM entries ORDER BY accessed"):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany("DELETE FROM entries WHERE key = ?", keys)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        print(f'Evicted {len(keys)} entries from disk cache {self.path}')
@@ -0,0 +1,57 @@
+import asyncio
+import os
+import time
+from api.metrics import increment, register_collector
+
+# How often the event loop lag is sampled, 0 to disable the monitor
+EVENT_LOOP_LAG_INTERVAL_SECONDS = float(os.environ.get("EVENT_LOOP_LAG_INTERVAL_SECONDS", "0.1"))
+# Lag above this is logged, something blocked every request and stream of the worker for that long
+EVENT_LOOP_LAG_WARN_SECONDS = float(os.environ.get("EVENT_LOOP_LAG_WARN_SECONDS", "0.1"))
+
+monitor_task = None
+# Lag of the latest sample, and the largest lag since the metrics were last rendered
+loop_lag = {"last": 0.0, "max": 0.0}
+
+
+async def monitor_loop_lag():
+    """Sleep for the interval and measure how much later than that the loop woke the monitor up."""
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL_SECONDS)
+        lag = max(0.0, time.monotonic() - start - EVENT_LOOP_LAG_INTERVAL_SECONDS)
+        loop_lag["last"] = lag
+        loop_lag["max"] = max(loop_lag["max"], lag)
+        increment("gateway_event_loop_lag_seconds_total", lag)
+        if lag > EVENT_LOOP_LAG_WARN_SECONDS:
+            increment("gateway_event_loop_stalls_total")
+            print(f'Event loop blocked for {lag:.3f}s')
+
+
+async def start_loop_lag_monitor():
+    global monitor_task
+    if EVENT_LOOP_LAG_INTERVAL_SECONDS <= 0 or monitor_task is not None:
+        return
+    monitor_task = asyncio.create_task(monitor_loop_lag())
+
+
+async def stop_loop_lag_monitor():
+    global monitor_task
+    if monitor_task is None:
+        return
+    monitor_task.cancel()
+    try:
+        await monitor_task
+    except asyncio.CancelledError:
+        pass
+    monitor_task = None
+
+
+def collect_loop_lag_metrics():
+    if monitor_task is None:
+        return
+    yield "gateway_event_loop_lag_seconds", "gauge", {}, loop_lag["last"]
+    yield "gateway_event_loop_max_lag_seconds", "gauge", {}, loop_lag["max"]
+    loop_lag["max"] = 0.0
+
+
+register_collector(collect_loop_lag_metrics)
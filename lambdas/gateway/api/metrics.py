@@ -0,0 +1,58 @@
+import threading
+
+# (name, sorted label items) -> value
+counters = {}
+gauges = {}
+# Callables returning (name, type, labels, value) tuples, read when the metrics are rendered
+collectors = []
+metrics_lock = threading.Lock()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    key = _key(name, labels)
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    gauges[_key(name, labels)] = value
+
+
+def register_collector(collector):
+    collectors.append(collector)
+
+
+def _format_labels(label_items):
+    if not label_items:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in label_items) + "}"
+
+
+def render_metrics():
+    """
+    Render all metrics in the Prometheus text exposition format.
+
+    Returns:
+        str: One line per sample, grouped by metric name.
+    """
+    samples = {}
+    with metrics_lock:
+        counter_items = list(counters.items())
+    for (name, label_items), value in counter_items:
+        samples.setdefault((name, "counter"), []).append((label_items, value))
+    for (name, label_items), value in list(gauges.items()):
+        samples.setdefault((name, "gauge"), []).append((label_items, value))
+    for collector in collectors:
+        for name, metric_type, labels, value in collector():
+            samples.setdefault((name, metric_type), []).append((tuple(sorted(labels.items())), value))
+
+    lines = []
+    for (name, metric_type), values in sorted(samples.items()):
+        lines.append(f"# TYPE {name} {metric_type}")
+        for label_items, value in values:
+            lines.append(f"{name}{_format_labels(label_items)} {value}")
+    return "\n".join(lines) + "\n"
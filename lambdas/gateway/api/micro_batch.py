@@ -0,0 +1,109 @@
+import asyncio
+import json
+from fastapi import HTTPException, status
+from api.metrics import increment
+
+
+class PendingBatch:
+    __slots__ = ("model_id", "args", "texts", "indexes", "requests", "result", "timer")
+
+    def __init__(self, model_id, args):
+        self.model_id = model_id
+        self.args = args
+        self.texts = []
+        # text -> index in texts, texts of different requests are embedded once
+        self.indexes = {}
+        self.requests = 0
+        self.result = asyncio.get_running_loop().create_future()
+        self.timer = None
+
+
+class MicroBatcher:
+    """Collects the texts of concurrent embeddings requests with the same model and parameters into one call.
+
+    A batch is sent max_wait seconds after its first request arrived, or as soon as it holds max_texts texts.
+    """
+
+    def __init__(self, name, max_wait, max_texts):
+        self.name = name
+        self.max_wait = max_wait
+        self.max_texts = max_texts
+        # batch key -> PendingBatch
+        self.pending = {}
+
+    async def embed(self, model_id, args, call):
+        """
+        Embed the texts of args as part of a batch.
+
+        Args:
+            model_id (str): The Bedrock model id.
+            args (dict): The model request args with the texts of this request.
+            call: Function taking the args of a batch and the model id, returning the coroutine that embeds them.
+
+        Returns:
+            list: The embedding of each text of args, in order.
+        """
+        texts = args["texts"]
+        if len(texts) > self.max_texts:
+            return (await call(args, model_id))["embeddings"]
+
+        parameters = {name: value for name, value in args.items() if name != "texts"}
+        key = json.dumps([model_id, parameters], sort_keys=True)
+        batch = self.pending.get(key)
+        if batch is not None and len(batch.texts) + len(texts) > self.max_texts:
+            self._send(key, batch, call)
+            batch = None
+        if batch is None:
+            batch = self.pending[key] = PendingBatch(model_id, parameters)
+            batch.timer = asyncio.get_running_loop().call_later(self.max_wait, self._send, key, batch, call)
+
+        indexes = []
+        for text in texts:
+            index = batch.indexes.get(text)
+            if index is None:
+                index = batch.indexes[text] = len(batch.texts)
+                batch.texts.append(text)
+            indexes.append(index)
+        batch.requests += 1
+        if len(batch.texts) >= self.max_texts:
+            self._send(key, batch, call)
+
+        # Shielded, a request going away does not cancel the call of the others
+        embeddings = await asyncio.shield(batch.result)
+        if embeddings is None:
+            # The batch was rejected, possibly for the texts of another request
+            return (await call(args, model_id))["embeddings"]
+        return [embeddings[index] for index in indexes]
+
+    def _send(self, key, batch, call):
+        if self.pending.get(key) is not batch:
+            return
+        del self.pending[key]
+        batch.timer.cancel()
+        increment("gateway_micro_batches_total", batcher=self.name)
+        increment("gateway_micro_batch_requests_total", batch.requests, batcher=self.name)
+        increment("gateway_micro_batch_texts_total", len(batch.texts), batcher=self.name)
+        asyncio.ensure_future(self._run(batch, call))
+
+    async def _run(self, batch, call):
+        try:
+            response_body = await call({**batch.args, "texts": batch.texts}, batch.model_id)
+        except asyncio.CancelledError:
+            # E.g. on shutdown. Fail the waiters instead of leaving them waiting for a result that never comes.
+            batch.result.set_exception(
+                HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Embeddings batch was cancelled")
+            )
+            batch.result.exception()
+            raise
+        except Exception as e:
+            if isinstance(e, HTTPException) and e.status_code == status.HTTP_400_BAD_REQUEST and batch.requests > 1:
+                # Each request tries again alone, so only the invalid one fails. Other errors, e.g. throttling, are
+                # not retried, that would only add load.
+                increment("gateway_micro_batch_splits_total", batcher=self.name)
+                batch.result.set_result(None)
+                return
+            batch.result.set_exception(e)
+            # Retrieved here, the requests of the batch may all have gone away
+            batch.result.exception()
+            return
+        batch.result.set_result(response_body["embeddings"])
@@ -1,6 +1,7 @@
 import boto3
 import os
 import botocore
+from api.clients import get_async_client
 
 ENABLED_MODELS = os.environ["ENABLED_MODELS"]
 #print(f'ENABLED_MODELS: {ENABLED_MODELS}')
@@ -8,20 +9,27 @@ REGION = os.environ["REGION"]
 BENCHMARK_MODE = os.environ["BENCHMARK_MODE"] == "true"
 LLM_GATEWAY_URL = os.environ["LLM_GATEWAY_URL"] + "/benchmark"
 
+# Entries are model, region_model or region_model_weight. A model listed with several regions is routed across
+# them in proportion to the weights, which default to 1.
 enabled_models_list = ENABLED_MODELS.split(",")
 #print(f'enabled_models_list: {enabled_models_list}')
 region_client_map = {}
 model_region_map = {}
+# model -> [(region, weight), ...] in the order listed
+model_regions_map = {}
 
 for enabled_model in enabled_models_list:
     #print(f'enabled_model: {enabled_model}')
     enabled_model_split = enabled_model.split("_")
+    weight = 1.0
     if len(enabled_model_split) == 1:
         region = REGION
         model = enabled_model_split[0]
     else:
         region = enabled_model_split[0]
         model = enabled_model_split[1]
+        if len(enabled_model_split) > 2:
+            weight = float(enabled_model_split[2])
 
     if region not in region_client_map:
         print(f'Creating boto3 client')
@@ -43,7 +51,9 @@ for enabled_model in enabled_models_list:
                 config=client_config
             )
 
-    model_region_map[model] = region
+    # The first region listed is the model's home region, used for estimates and the embeddings
+    model_region_map.setdefault(model, region)
+    model_regions_map.setdefault(model, []).append((region, weight))
 
 #print(f'region_client_map: {region_client_map}')
 #print(f'model_region_map: {model_region_map}')
@@ -51,5 +61,13 @@ for enabled_model in enabled_models_list:
 def get_model_region_map():
     return model_region_map
 
+def get_model_regions_map():
+    return model_regions_map
+
 def get_region_client_map():
     return region_client_map
+
+async def get_async_region_client(region):
+    if BENCHMARK_MODE:
+        return await get_async_client("bedrock-runtime", region_name=region, endpoint_url=LLM_GATEWAY_URL)
+    return await get_async_client("bedrock-runtime", region_name=region)
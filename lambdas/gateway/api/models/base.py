@@ -1,3 +1,4 @@
+import json
 import time
 import uuid
 from abc import ABC, abstractmethod
@@ -29,7 +30,7 @@ class BaseChatModel(ABC):
         pass
 
     @abstractmethod
-    def chat(self, chat_request: ChatRequest) -> ChatResponse:
+    async def chat(self, chat_request: ChatRequest, user_name, api_key_name) -> ChatResponse:
         """Handle a basic chat completion requests."""
         pass
 
@@ -55,6 +56,38 @@ class BaseChatModel(ABC):
         return "data: [DONE]\n\n".encode("utf-8")
 
 
+class StreamChunkEncoder:
+    """Encode text delta chunks of a single stream without building pydantic models.
+
+    The static parts of the chunk are rendered once per message id and model, and each delta only splices the
+    JSON escaped text (and the current timestamp) into them. The output is byte-identical to
+    BaseChatModel.stream_response_to_bytes for a text-only delta.
+    """
+
+    def __init__(self, message_id: str, model: str):
+        self._prefix = ('data: {"id":' + json.dumps(message_id, ensure_ascii=False) + ',"created":').encode("utf-8")
+        self._middle = (
+            ',"model":' + json.dumps(model, ensure_ascii=False) + ',"system_fingerprint":"fp",'
+            '"choices":[{"index":0,"finish_reason":null,"logprobs":null,"delta":{"content":'
+        ).encode("utf-8")
+        self._suffix = b'}}],"object":"chat.completion.chunk","usage":null}\n\n'
+        self._created = 0
+        self._created_bytes = b"0"
+
+    def encode_text_delta(self, text: str) -> bytes:
+        created = int(time.time())
+        if created != self._created:
+            self._created = created
+            self._created_bytes = str(created).encode("utf-8")
+        return b"".join((
+            self._prefix,
+            self._created_bytes,
+            self._middle,
+            json.dumps(text, ensure_ascii=False).encode("utf-8"),
+            self._suffix,
+        ))
+
+
 class BaseEmbeddingsModel(ABC):
     """Represents a basic embeddings model.
 
@@ -62,6 +95,6 @@ class BaseEmbeddingsModel(ABC):
     """
 
     @abstractmethod
-    def embed(self, embeddings_request: EmbeddingsRequest, user_name:str, api_key_name:str) -> EmbeddingsResponse:
+    async def embed(self, embeddings_request: EmbeddingsRequest, user_name:str, api_key_name:str) -> EmbeddingsResponse:
         """Handle a basic embeddings request."""
         pass
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import json
 import logging
@@ -5,18 +6,19 @@ import re
 import time
 import os
 from abc import ABC
+from contextlib import asynccontextmanager
 from typing import AsyncIterable, Iterable, Literal
 
 import boto3
-from api.model_enabled import get_region_client_map, get_model_region_map
+from api.model_enabled import get_model_region_map, get_model_regions_map, get_async_region_client
+import httpx
 import numpy as np
-import requests
 import tiktoken
 from fastapi import HTTPException
 from collections.abc import Iterable
 from typing import Union
 
-from api.models.base import BaseChatModel, BaseEmbeddingsModel
+from api.models.base import BaseChatModel, BaseEmbeddingsModel, StreamChunkEncoder
 from api.schema import (
     # Chat
     ChatResponse,
@@ -40,14 +42,30 @@ from api.schema import (
     EmbeddingsUsage,
     Embedding,
 )
-from api.setting import DEBUG, AWS_REGION
+from api.setting import DEBUG, AWS_REGION, DEFAULT_EMBEDDING_MODEL
 from api.quota import calculate_input_cost, calculate_output_cost, update_quota_local
+from api.rate_limit import record_token_usage
+from api.admission import (
+    AdmissionRejected, REGION, REGION_MODEL, acquire_admission_slot, record_call_success, record_call_throttled
+)
+from api.region_router import (
+    allow_call, choose_regions, get_response_time_percentile, is_region_failure, is_retryable_error, is_throttling_error,
+    record_failover, record_failure, record_response_time, record_success
+)
+from api.metrics import increment
+from api.response_cache import (
+    StreamResponseAssembler, get_cached_response, get_cached_values, get_embedding_cache_keys, get_response_cache_key,
+    store_response, store_values, to_stream_events
+)
 from api.request_details import create_request_detail
+from api.coalescing import coalesce, get_coalescing_key, join_stream, leave
+from api.semantic_cache import SemanticQuery, get_semantic_cache_prompt
+from api.micro_batch import MicroBatcher
 
 logger = logging.getLogger(__name__)
 
-region_client_map = get_region_client_map()
 model_region_map = get_model_region_map()
+model_regions_map = get_model_regions_map()
 
 SUPPORTED_BEDROCK_EMBEDDING_MODELS = {
     "cohere.embed-multilingual-v3": "Cohere Embed Multilingual",
@@ -59,6 +77,88 @@ SUPPORTED_BEDROCK_EMBEDDING_MODELS = {
 
 ENCODER = tiktoken.get_encoding("cl100k_base")
 
+# Most texts Cohere Embed takes in one call, larger inputs are split into calls of this size
+EMBEDDINGS_BATCH_SIZE = int(os.environ.get("EMBEDDINGS_BATCH_SIZE", "96"))
+# Calls of one embeddings request running at the same time
+EMBEDDINGS_MAX_PARALLEL_CALLS = int(os.environ.get("EMBEDDINGS_MAX_PARALLEL_CALLS", "4"))
+# Embeddings built or JSON encoded in one slice of work on the event loop, see embeddings_slice
+EMBEDDINGS_SLICE_SIZE = 32
+# Opt-in micro-batching: embeddings requests of at most EMBEDDINGS_MICRO_BATCH_MAX_TEXTS texts arriving within
+# EMBEDDINGS_MICRO_BATCH_WAIT_MS of each other share one Bedrock call
+EMBEDDINGS_MICRO_BATCH = os.environ.get("EMBEDDINGS_MICRO_BATCH", "false").lower() == "true"
+EMBEDDINGS_MICRO_BATCH_WAIT_MS = float(os.environ.get("EMBEDDINGS_MICRO_BATCH_WAIT_MS", "5"))
+EMBEDDINGS_MICRO_BATCH_MAX_TEXTS = int(os.environ.get("EMBEDDINGS_MICRO_BATCH_MAX_TEXTS", str(EMBEDDINGS_BATCH_SIZE)))
+# Maximum number of encoded chunks buffered between the Bedrock reader and the client for a single stream.
+STREAM_BUFFER_SIZE = int(os.environ.get("STREAM_BUFFER_SIZE", "64"))
+# Hedging of non-streaming calls to models with several regions: a call still waiting after the HEDGE_PERCENTILE of
+# its region's recent response times gets a second call in another region, and the first answer wins.
+HEDGE_REQUESTS = os.environ.get("HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY_SECONDS = float(os.environ.get("HEDGE_MIN_DELAY_SECONDS", "0.5"))
+# Time allowed to fetch an image url of a chat message
+IMAGE_FETCH_TIMEOUT_SECONDS = float(os.environ.get("IMAGE_FETCH_TIMEOUT_SECONDS", "10"))
+
+# Pooled connections for the image urls of chat messages
+image_http_client = httpx.AsyncClient(timeout=IMAGE_FETCH_TIMEOUT_SECONDS, follow_redirects=True)
+
+# Held for one slice of embeddings work at a time across all requests of the worker
+embeddings_slice_lock = asyncio.Lock()
+
+
+def get_hedge_delay(model_id, regions):
+    """
+    Returns:
+        float: Seconds after which a non-streaming call in regions[0] is hedged, None if it is not hedged.
+    """
+    if not HEDGE_REQUESTS or len(regions) < 2:
+        return None
+    threshold = get_response_time_percentile(regions[0], model_id, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+    if threshold is None:
+        return None
+    return max(threshold, HEDGE_MIN_DELAY_SECONDS)
+
+
+@asynccontextmanager
+async def embeddings_slice():
+    """
+    Run a slice of the decoding, building or encoding of embeddings, then let the event loop run other tasks.
+
+    Thousands of embeddings hold the GIL for long enough to stall every stream of the worker, and a worker thread
+    would hold it just the same, so the work stays on the loop in slices of a few milliseconds: one Bedrock call of
+    at most EMBEDDINGS_BATCH_SIZE embeddings, or EMBEDDINGS_SLICE_SIZE embeddings. At most one slice runs per loop
+    iteration, so many concurrent requests cannot add up to a stall either.
+    """
+    await embeddings_slice_lock.acquire()
+    try:
+        yield
+    finally:
+        # Released on the next iteration, after the tasks that became ready meanwhile, e.g. streams, had their turn
+        asyncio.get_running_loop().call_soon(embeddings_slice_lock.release)
+
+
+async def peek_stream(stream):
+    """
+    Read the first event of a Converse stream, raising the error it carries if there is one.
+
+    Returns:
+        An async iterator over all the events of the stream, the first one included.
+    """
+    events = stream.__aiter__()
+    try:
+        first_event = await events.__anext__()
+    except StopAsyncIteration:
+        first_event = None
+
+    async def chained():
+        if first_event is None:
+            return
+        yield first_event
+        async for event in events:
+            yield event
+
+    return chained()
+
 
 class BedrockModel(BaseChatModel):
     # https://docs.aws.amazon.com/bedrock/latest/userguide/conversation-inference.html#conversation-inference-supported-models-features
@@ -194,32 +294,245 @@ class BedrockModel(BaseChatModel):
                 detail=error,
             )
 
-    def _invoke_bedrock(self, chat_request: ChatRequest, stream=False):
-        """Common logic for invoke bedrock models"""
-        bedrock_runtime = region_client_map[model_region_map[chat_request.model]]
-        # convert OpenAI chat request to Bedrock SDK request
-        args = self._parse_request(chat_request)
+    def estimate_cost(self, chat_request: ChatRequest):
+        """Upper bound of the request cost, used to reserve quota while the request is in flight.
+
+        Input tokens are roughly estimated as characters divided by 4, output tokens as max_tokens.
+        """
+        total_length = 0
+        for message in chat_request.messages:
+            if isinstance(message.content, str):
+                total_length += len(message.content)
+            elif isinstance(message.content, list):
+                for part in message.content:
+                    if isinstance(part, TextContent):
+                        total_length += len(part.text)
+        # Any of the model's regions may serve the request, reserve for the most expensive one
+        return max(
+            calculate_input_cost(total_length // 4, chat_request.model, region)
+            + calculate_output_cost(chat_request.max_tokens or 0, chat_request.model, region)
+            for region, _ in model_regions_map[chat_request.model]
+        )
+
+    async def _invoke_bedrock(self, chat_request: ChatRequest, args: dict, user_name, stream=False, regions=None, attempt=None):
+        """
+        Invoke the model in the best of its regions, failing over to the next region on throttling and on
+        transient errors, for streams also when the first event carries one. Nothing has been sent to the client at
+        that point, so failover is invisible to it. Regions whose circuit is open are skipped.
+
+        Args:
+            args (dict): The Converse request from _parse_request.
+            regions (list): Regions to try in order, chosen by the router if None.
+            attempt (dict): Optional, its "region" is set to the region while a call to Bedrock is in flight.
+
+        Returns:
+            tuple: The Bedrock response, the region that served it, the admission slot held for the call, which the
+            caller releases, and the monotonic time the call to that region started.
+        """
+        if regions is None:
+            regions = choose_regions(chat_request.model)
+        if attempt is None:
+            attempt = {}
+
+        for index, region in enumerate(regions):
+            is_last_region = index == len(regions) - 1
+            if not allow_call(region, chat_request.model):
+                if is_last_region:
+                    raise HTTPException(
+                        status_code=503,
+                        detail=f"{chat_request.model} is temporarily unavailable, please retry",
+                        headers={"Retry-After": "1"},
+                    )
+                continue
+            try:
+                slot = await acquire_admission_slot(region, chat_request.model, user_name)
+            except AdmissionRejected as e:
+                if e.scope not in (REGION, REGION_MODEL) or is_last_region:
+                    raise
+                record_failover(region, chat_request.model)
+                continue
+
+            bedrock_runtime = await get_async_region_client(region)
+            started_at = time.monotonic()
+            attempt["region"] = region
+            try:
+                if stream:
+                    response = await bedrock_runtime.converse_stream(**args)
+                    # Throttling and unavailability may only show in the first event, still in time to fail over
+                    response["stream"] = await peek_stream(response["stream"])
+                else:
+                    response = await bedrock_runtime.converse(**args)
+            except bedrock_runtime.exceptions.ValidationException as e:
+                attempt["region"] = None
+                slot.release()
+                logger.error("Validation Error: " + str(e))
+                raise HTTPException(status_code=400, detail=str(e))
+            except Exception as e:
+                attempt["region"] = None
+                slot.release()
+                throttled = is_throttling_error(e)
+                if is_region_failure(e):
+                    record_failure(region, chat_request.model, throttled)
+                if throttled:
+                    record_call_throttled(region, chat_request.model, started_at)
+                if is_retryable_error(e) and not is_last_region:
+                    logger.warning(f"{region} failed for {chat_request.model}, failing over: {e}")
+                    record_failover(region, chat_request.model)
+                    continue
+                logger.error(e)
+                if throttled:
+                    raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+                raise HTTPException(status_code=500, detail=str(e))
+            except BaseException:
+                slot.release()
+                raise
+
+            if not stream:
+                response_time = time.monotonic() - started_at
+                record_success(region, chat_request.model, response_time)
+                record_response_time(region, chat_request.model, response_time)
+                record_call_success(region, chat_request.model, started_at)
+            return response, region, slot, started_at
+
+    async def _invoke_bedrock_hedged(self, chat_request: ChatRequest, args: dict, user_name, api_key_name):
+        """
+        Invoke the model without streaming, hedged with a call in a second region if HEDGE_REQUESTS is enabled and
+        the first call is slow. The first answer wins and the other call is cancelled. A cancelled call that had
+        reached Bedrock is charged like the winning call, as it may be billed.
+
+        Returns:
+            tuple: The Bedrock response, the region that served it and the admission slot held for the call.
+        """
+        regions = choose_regions(chat_request.model)
+        hedge_delay = get_hedge_delay(chat_request.model, regions)
+        if hedge_delay is None:
+            response, region, slot, _ = await self._invoke_bedrock(chat_request, args, user_name, regions=regions)
+            return response, region, slot
+
+        primary_attempt = {}
+        primary = asyncio.create_task(
+            self._invoke_bedrock(chat_request, args, user_name, regions=regions, attempt=primary_attempt)
+        )
+        attempts = {primary: primary_attempt}
+        winner = None
+        try:
+            done, _ = await asyncio.wait([primary], timeout=hedge_delay)
+            if not done:
+                increment("gateway_hedged_requests_total", model=chat_request.model)
+                hedge_attempt = {}
+                hedge = asyncio.create_task(
+                    self._invoke_bedrock(chat_request, args, user_name, regions=regions[1:], attempt=hedge_attempt)
+                )
+                attempts[hedge] = hedge_attempt
+            pending = set(attempts)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+        finally:
+            if winner is None:
+                # Every call failed, or the caller went away
+                await self._cancel_hedge_attempts(attempts)
+        if winner is None:
+            raise primary.exception()
+
+        response, region, slot, _ = winner.result()
+        if winner is not primary:
+            increment("gateway_hedge_wins_total", model=chat_request.model)
+        losers = {task: attempt for task, attempt in attempts.items() if task is not winner}
+        await self._cancel_hedge_attempts(losers, chat_request, user_name, api_key_name, response["usage"])
+        return response, region, slot
+
+    async def _cancel_hedge_attempts(self, attempts, chat_request=None, user_name=None, api_key_name=None, usage=None):
+        """Cancel hedged calls and charge the ones that reached Bedrock, given the usage of the winning call."""
+        for task in attempts:
+            task.cancel()
+        results = await asyncio.gather(*attempts, return_exceptions=True)
+        for (task, attempt), result in zip(attempts.items(), results):
+            if isinstance(result, tuple):
+                # Finished before it could be cancelled, its real usage is known
+                loser_response, region, slot, _ = result
+                slot.release()
+                if usage is not None:
+                    loser_usage = loser_response["usage"]
+                    await self._charge_call(
+                        chat_request, user_name, api_key_name, region, loser_usage["inputTokens"], loser_usage["outputTokens"],
+                        "Hedge Cancelled"
+                    )
+            elif isinstance(result, asyncio.CancelledError) and attempt.get("region") and usage is not None:
+                await self._charge_call(
+                    chat_request, user_name, api_key_name, attempt["region"], usage["inputTokens"], usage["outputTokens"],
+                    "Hedge Cancelled"
+                )
+
+    async def _charge_call(self, chat_request: ChatRequest, user_name, api_key_name, region, input_tokens, output_tokens, result):
+        total_cost = calculate_input_cost(input_tokens, chat_request.model, region) + calculate_output_cost(output_tokens, chat_request.model, region)
+        update_quota_local(user_name, total_cost)
+        record_token_usage(user_name, api_key_name, chat_request.model, input_tokens + output_tokens)
+        await create_request_detail(user_name, api_key_name, total_cost, input_tokens, output_tokens, chat_request.model, result)
+
+    async def _call_bedrock(self, chat_request: ChatRequest, args: dict, user_name, api_key_name, cache_key=None):
+        response, region, slot = await self._invoke_bedrock_hedged(chat_request, args, user_name, api_key_name)
+        slot.release()
+        store_response(cache_key, response)
+        return response, region
+
+    async def _lookup_caches(self, chat_request: ChatRequest, args: dict, user_name, api_key_name):
+        """
+        Look a chat request up in the response cache, then in the semantic cache.
 
+        Returns:
+            tuple: The cached Converse response or None, the result to record for a hit, the response cache key and
+                the SemanticQuery, both to store the response under on a miss.
+        """
+        cache_key = get_response_cache_key(chat_request, args, user_name)
+        cached_response = await get_cached_response(cache_key)
+        if cached_response:
+            return cached_response, "Cache Hit", cache_key, None
+        semantic_query = await self._get_semantic_query(chat_request, args, user_name, api_key_name)
+        if semantic_query:
+            return semantic_query.lookup(), "Semantic Cache Hit", cache_key, semantic_query
+        return None, None, cache_key, None
+
+    async def _get_semantic_query(self, chat_request: ChatRequest, args: dict, user_name, api_key_name):
+        prompt = get_semantic_cache_prompt(args, user_name)
+        if prompt is None:
+            return None
+        partition_key, text = prompt
         try:
-            if stream:
-                response = bedrock_runtime.converse_stream(**args)
-            else:
-                response = bedrock_runtime.converse(**args)
-        except bedrock_runtime.exceptions.ValidationException as e:
-            logger.error("Validation Error: " + str(e))
-            raise HTTPException(status_code=400, detail=str(e))
+            # Charged to the user like any embeddings request
+            embeddings_response = await get_embeddings_model(DEFAULT_EMBEDDING_MODEL).embed(
+                EmbeddingsRequest(model=DEFAULT_EMBEDDING_MODEL, input=[text]), user_name, api_key_name
+            )
         except Exception as e:
-            logger.error(e)
-            raise HTTPException(status_code=500, detail=str(e))
-        return response
+            logger.error(f"Semantic cache skipped, the prompt could not be embedded: {e}")
+            return None
+        vector = np.array(embeddings_response.data[0].embedding, dtype=np.float32)
+        return SemanticQuery(partition_key, vector, chat_request.model)
 
-    def chat(self, chat_request: ChatRequest, user_name, api_key_name) -> ChatResponse:
+    async def chat(self, chat_request: ChatRequest, user_name, api_key_name) -> ChatResponse:
         """Default implementation for Chat API."""
 
         message_id = self.generate_message_id()
+        # convert OpenAI chat request to Bedrock SDK request
+        args = await self._parse_request(chat_request)
+        cached_response, result, cache_key, semantic_query = await self._lookup_caches(chat_request, args, user_name, api_key_name)
+        if cached_response:
+            usage = cached_response["usage"]
+            await create_request_detail(user_name, api_key_name, 0, usage["inputTokens"], usage["outputTokens"], chat_request.model, result)
+            return self._create_response(
+                model=chat_request.model,
+                message_id=message_id,
+                content=cached_response["output"]["message"]["content"],
+                finish_reason=cached_response["stopReason"],
+                input_tokens=usage["inputTokens"],
+                output_tokens=usage["outputTokens"],
+            )
 
+        coalescing_key = get_coalescing_key("chat", args, user_name) if chat_request.temperature == 0 else None
         #start_time = time.time()  # Start time before the function call
-        response = self._invoke_bedrock(chat_request)
+        (response, region), coalesced = await coalesce(
+            "chat", coalescing_key, lambda: self._call_bedrock(chat_request, args, user_name, api_key_name, cache_key)
+        )
         #end_time = time.time()  # End time after the function call
         #elapsed_time = (end_time - start_time) * 1000  # Calculate elapsed time in milliseconds
         #print(f"Execution time: {elapsed_time:.2f} ms")  # Print elapsed time
@@ -229,15 +542,30 @@ class BedrockModel(BaseChatModel):
         output_tokens = response["usage"]["outputTokens"]
         finish_reason = response["stopReason"]
 
+        if semantic_query and not coalesced:
+            semantic_query.store(response)
+        if coalesced:
+            # The request whose call this one joined pays for it
+            await create_request_detail(user_name, api_key_name, 0, input_tokens, output_tokens, chat_request.model, "Coalesced")
+            return self._create_response(
+                model=chat_request.model,
+                message_id=message_id,
+                content=output_message["content"],
+                finish_reason=finish_reason,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+            )
+
         #print(f'stream_response.usage: {usage}')
-        input_cost = calculate_input_cost(input_tokens, chat_request.model)
+        input_cost = calculate_input_cost(input_tokens, chat_request.model, region)
         #print(f'usage.prompt_tokens: {usage.prompt_tokens} input_cost: {input_cost}')
-        output_cost = calculate_output_cost(output_tokens, chat_request.model)
+        output_cost = calculate_output_cost(output_tokens, chat_request.model, region)
         #print(f'usage.completion_tokens: {usage.completion_tokens} output_cost: {output_cost}')
         total_cost = input_cost + output_cost
         #print(f'total_cost: {total_cost}')
         update_quota_local(user_name, total_cost)
-        create_request_detail(user_name, api_key_name, total_cost, input_tokens, output_tokens, chat_request.model, "Success")
+        record_token_usage(user_name, api_key_name, chat_request.model, input_tokens + output_tokens)
+        await create_request_detail(user_name, api_key_name, total_cost, input_tokens, output_tokens, chat_request.model, "Success")
 
         chat_response = self._create_response(
             model=chat_request.model,
@@ -249,13 +577,57 @@ class BedrockModel(BaseChatModel):
         )
         return chat_response
 
-    def chat_stream(self, chat_request: ChatRequest, user_name, api_key_name) -> AsyncIterable[bytes]:
-        """Default implementation for Chat Stream API"""
-        response = self._invoke_bedrock(chat_request, stream=True)
-        message_id = self.generate_message_id()
+    async def chat_stream(self, chat_request: ChatRequest, user_name, api_key_name) -> AsyncIterable[bytes]:
+        """Default implementation for Chat Stream API
+
+        The Bedrock event stream is read by a dedicated reader task that hands encoded chunks over through a
+        bounded queue, so a slow client pauses the reader instead of buffering the whole generation in memory.
+        The admission slot is held until the stream ends. Cached responses are replayed without calling Bedrock.
+        """
+        # convert OpenAI chat request to Bedrock SDK request
+        args = await self._parse_request(chat_request)
+        cached_response, result, cache_key, semantic_query = await self._lookup_caches(chat_request, args, user_name, api_key_name)
+        if cached_response:
+            async for chunk in self._replay_cached_stream(cached_response, chat_request, user_name, api_key_name, result):
+                yield chunk
+            return
+
+        coalescing_key = get_coalescing_key("chat_stream", args, user_name) if chat_request.temperature == 0 else None
+        if coalescing_key:
+            async for chunk in self._subscribe_stream(
+                coalescing_key, chat_request, args, user_name, api_key_name, cache_key, semantic_query
+            ):
+                yield chunk
+            return
+
+        response, region, slot, started_at = await self._invoke_bedrock(chat_request, args, user_name, stream=True)
+        reader = None
+        try:
+            message_id = self.generate_message_id()
 
-        stream = response.get("stream")
-        for chunk in stream:
+            queue = asyncio.Queue(maxsize=STREAM_BUFFER_SIZE)
+            reader = asyncio.create_task(
+                self._read_stream(
+                    response.get("stream"), queue, chat_request, message_id, user_name, api_key_name, region, started_at,
+                    cache_key, semantic_query
+                )
+            )
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # The client may disconnect mid stream, stop reading from Bedrock in that case.
+            if reader and not reader.done():
+                reader.cancel()
+            slot.release()
+
+    async def _replay_cached_stream(self, cached_response, chat_request: ChatRequest, user_name, api_key_name, result="Cache Hit"):
+        message_id = self.generate_message_id()
+        for chunk in to_stream_events(cached_response):
             stream_response = self._create_response_stream(
                 model_id=chat_request.model, message_id=message_id, chunk=chunk
             )
@@ -264,28 +636,144 @@ class BedrockModel(BaseChatModel):
             if stream_response.choices:
                 yield self.stream_response_to_bytes(stream_response)
             else:
-                
                 usage = stream_response.usage
-                #print(f'stream_response.usage: {usage}')
-                input_cost = calculate_input_cost(usage.prompt_tokens, chat_request.model)
-                #print(f'usage.prompt_tokens: {usage.prompt_tokens} input_cost: {input_cost}')
-                output_cost = calculate_output_cost(usage.completion_tokens, chat_request.model)
-                #print(f'usage.completion_tokens: {usage.completion_tokens} output_cost: {output_cost}')
-                total_cost = input_cost + output_cost
-                #print(f'total_cost: {total_cost}')
-                update_quota_local(user_name, total_cost)
-                create_request_detail(user_name, api_key_name, total_cost, usage.prompt_tokens, usage.completion_tokens, chat_request.model, "Success")
-                # An empty choices for Usage as per OpenAI doc below:
-                # if you set stream_options: {"include_usage": true}.
-                # an additional chunk will be streamed before the data: [DONE] message.
-                # The usage field on this chunk shows the token usage statistics for the entire request,
-                # and the choices field will always be an empty array.
-                # All other chunks will also include a usage field, but with a null value.
+                await create_request_detail(user_name, api_key_name, 0, usage.prompt_tokens, usage.completion_tokens, chat_request.model, result)
                 if chat_request.stream_options and chat_request.stream_options.include_usage:
                     yield self.stream_response_to_bytes(stream_response)
-        # return an [DONE] message at the end.
         yield self.stream_response_to_bytes()
 
+    async def _subscribe_stream(self, coalescing_key, chat_request: ChatRequest, args: dict, user_name, api_key_name, cache_key=None, semantic_query=None):
+        """Stream the response of a Bedrock stream shared by identical requests, starting it if none is in flight."""
+        shared, coalesced = join_stream(
+            "chat_stream", coalescing_key,
+            lambda shared: self._publish_stream(shared, chat_request, args, user_name, api_key_name, cache_key, semantic_query),
+        )
+        try:
+            message_id = self.generate_message_id()
+            encoder = StreamChunkEncoder(message_id, chat_request.model)
+            async for chunk in shared.subscribe():
+                if "contentBlockDelta" in chunk and "text" in chunk["contentBlockDelta"]["delta"]:
+                    yield encoder.encode_text_delta(chunk["contentBlockDelta"]["delta"]["text"])
+                    continue
+                stream_response = self._create_response_stream(
+                    model_id=chat_request.model, message_id=message_id, chunk=chunk
+                )
+                if not stream_response:
+                    continue
+                if stream_response.choices:
+                    yield self.stream_response_to_bytes(stream_response)
+                else:
+                    if coalesced:
+                        # The request whose stream this one joined pays for it
+                        usage = stream_response.usage
+                        await create_request_detail(user_name, api_key_name, 0, usage.prompt_tokens, usage.completion_tokens, chat_request.model, "Coalesced")
+                    if chat_request.stream_options and chat_request.stream_options.include_usage:
+                        yield self.stream_response_to_bytes(stream_response)
+            yield self.stream_response_to_bytes()
+        finally:
+            leave(shared)
+
+    async def _publish_stream(self, shared, chat_request: ChatRequest, args: dict, user_name, api_key_name, cache_key=None, semantic_query=None):
+        """Read a Bedrock stream into a SharedStream, charging the request that started it."""
+        response, region, slot, started_at = await self._invoke_bedrock(chat_request, args, user_name, stream=True)
+        first_chunk = True
+        assembler = StreamResponseAssembler() if cache_key or semantic_query else None
+        try:
+            async for chunk in response.get("stream"):
+                if first_chunk:
+                    first_chunk = False
+                    time_to_first_token = time.monotonic() - started_at
+                    record_success(region, chat_request.model, time_to_first_token)
+                    record_call_success(region, chat_request.model, started_at, time_to_first_token)
+                if assembler:
+                    assembler.add(chunk)
+                if "metadata" in chunk and "usage" in chunk["metadata"]:
+                    usage = chunk["metadata"]["usage"]
+                    await self._charge_call(
+                        chat_request, user_name, api_key_name, region, usage["inputTokens"], usage["outputTokens"], "Success"
+                    )
+                shared.publish(chunk)
+        except Exception as e:
+            logger.error(e)
+            throttled = is_throttling_error(e)
+            if is_region_failure(e):
+                record_failure(region, chat_request.model, throttled)
+            if throttled:
+                record_call_throttled(region, chat_request.model, started_at)
+            raise
+        finally:
+            slot.release()
+        if assembler:
+            completed_response = assembler.get_response()
+            if completed_response:
+                store_response(cache_key, completed_response)
+                if semantic_query:
+                    semantic_query.store(completed_response)
+
+    async def _read_stream(self, stream, queue: asyncio.Queue, chat_request: ChatRequest, message_id: str, user_name, api_key_name, region, started_at, cache_key=None, semantic_query=None):
+        encoder = StreamChunkEncoder(message_id, chat_request.model)
+        first_chunk = True
+        assembler = StreamResponseAssembler() if cache_key or semantic_query else None
+        try:
+            async for chunk in stream:
+                if first_chunk:
+                    first_chunk = False
+                    time_to_first_token = time.monotonic() - started_at
+                    record_success(region, chat_request.model, time_to_first_token)
+                    record_call_success(region, chat_request.model, started_at, time_to_first_token)
+                if assembler:
+                    assembler.add(chunk)
+                # Fast path for plain text deltas, which are the vast majority of chunks.
+                if "contentBlockDelta" in chunk and "text" in chunk["contentBlockDelta"]["delta"]:
+                    await queue.put(encoder.encode_text_delta(chunk["contentBlockDelta"]["delta"]["text"]))
+                    continue
+                stream_response = self._create_response_stream(
+                    model_id=chat_request.model, message_id=message_id, chunk=chunk
+                )
+                if not stream_response:
+                    continue
+                if stream_response.choices:
+                    await queue.put(self.stream_response_to_bytes(stream_response))
+                else:
+                    
+                    usage = stream_response.usage
+                    #print(f'stream_response.usage: {usage}')
+                    input_cost = calculate_input_cost(usage.prompt_tokens, chat_request.model, region)
+                    #print(f'usage.prompt_tokens: {usage.prompt_tokens} input_cost: {input_cost}')
+                    output_cost = calculate_output_cost(usage.completion_tokens, chat_request.model, region)
+                    #print(f'usage.completion_tokens: {usage.completion_tokens} output_cost: {output_cost}')
+                    total_cost = input_cost + output_cost
+                    #print(f'total_cost: {total_cost}')
+                    update_quota_local(user_name, total_cost)
+                    record_token_usage(user_name, api_key_name, chat_request.model, usage.total_tokens)
+                    await create_request_detail(user_name, api_key_name, total_cost, usage.prompt_tokens, usage.completion_tokens, chat_request.model, "Success")
+                    # An empty choices for Usage as per OpenAI doc below:
+                    # if you set stream_options: {"include_usage": true}.
+                    # an additional chunk will be streamed before the data: [DONE] message.
+                    # The usage field on this chunk shows the token usage statistics for the entire request,
+                    # and the choices field will always be an empty array.
+                    # All other chunks will also include a usage field, but with a null value.
+                    if chat_request.stream_options and chat_request.stream_options.include_usage:
+                        await queue.put(self.stream_response_to_bytes(stream_response))
+        except Exception as e:
+            logger.error(e)
+            throttled = is_throttling_error(e)
+            if is_region_failure(e):
+                record_failure(region, chat_request.model, throttled)
+            if throttled:
+                record_call_throttled(region, chat_request.model, started_at)
+            await queue.put(e)
+            return
+        if assembler:
+            completed_response = assembler.get_response()
+            if completed_response:
+                store_response(cache_key, completed_response)
+                if semantic_query:
+                    semantic_query.store(completed_response)
+        # return an [DONE] message at the end.
+        await queue.put(self.stream_response_to_bytes())
+        await queue.put(None)
+
     def _parse_system_prompts(self, chat_request: ChatRequest) -> list[dict[str, str]]:
         """Create system prompts.
         Note that not all models support system prompts.
@@ -306,7 +794,7 @@ class BedrockModel(BaseChatModel):
 
         return system_prompts
 
-    def _parse_messages(self, chat_request: ChatRequest) -> list[dict]:
+    async def _parse_messages(self, chat_request: ChatRequest) -> list[dict]:
         """
         Converse API only support user and assistant messages.
 
@@ -324,7 +812,7 @@ class BedrockModel(BaseChatModel):
                 messages.append(
                     {
                         "role": message.role,
-                        "content": self._parse_content_parts(
+                        "content": await self._parse_content_parts(
                             message, chat_request.model
                         ),
                     }
@@ -375,7 +863,7 @@ class BedrockModel(BaseChatModel):
                 continue
         return messages
 
-    def _parse_request(self, chat_request: ChatRequest) -> dict:
+    async def _parse_request(self, chat_request: ChatRequest) -> dict:
         """Create default converse request body.
 
         Also perform validations to tool call etc.
@@ -383,7 +871,7 @@ class BedrockModel(BaseChatModel):
         Ref: https://docs.aws.amazon.com/bedrock/latest/APIReference/API_runtime_Converse.html
         """
 
-        messages = self._parse_messages(chat_request)
+        messages = await self._parse_messages(chat_request)
         system_prompts = self._parse_system_prompts(chat_request)
 
         # Base inference parameters.
@@ -555,7 +1043,7 @@ class BedrockModel(BaseChatModel):
 
         return None
 
-    def _parse_image(self, image_url: str) -> tuple[bytes, str]:
+    async def _parse_image(self, image_url: str) -> tuple[bytes, str]:
         """Try to get the raw data from an image url.
 
         Ref: https://docs.aws.amazon.com/bedrock/latest/APIReference/API_runtime_ImageSource.html
@@ -569,8 +1057,14 @@ class BedrockModel(BaseChatModel):
             image_data = re.sub(pattern, "", image_url)
             return base64.b64decode(image_data), content_type.group(1)
 
-        # Send a request to the image URL
-        response = requests.get(image_url)
+        # Send a request to the image URL, without blocking the event loop
+        try:
+            response = await image_http_client.get(image_url)
+        except httpx.HTTPError as e:
+            logger.error("Unable to access the image url: " + str(e))
+            raise HTTPException(
+                status_code=500, detail="Unable to access the image url"
+            )
         # Check if the request was successful
         if response.status_code == 200:
 
@@ -585,7 +1079,7 @@ class BedrockModel(BaseChatModel):
                 status_code=500, detail="Unable to access the image url"
             )
 
-    def _parse_content_parts(
+    async def _parse_content_parts(
             self,
             message: UserMessage,
             model_id: str,
@@ -610,7 +1104,7 @@ class BedrockModel(BaseChatModel):
                         status_code=400,
                         detail=f"Multimodal message is currently not supported by {model_id}",
                     )
-                image_data, content_type = self._parse_image(part.image_url.url)
+                image_data, content_type = await self._parse_image(part.image_url.url)
                 content_parts.append(
                     {
                         "image": {
@@ -680,27 +1174,36 @@ class BedrockEmbeddingsModel(BaseEmbeddingsModel, ABC):
     accept = "application/json"
     content_type = "application/json"
 
-    def _invoke_model(self, args: dict, model_id: str):
-        bedrock_runtime = region_client_map[model_region_map[model_id]]
+    async def _invoke_model(self, args: dict, model_id: str):
+        """
+        Returns:
+            dict: The decoded response body.
+        """
+        bedrock_runtime = await get_async_region_client(model_region_map[model_id])
 
         body = json.dumps(args)
         if DEBUG:
             logger.info("Invoke Bedrock Model: " + model_id)
         try:
-            return bedrock_runtime.invoke_model(
+            response = await bedrock_runtime.invoke_model(
                 body=body,
                 modelId=model_id,
                 accept=self.accept,
                 contentType=self.content_type,
             )
+            response_body = await response["body"].read()
         except bedrock_runtime.exceptions.ValidationException as e:
             logger.error("Validation Error: " + str(e))
             raise HTTPException(status_code=400, detail=str(e))
         except Exception as e:
             logger.error(e)
+            if is_throttling_error(e):
+                raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
             raise HTTPException(status_code=500, detail=str(e))
+        async with embeddings_slice():
+            return json.loads(response_body)
 
-    def _create_response(
+    async def _create_response(
             self,
             embeddings: list[float],
             model: str,
@@ -709,14 +1212,17 @@ class BedrockEmbeddingsModel(BaseEmbeddingsModel, ABC):
             encoding_format: Literal["float", "base64"] = "float",
     ) -> EmbeddingsResponse:
         data = []
-        for i, embedding in enumerate(embeddings):
-            if encoding_format == "base64":
-                arr = np.array(embedding, dtype=np.float32)
-                arr_bytes = arr.tobytes()
-                encoded_embedding = base64.b64encode(arr_bytes)
-                data.append(Embedding(index=i, embedding=encoded_embedding))
-            else:
-                data.append(Embedding(index=i, embedding=embedding))
+        for start in range(0, len(embeddings), EMBEDDINGS_SLICE_SIZE):
+            async with embeddings_slice():
+                for i in range(start, min(start + EMBEDDINGS_SLICE_SIZE, len(embeddings))):
+                    embedding = embeddings[i]
+                    if encoding_format == "base64":
+                        arr = np.array(embedding, dtype=np.float32)
+                        arr_bytes = arr.tobytes()
+                        encoded_embedding = base64.b64encode(arr_bytes)
+                        data.append(Embedding(index=i, embedding=encoded_embedding))
+                    else:
+                        data.append(Embedding(index=i, embedding=embedding))
         response = EmbeddingsResponse(
             data=data,
             model=model,
@@ -765,24 +1271,89 @@ class CohereEmbeddingsModel(BedrockEmbeddingsModel):
             length += len(text)
         return length
 
+    def estimate_cost(self, embeddings_request: EmbeddingsRequest):
+        """Cost of the request, used to reserve quota while the request is in flight."""
+        estimated_token_amount = self.get_length(self._parse_args(embeddings_request)['texts']) // 4
+        return calculate_input_cost(estimated_token_amount, embeddings_request.model, model_region_map[embeddings_request.model])
 
-    def embed(self, embeddings_request: EmbeddingsRequest, user_name:str, api_key_name:str) -> EmbeddingsResponse:
+
+    async def _embed_texts(self, args: dict, model_id: str):
+        if EMBEDDINGS_MICRO_BATCH:
+            return {"embeddings": await embeddings_batcher.embed(model_id, args, self._call_bedrock)}
+        return await self._call_bedrock(args, model_id)
+
+    async def _call_bedrock(self, args: dict, model_id: str):
+        """Embed the texts of args in calls of at most EMBEDDINGS_BATCH_SIZE texts, EMBEDDINGS_MAX_PARALLEL_CALLS
+        of them at a time, and merge the embeddings back in order."""
+        texts = args["texts"]
+        if len(texts) <= EMBEDDINGS_BATCH_SIZE:
+            return await self._invoke_model(args, model_id)
+
+        semaphore = asyncio.Semaphore(EMBEDDINGS_MAX_PARALLEL_CALLS)
+
+        async def embed_batch(start):
+            async with semaphore:
+                return await self._invoke_model({**args, "texts": texts[start:start + EMBEDDINGS_BATCH_SIZE]}, model_id)
+
+        batches = [asyncio.ensure_future(embed_batch(start)) for start in range(0, len(texts), EMBEDDINGS_BATCH_SIZE)]
+        try:
+            results = await asyncio.gather(*batches)
+        finally:
+            # Batches not started yet are not needed once one failed
+            for batch in batches:
+                batch.cancel()
+        return {"embeddings": [embedding for result in results for embedding in result["embeddings"]]}
+
+    async def embed(self, embeddings_request: EmbeddingsRequest, user_name:str, api_key_name:str) -> EmbeddingsResponse:
+        """Embed the texts of a request. Repeated texts are embedded once and cached texts are not sent to Bedrock,
+        only the texts sent are charged."""
         args = self._parse_args(embeddings_request)
-        response = self._invoke_model(
-            args=args, model_id=embeddings_request.model
-        )
-        response_body = json.loads(response.get("body").read())
-        total_length = self.get_length(args['texts'])
+        texts = args["texts"]
+        unique_texts = list(dict.fromkeys(texts))
+
+        # text -> embedding
+        embeddings = {}
+        cache_keys = get_embedding_cache_keys(embeddings_request.model, args["input_type"], unique_texts, user_name)
+        if cache_keys:
+            cached_values = await get_cached_values(cache_keys)
+            for start in range(0, len(unique_texts), EMBEDDINGS_SLICE_SIZE):
+                async with embeddings_slice():
+                    for i in range(start, min(start + EMBEDDINGS_SLICE_SIZE, len(unique_texts))):
+                        if cached_values[i] is not None:
+                            embeddings[unique_texts[i]] = np.frombuffer(cached_values[i]).tolist()
+        missing_texts = [text for text in unique_texts if text not in embeddings]
 
         #This model does not return the amount of tokens used. A rough estimate is characters divided by 4. Also, there is no charge for output tokens for embeddings models
-        estimated_token_amount = total_length // 4
-        input_cost = calculate_input_cost(estimated_token_amount, embeddings_request.model)
+        estimated_token_amount = self.get_length(missing_texts) // 4
+
+        result = "Cache Hit"
+        if missing_texts:
+            missing_args = {**args, "texts": missing_texts}
+            coalescing_key = get_coalescing_key("embeddings", [embeddings_request.model, missing_args], user_name)
+            response_body, coalesced = await coalesce(
+                "embeddings", coalescing_key, lambda: self._embed_texts(missing_args, embeddings_request.model)
+            )
+            embeddings.update(zip(missing_texts, response_body["embeddings"]))
+            result = "Coalesced" if coalesced else "Success"
+            if cache_keys and not coalesced:
+                key_by_text = dict(zip(unique_texts, cache_keys))
+                store_values([
+                    (key_by_text[text], np.array(embeddings[text], dtype=np.float64).tobytes()) for text in missing_texts
+                ])
+
+        if result == "Success":
+            input_cost = calculate_input_cost(estimated_token_amount, embeddings_request.model, model_region_map[embeddings_request.model])
+            update_quota_local(user_name, input_cost)
+            record_token_usage(user_name, api_key_name, embeddings_request.model, estimated_token_amount)
+            await create_request_detail(user_name, api_key_name, input_cost, estimated_token_amount, 0.0, embeddings_request.model, result)
+        else:
+            # Cached texts, or a call made and paid for by another request
+            await create_request_detail(user_name, api_key_name, 0, estimated_token_amount, 0.0, embeddings_request.model, result)
 
-        update_quota_local(user_name, input_cost)
-        create_request_detail(user_name, api_key_name, input_cost, estimated_token_amount, 0.0, embeddings_request.model, "Success")
-        return self._create_response(
-            embeddings=response_body["embeddings"],
+        return await self._create_response(
+            embeddings=[embeddings[text] for text in texts],
             model=embeddings_request.model,
+            input_tokens=estimated_token_amount,
             encoding_format=embeddings_request.encoding_format,
         )
 
@@ -813,19 +1384,21 @@ class TitanEmbeddingsModel(BedrockEmbeddingsModel):
             )
         return args
 
-    def embed(self, embeddings_request: EmbeddingsRequest, user_name:str, api_key_name:str) -> EmbeddingsResponse:
-        response = self._invoke_model(
+    async def embed(self, embeddings_request: EmbeddingsRequest, user_name:str, api_key_name:str) -> EmbeddingsResponse:
+        response_body = await self._invoke_model(
             args=self._parse_args(embeddings_request), model_id=embeddings_request.model
         )
-        response_body = json.loads(response.get("body").read())
 
-        return self._create_response(
+        return await self._create_response(
             embeddings=[response_body["embedding"]],
             model=embeddings_request.model,
             input_tokens=response_body["inputTextTokenCount"],
         )
 
 
+embeddings_batcher = MicroBatcher("embeddings", EMBEDDINGS_MICRO_BATCH_WAIT_MS / 1000, EMBEDDINGS_MICRO_BATCH_MAX_TEXTS)
+
+
 def get_embeddings_model(model_id: str) -> BedrockEmbeddingsModel:
     model_name = SUPPORTED_BEDROCK_EMBEDDING_MODELS.get(model_id, "")
     if DEBUG:
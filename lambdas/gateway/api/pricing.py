@@ -0,0 +1,91 @@
+import csv
+import decimal
+import os
+import threading
+import time
+from fastapi import HTTPException, status
+
+COST_DB_PATH = os.environ.get("COST_DB_PATH", "/app/api/data/cost_db.csv")
+# How often (in seconds) the cost db file is checked for changes
+COST_DB_RELOAD_INTERVAL = float(os.environ.get("COST_DB_RELOAD_INTERVAL", "60"))
+
+# Prices are kept as integer picodollars per token, so cost arithmetic is exact fixed point.
+COST_SCALE = 10 ** 12
+TOKENS_PER_PRICE_UNIT = 1000  # cost_db.csv prices are per 1000 tokens
+
+# (model_name, region) -> (input price, output price). Region-less rows are stored under (model_name, None)
+price_index = {}
+price_index_mtime = None
+next_reload_check = 0.0
+reload_lock = threading.Lock()
+
+
+def to_price_units(price_per_thousand_tokens):
+    price = decimal.Decimal(price_per_thousand_tokens.strip() or "0") * COST_SCALE / TOKENS_PER_PRICE_UNIT
+    return int(price.to_integral_value(rounding=decimal.ROUND_HALF_UP))
+
+
+def build_price_index(path):
+    index = {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            region = row["region"].strip() or None
+            key = (row["model_name"].strip(), region)
+            # Keep the first row for a key, like the previous first-match lookup did
+            if key not in index:
+                index[key] = (to_price_units(row["cost_per_token_input"]), to_price_units(row["cost_per_token_output"]))
+    return index
+
+
+def load_price_index():
+    global price_index, price_index_mtime
+    mtime = os.stat(COST_DB_PATH).st_mtime
+    if mtime == price_index_mtime:
+        return
+    price_index = build_price_index(COST_DB_PATH)
+    price_index_mtime = mtime
+    print(f'Loaded {len(price_index)} prices from {COST_DB_PATH}')
+
+
+def reload_price_index_if_changed():
+    global next_reload_check
+    now = time.monotonic()
+    if now < next_reload_check:
+        return
+    with reload_lock:
+        if now < next_reload_check:
+            return
+        next_reload_check = now + COST_DB_RELOAD_INTERVAL
+        try:
+            load_price_index()
+        except Exception as e:
+            # Keep serving the last good index if the file is mid-write or malformed
+            print(f'Failed to reload cost db {COST_DB_PATH}: {e}')
+
+
+def get_token_prices(model, region):
+    """
+    Look up the (input, output) price per token for a model in a region.
+
+    Args:
+        model (str): The Bedrock model id.
+        region (str): The region the request was routed to.
+
+    Returns:
+        tuple: Input and output price per token in picodollars. Falls back to the model's region-less price.
+    """
+    reload_price_index_if_changed()
+    prices = price_index.get((model, region)) or price_index.get((model, None))
+    if prices is None:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"No pricing configured for model {model} in region {region}"
+        )
+    return prices
+
+
+def units_to_dollars(cost_units):
+    return decimal.Decimal(cost_units) / COST_SCALE
+
+
+load_price_index()
+next_reload_check = time.monotonic() + COST_DB_RELOAD_INTERVAL
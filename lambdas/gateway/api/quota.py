@@ -1,68 +1,64 @@
 from fastapi import HTTPException, status
-import datetime
 import os
-from cachetools import TTLCache
-import boto3
 from boto3.dynamodb.conditions import Key
 import json
-import pandas as pd
 from botocore.exceptions import ClientError
 import decimal
 from datetime import datetime, timezone, date, timedelta
 from api.request_details import create_request_detail
-from api.clients import get_dynamo_db_client
+from api.cache import AsyncCache
+from api.clients import get_dynamo_db_low_level_client, get_async_client, get_async_dynamo_db_resource
+from api.pricing import get_token_prices, units_to_dollars
+from api.quota_journal import QuotaJournal
+from api.usage_accumulator import UsageAccumulator
+from concurrent.futures import ThreadPoolExecutor
+import random
 import threading
+import time
 
 DEFAULT_QUOTA_PARAMETER_NAME = os.environ.get("DEFAULT_QUOTA_PARAMETER_NAME")
 QUOTA_TABLE_NAME = os.environ.get("QUOTA_TABLE_NAME")
 REGION = os.environ.get("REGION")
-
-ssm_client = boto3.client("ssm")
-dynamodb = get_dynamo_db_client()
-quota_table = dynamodb.Table(QUOTA_TABLE_NAME)
-
-cache = TTLCache(maxsize=10000, ttl=1200)
-default_quota_cache = TTLCache(maxsize=1, ttl=1200)
-quota_usage_cache = TTLCache(maxsize=10000, ttl=1200)
-
-cost_df = pd.read_csv('/app/api/data/cost_db.csv', dtype={'cost_per_token_input': float, 'cost_per_token_output': float})
-#print(f'cost_df: {cost_df}')
-
-def check_quota(user_name, api_key_name, model_id):
+QUOTA_FLUSH_CONCURRENCY = int(os.environ.get("QUOTA_FLUSH_CONCURRENCY", "16"))
+QUOTA_FLUSH_MAX_ATTEMPTS = int(os.environ.get("QUOTA_FLUSH_MAX_ATTEMPTS", "5"))
+QUOTA_FLUSH_BACKOFF_SECONDS = float(os.environ.get("QUOTA_FLUSH_BACKOFF_SECONDS", "0.2"))
+# Optional directory for the local journal of unflushed quota spend, replayed on startup
+QUOTA_JOURNAL_DIR = os.environ.get("QUOTA_JOURNAL_DIR")
+# Number of lock stripes the local usage accumulator is split over
+QUOTA_LOCK_STRIPES = int(os.environ.get("QUOTA_LOCK_STRIPES", "64"))
+QUOTA_USAGE_CACHE_TTL = 1200
+
+dynamodb_client = get_dynamo_db_low_level_client()
+
+cache = AsyncCache("quota_config", maxsize=10000, ttl=1200)
+default_quota_cache = AsyncCache("default_quota", maxsize=1, ttl=1200)
+# A missing requests_summary is not cached, check_quota creates it
+quota_usage_cache = AsyncCache("quota_usage", maxsize=10000, ttl=QUOTA_USAGE_CACHE_TTL)
+
+async def check_quota(user_name, api_key_name, model_id, estimated_cost=0):
+    """
+    Check the user's usage against their quota and reserve the estimated cost of the request.
+
+    Usage is the DynamoDB requests_summary baseline plus the spend this node has not flushed yet and the
+    reservations of requests still in flight, so concurrent requests cannot overshoot the limit while
+    the local spend is waiting for the next flush.
+
+    Returns:
+        The reserved cost, to be passed to release_quota_reservation once the request has been accounted.
+    """
     #print('Checking if user has exceeded usage quota')
-    quota_config = get_from_cache(user_name)
-
-    if not quota_config:
-        #print("No cached quota, getting user's quota config")
-        quota_config = get_user_quota_config(user_name)
-        
-        if not quota_config:
-            #print('No user specific config, getting default quota config')
-            quota_config = get_default_quota()
-            if quota_config:
-                pass
-                #print(f'Found default quota config: {quota_config}')
-            else:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Quota config not configured correctly"
-                )
-        else:
-            pass
-
-        add_to_cache(user_name, quota_config)
-    else:
-        pass
-        #print(f'quota config config cache hit')
+    quota_config = await cache.get(user_name, lambda: load_quota_config(user_name))
     
     #print(f'fetching requests_summary')
-    requests_summary = get_user_requests_summary(user_name)
+    requests_summary = await get_user_requests_summary(user_name)
     #print(f'requests_summary: {requests_summary}')
 
     if not requests_summary:
         #print(f"Didn't find requests_summary, creating new one")
-        new_requests_summary = build_new_requests_summary(user_name, quota_config)
-        #print(f"new_requests_summary: {new_requests_summary}")
-        create_requests_summary(new_requests_summary)
+        requests_summary = build_new_requests_summary(user_name, quota_config)
+        #print(f"new_requests_summary: {requests_summary}")
+        if await create_requests_summary(requests_summary):
+            add_to_quota_usage_cache(user_name, requests_summary)
     else:
         quota_limit_map = requests_summary.get('quota_limit_map', None)
         #print(f'quota_limit_map: {quota_limit_map}')
@@ -75,20 +71,37 @@ def check_quota(user_name, api_key_name, model_id):
                     "total_estimate_cost": decimal.Decimal(str(0.00))
                 }
                 request_summary_needs_update = True
-            else:
-                if float(quota_limit_map[frequency]["total_estimate_cost"]) > float(limit):
-                    print(f'Quota exceeded. Quota frequency: {frequency}. Total usage: {quota_limit_map[frequency]["total_estimate_cost"]}. Limit: {limit}')
-                    create_request_detail(user_name, api_key_name, None, None, None, model_id, "Quota Exceeded")
-                    raise HTTPException(
-                        status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=f"Quota exceeded. Quota frequency: {frequency}. Total usage: {format_two_significant_figures(quota_limit_map[frequency]["total_estimate_cost"])}. Limit: {limit}"
-                    )
         if request_summary_needs_update:
             #print(f'request summary needs update, updating...')
-            update_requests_summary(requests_summary, quota_config, user_name)
+            await update_requests_summary(requests_summary, quota_config, user_name)
+
+    local_usage = get_local_usage(user_name)
+    quota_limit_map = requests_summary['quota_limit_map']
+    for frequency, limit in quota_config.items():
+        total_usage = quota_limit_map[frequency]["total_estimate_cost"] + local_usage
+        if total_usage > decimal.Decimal(str(limit)):
+            print(f'Quota exceeded. Quota frequency: {frequency}. Total usage: {total_usage}. Limit: {limit}')
+            await create_request_detail(user_name, api_key_name, None, None, None, model_id, "Quota Exceeded")
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=f"Quota exceeded. Quota frequency: {frequency}. Total usage: {format_two_significant_figures(total_usage)}. Limit: {limit}"
+            )
 
     #print(f'Quota is not exceeded. Processing request.')
-    return requests_summary
+    return reserve_quota(user_name, estimated_cost)
+
 
+async def load_quota_config(user_name):
+    #print("No cached quota, getting user's quota config")
+    quota_config = await get_user_quota_config(user_name)
+
+    if not quota_config:
+        #print('No user specific config, getting default quota config')
+        quota_config = await get_default_quota()
+        if not quota_config:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Quota config not configured correctly"
+            )
+    return quota_config
 
 def format_two_significant_figures(num_str):
     num = float(num_str)
@@ -112,28 +125,34 @@ def build_new_requests_summary(user_name, quota_config):
     except Exception as e:
         print(f'Failed to build new requests summary with error {e}')
 
-def create_requests_summary(requests_summary):
+async def create_requests_summary(requests_summary):
+    flushed = get_flushed_usage(requests_summary["username"])
     try:
-        response = quota_table.put_item(
+        async_quota_table = await get_async_quota_table()
+        await async_quota_table.put_item(
             Item=requests_summary,
             ConditionExpression='attribute_not_exists(username) AND attribute_not_exists(document_type_id)'
         )
         #print("Item created successfully:", response)
+        reset_flushed_usage(requests_summary["username"], flushed)
+        return True
     except ClientError as e:
         if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
             print("Item already exists. Continuing...")
+            return False
         else:
             raise
 
 def get_current_timestamp():
     return datetime.now(timezone.utc).isoformat()
 
-def update_requests_summary(requests_summary, quota_config, user_name):
+async def update_requests_summary(requests_summary, quota_config, user_name):
     last_known_update_time = requests_summary["last_updated_time"]
     requests_summary["last_updated_time"] = get_current_timestamp()
     try:
         # Perform the put operation
-        response = quota_table.put_item(
+        async_quota_table = await get_async_quota_table()
+        await async_quota_table.put_item(
             Item=requests_summary,
             ConditionExpression="last_updated_time = :last_known_time",
             ExpressionAttributeValues={
@@ -144,7 +163,7 @@ def update_requests_summary(requests_summary, quota_config, user_name):
     except ClientError as e:
         if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
             print("Upload failed: Last updated time has changed since last read. Reading the latest document and seeing if it still needs updating")
-            latest_requests_summary = get_user_requests_summary(user_name)
+            latest_requests_summary = await get_user_requests_summary(user_name)
             quota_limit_map = latest_requests_summary.get('quota_limit_map')
 
             request_summary_needs_update = False
@@ -157,7 +176,7 @@ def update_requests_summary(requests_summary, quota_config, user_name):
                     }
                     request_summary_needs_update = True
             if request_summary_needs_update:
-                update_requests_summary(latest_requests_summary)
+                await update_requests_summary(latest_requests_summary, quota_config, user_name)
         else:
             raise
 
@@ -172,23 +191,32 @@ def get_current_time_period(frequency):
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Quota Configuration has unsupported frequency type"
                 )
 
-def get_user_quota_config(user_name):
-    quota_config_document = get_user_document(user_name, "quota_config")
+async def get_user_quota_config(user_name):
+    quota_config_document = await get_user_document(user_name, "quota_config")
     if quota_config_document:
         return quota_config_document.get('quota_map', None)
 
-def get_user_requests_summary(user_name):
-    requests_summary = get_from_quota_usage_cache(user_name)
-    if not requests_summary:
-        requests_summary = get_user_document(user_name, "requests_summary")
-        add_to_quota_usage_cache(user_name, requests_summary)
+async def get_user_requests_summary(user_name):
+    return await quota_usage_cache.get(user_name, lambda: load_user_requests_summary(user_name))
+
+async def load_user_requests_summary(user_name):
+    # The fresh baseline includes everything this node flushed before the read. A flush finishing during the read
+    # may not be in it, so it stays counted locally.
+    flushed = get_flushed_usage(user_name)
+    requests_summary = await get_user_document(user_name, "requests_summary")
+    reset_flushed_usage(user_name, flushed)
     return requests_summary
 
-def get_user_document(user_name, document_type):    
+async def get_async_quota_table():
+    async_dynamodb = await get_async_dynamo_db_resource()
+    return await async_dynamodb.Table(QUOTA_TABLE_NAME)
+
+async def get_user_document(user_name, document_type):    
     document_type_id = f'{document_type}:{user_name}'
     #print(f'username: {user_name} document_type_id: {document_type_id}')
 
-    response = quota_table.query(
+    async_quota_table = await get_async_quota_table()
+    response = await async_quota_table.query(
         KeyConditionExpression=Key('username').eq(user_name) & Key('document_type_id').eq(document_type_id)
     )
     # print(f'response: {response}')
@@ -200,116 +228,129 @@ def get_user_document(user_name, document_type):
     return response["Items"][0]
 
 
-def get_from_quota_usage_cache(key):
-    return quota_usage_cache.get(key, None)
-
 def add_to_quota_usage_cache(key, value):
-    quota_usage_cache[key] = value
+    quota_usage_cache.set(key, value)
 
-def add_to_cache(key, value):
-    cache[key] = value
+async def get_default_quota():
+    return await default_quota_cache.get("default", load_default_quota)
 
-def get_from_cache(key):
-    return cache.get(key, None)
+async def load_default_quota():
+    ssm_client = await get_async_client("ssm")
+    response = await ssm_client.get_parameter(Name=DEFAULT_QUOTA_PARAMETER_NAME, WithDecryption=True)
+    parameter_value = response['Parameter']['Value']
+    return json.loads(parameter_value)
 
-def get_default_quota():
-    default_quota_config_dict = default_quota_cache.get("default", None)
-    if default_quota_config_dict:
-        return default_quota_config_dict
+def calculate_input_cost(prompt_tokens, model, region):
+    input_price, _ = get_token_prices(model, region)
+    return units_to_dollars(prompt_tokens * input_price)
 
-    response = ssm_client.get_parameter(Name=DEFAULT_QUOTA_PARAMETER_NAME, WithDecryption=True)
-    parameter_value = response['Parameter']['Value']
-    default_quota_config_dict = json.loads(parameter_value)
-    default_quota_cache["default"] = default_quota_config_dict
-    return default_quota_config_dict
-
-def calculate_input_cost(prompt_tokens, model):
-    return calculate_cost(prompt_tokens, model, 'cost_per_token_input')
-
-def calculate_output_cost(completion_tokens, model):
-    return calculate_cost(completion_tokens, model, 'cost_per_token_output')
-
-def calculate_cost(num_tokens, model, cost_type):
-    # print(f'cost_df: {cost_df}')
-    # print(f'model: {model} region: {REGION} type: {cost_type}')
-    filtered_df = cost_df[
-        (cost_df['model_name'] == model) & 
-        ((cost_df['region'] == REGION) | (cost_df['region'].isna()))
-    ]
-    #print(f'filtered_df: {filtered_df}')
-    costs_per_token = filtered_df.iloc[0][cost_type]
-    return (num_tokens * costs_per_token) / 1000
+def calculate_output_cost(completion_tokens, model, region):
+    _, output_price = get_token_prices(model, region)
+    return units_to_dollars(completion_tokens * output_price)
 
 def update_quota_dynamo(user_name, total_cost):
     keys = {
-        'username': user_name,  # Partition Key
-        'document_type_id': f'requests_summary:{user_name}'    # Sort Key
+        'username': {'S': user_name},  # Partition Key
+        'document_type_id': {'S': f'requests_summary:{user_name}'}    # Sort Key
     }
 
-    try:
-        response = quota_table.update_item(
-            Key=keys,
-            UpdateExpression="""
-            ADD #qlm.#wk.#tec :inc""",
-                #qlm.#hr.#tec :inc,
-                #qlm.#dy.#tec :inc,
-                #qlm.#mn.#tec :inc
-            #""",
-            ExpressionAttributeNames={
-                "#qlm": "quota_limit_map",
-                #"#hr": "hourly",
-                #"#dy": "daily",
-                "#wk": "weekly",
-                #"#mn": "monthly",
-                "#tec": "total_estimate_cost"
-            },
-            ExpressionAttributeValues={
-                ":inc": decimal.Decimal(str(total_cost))
-            },
-            ReturnValues="UPDATED_NEW"
-        )
-        #print("Update succeeded:", response)
-    except Exception as e:
-        print("Error updating item:", e)
+    for attempt in range(QUOTA_FLUSH_MAX_ATTEMPTS):
+        try:
+            # The low level client is thread safe, unlike the Table resource
+            dynamodb_client.update_item(
+                TableName=QUOTA_TABLE_NAME,
+                Key=keys,
+                UpdateExpression="""
+                ADD #qlm.#wk.#tec :inc""",
+                    #qlm.#hr.#tec :inc,
+                    #qlm.#dy.#tec :inc,
+                    #qlm.#mn.#tec :inc
+                #""",
+                ExpressionAttributeNames={
+                    "#qlm": "quota_limit_map",
+                    #"#hr": "hourly",
+                    #"#dy": "daily",
+                    "#wk": "weekly",
+                    #"#mn": "monthly",
+                    "#tec": "total_estimate_cost"
+                },
+                ExpressionAttributeValues={
+                    ":inc": {'N': str(total_cost)}
+                },
+                ReturnValues="UPDATED_NEW"
+            )
+            #print("Update succeeded:", response)
+            return True
+        except Exception as e:
+            print(f"Error updating item for {user_name} (attempt {attempt + 1}/{QUOTA_FLUSH_MAX_ATTEMPTS}):", e)
+            if attempt + 1 < QUOTA_FLUSH_MAX_ATTEMPTS:
+                time.sleep(QUOTA_FLUSH_BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random()))
+    return False
+
+# Local spend and reservations per user, on top of the cached requests_summary baseline
+usage = UsageAccumulator(QUOTA_LOCK_STRIPES, QUOTA_USAGE_CACHE_TTL)
+
+# Prevents a scheduled flush and the shutdown flush from overlapping
+flush_lock = threading.Lock()
+
+quota_journal = QuotaJournal(QUOTA_JOURNAL_DIR) if QUOTA_JOURNAL_DIR else None
 
-# Shared dictionary for user data
-user_data = {}
+def write_quota_updates_to_dynamo():
+    with flush_lock:
+        # Swap the pending spend out, so requests keep accumulating while this flush runs
+        pending = usage.swap_pending(quota_journal.rotate if quota_journal else None)
+
+        if pending:
+            print(f'Flushing quota usage of {len(pending)} users')
+            with ThreadPoolExecutor(max_workers=QUOTA_FLUSH_CONCURRENCY) as executor:
+                results = executor.map(lambda username: flush_user(username, pending[username]), pending)
+                failed_count = sum(1 for result in results if not result)
+            if failed_count:
+                print(f'Failed to flush quota usage of {failed_count} users, keeping it for the next flush')
+
+        if quota_journal:
+            quota_journal.finish_flush()
+
+def flush_user(username, amount):
+    success = update_quota_dynamo(username, amount)
+    usage.finish_flush(username, amount, success, quota_journal)
+    if success and quota_journal:
+        quota_journal.mark_flushed(username, amount)
+    return success
+
+def replay_quota_journal():
+    """Add the unflushed spend left in journals of previous processes to the pending spend."""
+    if not quota_journal:
+        return
+    recovered = quota_journal.adopt_orphaned_journals()
+    for username, amount in recovered.items():
+        # Already recorded in this process' journal by adopt_orphaned_journals
+        usage.add_pending(username, amount)
+    if recovered:
+        print(f'Recovered unflushed quota usage of {len(recovered)} users from {QUOTA_JOURNAL_DIR}')
 
-# Dictionary to store locks for each user
-user_locks = {}
+def update_quota_local(username: str, increment: float):
+    usage.add_pending(username, increment, quota_journal)
 
-# Global lock to protect creation of new user-specific locks
-global_lock = threading.Lock()
+def get_local_usage(username):
+    return usage.total(username)
 
-# Helper function to get a lock for a user
-def get_lock_for_user(username):
-    if username not in user_locks:
-        # Acquire global lock to safely create a new user lock
-        with global_lock:
-            if username not in user_locks:  # Double-check after acquiring the lock
-                user_locks[username] = threading.Lock()
-    return user_locks[username]
+def get_flushed_usage(username):
+    return usage.get_flushed(username)
 
-# Background task to process each user
-def write_quota_updates_to_dynamo():
-    # Iterate through a copy of usernames to avoid runtime changes issues
-    usernames = list(user_data.keys())
-    for username in usernames:
-        user_lock = get_lock_for_user(username)
-        with user_lock:
-            if username in user_data:
-                # Process the user's data here
-                if user_data[username] == 0:
-                    continue
-                update_quota_dynamo(username, user_data[username])
-                # Reset the user's value to 0 after processing
-                user_data[username] = 0
+def reset_flushed_usage(username, amount):
+    usage.reset_flushed(username, amount)
 
+def reserve_quota(username, estimated_cost):
+    usage.add_reserved(username, estimated_cost)
+    return estimated_cost
 
-def update_quota_local(username: str, increment: float):
-    user_lock = get_lock_for_user(username)
-    with user_lock:
-        if username in user_data:
-            user_data[username] += increment
-        else:
-            user_data[username] = increment
+def release_quota_reservation(username, reserved_cost):
+    usage.add_reserved(username, -reserved_cost)
+
+async def release_quota_reservation_on_close(stream, username, reserved_cost):
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        release_quota_reservation(username, reserved_cost)
@@ -0,0 +1,120 @@
+import decimal
+import fcntl
+import glob
+import json
+import os
+import threading
+import uuid
+
+JOURNAL_SUFFIX = ".journal"
+FLUSHING_SUFFIX = ".flushing"
+
+
+class QuotaJournal:
+    """Append-only local journal of quota spend that has not been flushed to DynamoDB yet.
+
+    Every worker process writes its own journal file in the directory and holds an exclusive flock on it while
+    it is alive, so on startup a worker can safely adopt the journals left behind by processes that exited
+    without flushing. Each line is a JSON [username, amount] delta. Lines are flushed to the OS on write but not
+    fsynced, so the journal survives process crashes and restarts, not host failures.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, f"quota-{uuid.uuid4()}{JOURNAL_SUFFIX}")
+        self.flushing_path = None
+        self.file = self._open_locked(self.path)
+        self.flushing_file = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _open_locked(path):
+        f = open(path, "a", encoding="utf-8")
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f
+
+    @staticmethod
+    def _write_line(f, username, amount):
+        f.write(json.dumps([username, str(amount)]) + "\n")
+        f.flush()
+
+    def append(self, username, amount):
+        with self.lock:
+            self._write_line(self.file, username, amount)
+
+    def rotate(self):
+        """Move the current journal aside for a flush and start a new one. Call with the pending map swapped out."""
+        with self.lock:
+            self.flushing_path = self.path[:-len(JOURNAL_SUFFIX)] + FLUSHING_SUFFIX
+            os.rename(self.path, self.flushing_path)
+            # The renamed file keeps its handle and lock, so it can record which users made it to DynamoDB
+            self.flushing_file = self.file
+            self.file = self._open_locked(self.path)
+
+    def mark_flushed(self, username, amount):
+        """Cancel out a flushed amount, so a crash mid flush does not replay it."""
+        with self.lock:
+            self._write_line(self.flushing_file, username, -amount)
+
+    def requeue(self, username, amount):
+        """Move an amount that failed to flush from the flushing journal back to the current one."""
+        with self.lock:
+            # Appended before it is cancelled, so a crash in between can only over count
+            self._write_line(self.file, username, amount)
+            if self.flushing_file:
+                self._write_line(self.flushing_file, username, -amount)
+
+    def finish_flush(self):
+        with self.lock:
+            if self.flushing_file:
+                os.remove(self.flushing_path)
+                self.flushing_file.close()
+                self.flushing_file = None
+                self.flushing_path = None
+
+    def adopt_orphaned_journals(self):
+        """Move the unflushed spend of journals left by processes that are gone into this journal.
+
+        Returns:
+            dict: The net unflushed amount per username, to be added to the pending spend.
+        """
+        totals = {}
+        adopted = []
+        paths = glob.glob(os.path.join(self.directory, "quota-*" + JOURNAL_SUFFIX))
+        paths += glob.glob(os.path.join(self.directory, "quota-*" + FLUSHING_SUFFIX))
+        for path in paths:
+            if path in (self.path, self.flushing_path):
+                continue
+            try:
+                f = open(path, "r", encoding="utf-8")
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Still owned by a live worker
+                f.close()
+                continue
+            lines = f.readlines()
+            if not lines:
+                # Nothing to recover. This may also be a journal a starting worker has not locked yet.
+                f.close()
+                continue
+            for line in lines:
+                try:
+                    username, amount = json.loads(line)
+                    totals[username] = totals.get(username, 0) + decimal.Decimal(amount)
+                except (ValueError, TypeError, decimal.InvalidOperation):
+                    # Torn write from a crash, skip it
+                    continue
+            adopted.append((path, f))
+
+        totals = {username: amount for username, amount in totals.items() if amount != 0}
+        # Record the spend in this journal before dropping the old files, so a crash here can only over count
+        for username, amount in totals.items():
+            self.append(username, amount)
+        for path, f in adopted:
+            os.remove(path)
+            f.close()
+        return totals
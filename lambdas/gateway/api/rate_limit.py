@@ -0,0 +1,169 @@
+import json
+import math
+import os
+import time
+from boto3.dynamodb.conditions import Key
+from fastapi import HTTPException, status
+from api.cache import AsyncCache
+from api.clients import get_async_dynamo_db_resource
+from api.request_details import create_request_detail
+
+QUOTA_TABLE_NAME = os.environ.get("QUOTA_TABLE_NAME")
+# Limits for users without a rate_limit_config document, in the same shape as its rate_limit_map, e.g.
+# {"user": {"requests_per_minute": 600, "tokens_per_minute": 400000}, "api_key": {...}, "model": {...}}
+DEFAULT_RATE_LIMITS = json.loads(os.environ.get("DEFAULT_RATE_LIMITS", "{}"))
+# How often buckets that refilled completely are dropped
+RATE_LIMIT_PRUNE_INTERVAL = 60
+
+# Limit scopes of a rate_limit_map. "api_key" applies to each key of the user, "model" to each model the user calls.
+SCOPES = ("user", "api_key", "model")
+REQUESTS = "requests"
+TOKENS = "tokens"
+
+rate_limit_config_cache = AsyncCache("rate_limit_config", maxsize=10000, ttl=1200)
+
+# (scope, identity, REQUESTS or TOKENS) -> TokenBucket
+buckets = {}
+next_prune = 0.0
+
+
+class TokenBucket:
+    """A bucket holding up to one minute of allowance and refilling continuously.
+
+    Request buckets are charged when a request is admitted. Token usage is only known once the model responded,
+    so token buckets are charged afterwards and may go into debt, which blocks the caller until it is repaid.
+    """
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, limit_per_minute, now):
+        self.capacity = limit_per_minute
+        self.rate = limit_per_minute / 60
+        self.tokens = limit_per_minute
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def seconds_until(self, amount):
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+
+def get_bucket(key, limit_per_minute, now):
+    bucket = buckets.get(key)
+    if bucket is None or bucket.capacity != limit_per_minute:
+        bucket = buckets[key] = TokenBucket(limit_per_minute, now)
+    else:
+        bucket.refill(now)
+    return bucket
+
+
+def prune_buckets(now):
+    global next_prune
+    next_prune = now + RATE_LIMIT_PRUNE_INTERVAL
+    for key, bucket in list(buckets.items()):
+        # A full bucket is indistinguishable from a new one
+        if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity:
+            del buckets[key]
+
+
+def get_scope_limits(config, user_name, api_key_name, model_id):
+    identities = {"user": user_name, "api_key": f"{user_name}:{api_key_name}" if api_key_name else None, "model": f"{user_name}:{model_id}"}
+    for scope in SCOPES:
+        limits = config.get(scope)
+        if limits and identities[scope]:
+            yield scope, identities[scope], limits
+
+
+async def check_rate_limit(user_name, api_key_name, model_id):
+    """
+    Admit a request against the requests and tokens per minute limits of the user, API key and model.
+
+    Returns:
+        dict: x-ratelimit-* headers describing the most constrained request and token buckets.
+
+    Raises:
+        HTTPException: 429 with Retry-After and x-ratelimit-* headers if a limit is exhausted.
+    """
+    config = await get_rate_limit_config(user_name)
+    if not config:
+        return {}
+
+    now = time.monotonic()
+    if now >= next_prune:
+        prune_buckets(now)
+
+    request_buckets = []
+    token_buckets = []
+    for scope, identity, limits in get_scope_limits(config, user_name, api_key_name, model_id):
+        if limits.get("requests_per_minute"):
+            request_buckets.append((scope, get_bucket((scope, identity, REQUESTS), float(limits["requests_per_minute"]), now)))
+        if limits.get("tokens_per_minute"):
+            token_buckets.append((scope, get_bucket((scope, identity, TOKENS), float(limits["tokens_per_minute"]), now)))
+
+    # Check every bucket before charging any, so a denied request costs nothing
+    retry_after = 0.0
+    exceeded_scope = None
+    for scope, bucket in request_buckets:
+        wait = bucket.seconds_until(1)
+        if wait > retry_after:
+            retry_after, exceeded_scope = wait, f"{scope} requests per minute"
+    for scope, bucket in token_buckets:
+        wait = bucket.seconds_until(0)
+        if wait > retry_after:
+            retry_after, exceeded_scope = wait, f"{scope} tokens per minute"
+
+    if exceeded_scope:
+        headers = build_rate_limit_headers(request_buckets, token_buckets)
+        headers["Retry-After"] = str(math.ceil(retry_after))
+        await create_request_detail(user_name, api_key_name, None, None, None, model_id, "Rate Limit Exceeded")
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=f"Rate limit exceeded: {exceeded_scope}", headers=headers
+        )
+
+    for _, bucket in request_buckets:
+        bucket.tokens -= 1
+    return build_rate_limit_headers(request_buckets, token_buckets)
+
+
+def record_token_usage(user_name, api_key_name, model_id, total_tokens):
+    """Charge the tokens a request used to its token buckets, once the usage is known."""
+    if not total_tokens:
+        return
+    # The config was loaded by check_rate_limit when the request was admitted
+    config = rate_limit_config_cache.peek(user_name)
+    if not config:
+        return
+    now = time.monotonic()
+    for scope, identity, limits in get_scope_limits(config, user_name, api_key_name, model_id):
+        if limits.get("tokens_per_minute"):
+            get_bucket((scope, identity, TOKENS), float(limits["tokens_per_minute"]), now).tokens -= total_tokens
+
+
+def build_rate_limit_headers(request_buckets, token_buckets):
+    headers = {}
+    for kind, scoped_buckets in ((REQUESTS, request_buckets), (TOKENS, token_buckets)):
+        if not scoped_buckets:
+            continue
+        # Report the bucket closest to running out
+        _, bucket = min(scoped_buckets, key=lambda scoped_bucket: scoped_bucket[1].tokens / scoped_bucket[1].capacity)
+        headers[f"x-ratelimit-limit-{kind}"] = str(int(bucket.capacity))
+        headers[f"x-ratelimit-remaining-{kind}"] = str(max(0, int(bucket.tokens)))
+        headers[f"x-ratelimit-reset-{kind}"] = f"{bucket.seconds_until(bucket.capacity):.3f}s"
+    return headers
+
+
+async def get_rate_limit_config(user_name):
+    return await rate_limit_config_cache.get(user_name, lambda: load_rate_limit_config(user_name))
+
+
+async def load_rate_limit_config(user_name):
+    dynamodb = await get_async_dynamo_db_resource()
+    quota_table = await dynamodb.Table(QUOTA_TABLE_NAME)
+    document_type_id = f'rate_limit_config:{user_name}'
+    response = await quota_table.query(
+        KeyConditionExpression=Key('username').eq(user_name) & Key('document_type_id').eq(document_type_id)
+    )
+    if response["Items"]:
+        return response["Items"][0].get("rate_limit_map", {})
+    return DEFAULT_RATE_LIMITS
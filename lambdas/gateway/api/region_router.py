@@ -0,0 +1,253 @@
+import asyncio
+import math
+import os
+import random
+import time
+from collections import deque
+from botocore.exceptions import BotoCoreError, ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+from api.metrics import increment, register_collector
+from api.model_enabled import get_model_regions_map
+
+# Weight of the latest sample in the moving averages of latency and error rate
+REGION_STATS_ALPHA = float(os.environ.get("REGION_STATS_ALPHA", "0.2"))
+# A throttled region is only tried after the others for this long, doubling on every further throttle up to the maximum
+REGION_THROTTLE_COOLDOWN_SECONDS = float(os.environ.get("REGION_THROTTLE_COOLDOWN_SECONDS", "1"))
+REGION_THROTTLE_MAX_COOLDOWN_SECONDS = float(os.environ.get("REGION_THROTTLE_MAX_COOLDOWN_SECONDS", "30"))
+# Floor for latencies in the region score, so one very fast sample does not take all the traffic
+REGION_MIN_LATENCY_SECONDS = 0.05
+# The circuit of a region and model opens when at least CIRCUIT_ERROR_RATE of the calls in a window of
+# CIRCUIT_WINDOW_SECONDS failed, given CIRCUIT_MIN_CALLS calls. Calls then skip the region for CIRCUIT_OPEN_SECONDS,
+# after which a single probe call decides whether it closes again. Throttles do not count, they have their cooldown,
+# and neither do errors that say nothing about the region, e.g. AccessDeniedException or ResourceNotFoundException.
+CIRCUIT_ERROR_RATE = float(os.environ.get("CIRCUIT_ERROR_RATE", "0.5"))
+CIRCUIT_MIN_CALLS = int(os.environ.get("CIRCUIT_MIN_CALLS", "5"))
+CIRCUIT_WINDOW_SECONDS = float(os.environ.get("CIRCUIT_WINDOW_SECONDS", "10"))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get("CIRCUIT_OPEN_SECONDS", "15"))
+# Response times of non-streaming calls kept per region and model for the hedging threshold
+RESPONSE_TIME_SAMPLES = 200
+
+# Bedrock error codes worth retrying in another region
+THROTTLING_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException"}
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {
+    "ServiceUnavailableException", "InternalServerException", "ModelNotReadyException", "ModelTimeoutException"
+}
+
+model_regions_map = get_model_regions_map()
+
+# (region, model_id) -> RegionStats
+region_stats = {}
+
+
+class RegionStats:
+    """Recent health of one model in one region.
+
+    latency is time to first token for streams and the full response time otherwise.
+    """
+    __slots__ = (
+        "latency", "error_rate", "throttled_until", "cooldown", "response_times",
+        "window_start", "window_calls", "window_failures", "circuit_open_until", "probe_started",
+    )
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.throttled_until = 0.0
+        self.cooldown = 0.0
+        self.response_times = deque(maxlen=RESPONSE_TIME_SAMPLES)
+        self.window_start = 0.0
+        self.window_calls = 0
+        self.window_failures = 0
+        # 0 while the circuit is closed
+        self.circuit_open_until = 0.0
+        self.probe_started = 0.0
+
+    def is_cooling_down(self, now):
+        return now < self.throttled_until or now < self.circuit_open_until
+
+    def is_circuit_open(self):
+        return self.circuit_open_until > 0
+
+    def count_call(self, failed, now):
+        if now - self.window_start > CIRCUIT_WINDOW_SECONDS:
+            self.window_start = now
+            self.window_calls = 0
+            self.window_failures = 0
+        self.window_calls += 1
+        self.window_failures += failed
+
+    def score(self, weight, default_latency):
+        latency = self.latency if self.latency is not None else default_latency
+        return weight * (1 - self.error_rate) / max(latency, REGION_MIN_LATENCY_SECONDS)
+
+
+def get_region_stats(region, model_id):
+    stats = region_stats.get((region, model_id))
+    if stats is None:
+        stats = region_stats[(region, model_id)] = RegionStats()
+    return stats
+
+
+def choose_regions(model_id):
+    """
+    Order the regions of a model for a call, best candidate first.
+
+    The first region is drawn at random in proportion to weight, success rate and speed, which spreads the load over
+    healthy regions. The remaining healthy regions follow by score, then regions still cooling down after a throttle.
+
+    Args:
+        model_id (str): The Bedrock model id.
+
+    Returns:
+        list: Regions to try in order.
+    """
+    regions = model_regions_map[model_id]
+    if len(regions) == 1:
+        return [regions[0][0]]
+
+    now = time.monotonic()
+    candidates = [(region, weight, get_region_stats(region, model_id)) for region, weight in regions]
+    known_latencies = [stats.latency for _, _, stats in candidates if stats.latency is not None]
+    # Regions without samples yet are scored like the fastest one, so they get tried
+    default_latency = min(known_latencies) if known_latencies else 1.0
+
+    healthy = []
+    cooling_down = []
+    for region, weight, stats in candidates:
+        if stats.is_cooling_down(now):
+            cooling_down.append((max(stats.throttled_until, stats.circuit_open_until), region))
+        else:
+            healthy.append((stats.score(weight, default_latency), region))
+
+    ordered = []
+    if healthy:
+        scores = [score for score, _ in healthy]
+        if sum(scores) > 0:
+            first = random.choices(range(len(healthy)), weights=scores)[0]
+        else:
+            first = random.randrange(len(healthy))
+        ordered.append(healthy.pop(first)[1])
+        ordered.extend(region for _, region in sorted(healthy, reverse=True))
+    ordered.extend(region for _, region in sorted(cooling_down))
+    return ordered
+
+
+def allow_call(region, model_id):
+    """
+    Check the circuit of a region and model before calling it.
+
+    Returns:
+        bool: True if the circuit is closed, or if it is open long enough that this call may probe the region.
+    """
+    stats = get_region_stats(region, model_id)
+    if not stats.is_circuit_open():
+        return True
+    now = time.monotonic()
+    # One probe at a time. A probe that never reported back, e.g. a cancelled hedge, is replaced after a while.
+    if now < stats.circuit_open_until or now - stats.probe_started < CIRCUIT_OPEN_SECONDS:
+        return False
+    stats.probe_started = now
+    return True
+
+
+def record_success(region, model_id, latency):
+    stats = get_region_stats(region, model_id)
+    stats.latency = latency if stats.latency is None else stats.latency + REGION_STATS_ALPHA * (latency - stats.latency)
+    stats.error_rate -= REGION_STATS_ALPHA * stats.error_rate
+    stats.cooldown = 0.0
+    stats.count_call(False, time.monotonic())
+    if stats.is_circuit_open():
+        stats.circuit_open_until = 0.0
+        print(f'Circuit of {model_id} in {region} closed')
+
+
+def record_response_time(region, model_id, seconds):
+    get_region_stats(region, model_id).response_times.append(seconds)
+
+
+def get_response_time_percentile(region, model_id, percentile, min_samples):
+    """
+    Returns:
+        float: The given percentile (0 to 1) of recent non-streaming response times, None with fewer than min_samples.
+    """
+    response_times = get_region_stats(region, model_id).response_times
+    if len(response_times) < min_samples:
+        return None
+    ordered = sorted(response_times)
+    return ordered[min(len(ordered) - 1, math.ceil(percentile * len(ordered)) - 1)]
+
+
+def record_failure(region, model_id, throttled):
+    stats = get_region_stats(region, model_id)
+    stats.error_rate += REGION_STATS_ALPHA * (1 - stats.error_rate)
+    now = time.monotonic()
+    if throttled:
+        stats.cooldown = min(REGION_THROTTLE_MAX_COOLDOWN_SECONDS, stats.cooldown * 2 or REGION_THROTTLE_COOLDOWN_SECONDS)
+        stats.throttled_until = now + stats.cooldown
+        increment("gateway_region_throttles_total", region=region, model=model_id)
+        return
+
+    increment("gateway_region_errors_total", region=region, model=model_id)
+    stats.count_call(True, now)
+    probe_failed = stats.is_circuit_open() and now >= stats.circuit_open_until
+    error_rate_tripped = (
+        stats.window_calls >= CIRCUIT_MIN_CALLS and stats.window_failures >= CIRCUIT_ERROR_RATE * stats.window_calls
+    )
+    if probe_failed or (error_rate_tripped and not stats.is_circuit_open()):
+        stats.circuit_open_until = now + CIRCUIT_OPEN_SECONDS
+        stats.window_start = now
+        stats.window_calls = 0
+        stats.window_failures = 0
+        increment("gateway_region_circuit_opened_total", region=region, model=model_id)
+        print(f'Circuit of {model_id} in {region} opened for {CIRCUIT_OPEN_SECONDS}s')
+
+
+def record_failover(region, model_id):
+    increment("gateway_region_failovers_total", region=region, model=model_id)
+
+
+def get_error_code(error):
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code")
+        # Errors inside a stream are named like their events, e.g. throttlingException
+        return code[:1].upper() + code[1:] if code else code
+    return None
+
+
+def is_throttling_error(error):
+    return get_error_code(error) in THROTTLING_ERROR_CODES
+
+
+def is_region_failure(error):
+    """
+    Returns:
+        bool: True for throttles, server errors, timeouts and connection failures, the errors that count against the
+            health of a region, False for errors of the request or the account, which any region would return.
+    """
+    if isinstance(error, ClientError):
+        if get_error_code(error) in RETRYABLE_ERROR_CODES:
+            return True
+        return error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+    return isinstance(error, (BotoConnectionError, HTTPClientError, asyncio.TimeoutError))
+
+
+def is_retryable_error(error):
+    if isinstance(error, ClientError):
+        return get_error_code(error) in RETRYABLE_ERROR_CODES
+    # Connection failures and timeouts
+    return isinstance(error, BotoCoreError)
+
+
+def collect_region_metrics():
+    now = time.monotonic()
+    for (region, model_id), stats in list(region_stats.items()):
+        labels = {"region": region, "model": model_id}
+        if stats.latency is not None:
+            yield "gateway_region_latency_seconds", "gauge", labels, stats.latency
+        yield "gateway_region_error_rate", "gauge", labels, stats.error_rate
+        yield "gateway_region_cooling_down", "gauge", labels, int(stats.is_cooling_down(now))
+        yield "gateway_region_circuit_open", "gauge", labels, int(stats.is_circuit_open())
+
+
+register_collector(collect_region_metrics)
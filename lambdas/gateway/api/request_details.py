@@ -1,23 +1,40 @@
+import asyncio
+import json
 import os
+import random
 import boto3
+from botocore.exceptions import ClientError
 from datetime import datetime, timezone
 import logging
 from api.setting import DEBUG
 import decimal
-from api.clients import get_dynamo_db_client
+from api.clients import get_async_dynamo_db_resource
 
 REQUEST_DETAILS_TABLE_NAME = os.environ.get("REQUEST_DETAILS_TABLE_NAME")
 STORE_REQUEST_DETAILS_IN_DYNAMO = os.environ.get("STORE_REQUEST_DETAILS_IN_DYNAMO").lower() == "true"
+# Items waiting for the background writer. When it is full, requests wait up to the enqueue timeout and then spill.
+REQUEST_DETAILS_QUEUE_SIZE = int(os.environ.get("REQUEST_DETAILS_QUEUE_SIZE", "10000"))
+REQUEST_DETAILS_ENQUEUE_TIMEOUT = float(os.environ.get("REQUEST_DETAILS_ENQUEUE_TIMEOUT", "0.05"))
+REQUEST_DETAILS_MAX_ATTEMPTS = int(os.environ.get("REQUEST_DETAILS_MAX_ATTEMPTS", "4"))
+REQUEST_DETAILS_BACKOFF_SECONDS = float(os.environ.get("REQUEST_DETAILS_BACKOFF_SECONDS", "0.1"))
+# Items DynamoDB could not take in time are appended here, and written again on startup and every retry interval
+REQUEST_DETAILS_SPILL_PATH = os.environ.get("REQUEST_DETAILS_SPILL_PATH", "/tmp/request_details_spill.jsonl")
+REQUEST_DETAILS_SPILL_RETRY_INTERVAL = float(os.environ.get("REQUEST_DETAILS_SPILL_RETRY_INTERVAL", "30"))
+REQUEST_DETAILS_SHUTDOWN_TIMEOUT = float(os.environ.get("REQUEST_DETAILS_SHUTDOWN_TIMEOUT", "10"))
+BATCH_WRITE_MAX_ITEMS = 25
+NUMERIC_FIELDS = ("estimated_cost", "input_tokens", "output_tokens")
 
 print(f'STORE_REQUEST_DETAILS_IN_DYNAMO: {STORE_REQUEST_DETAILS_IN_DYNAMO}')
-dynamodb = get_dynamo_db_client()
-table = dynamodb.Table(REQUEST_DETAILS_TABLE_NAME)
 logger = logging.getLogger(__name__)
 
+request_details_queue = None
+writer_task = None
+replay_task = None
+
 def get_current_timestamp():
     return datetime.now(timezone.utc).isoformat()
 
-def create_request_detail(username, api_key_name, estimated_cost, input_tokens, output_tokens, model_id, result):
+async def create_request_detail(username, api_key_name, estimated_cost, input_tokens, output_tokens, model_id, result):
     item = {
             'username': username,
             'timestamp': get_current_timestamp(),
@@ -34,18 +51,220 @@ def create_request_detail(username, api_key_name, estimated_cost, input_tokens,
     if output_tokens:
         item['output_tokens'] = decimal.Decimal(str(output_tokens))
 
-    log_item = item.copy()
-    if 'estimated_cost' in log_item:
-        log_item['estimated_cost'] = f"{float(log_item['estimated_cost']):.15f}"
-    if 'input_tokens' in log_item:
-        log_item['input_tokens'] = float(log_item['input_tokens'])
-    if 'output_tokens' in log_item:
-        log_item['output_tokens'] = float(log_item['output_tokens'])
+    # The log line is the only record when request details are not stored in DynamoDB
+    if DEBUG or not STORE_REQUEST_DETAILS_IN_DYNAMO:
+        log_item = item.copy()
+        if 'estimated_cost' in log_item:
+            log_item['estimated_cost'] = f"{float(log_item['estimated_cost']):.15f}"
+        if 'input_tokens' in log_item:
+            log_item['input_tokens'] = float(log_item['input_tokens'])
+        if 'output_tokens' in log_item:
+            log_item['output_tokens'] = float(log_item['output_tokens'])
 
-    print(log_item)
+        print(log_item)
 
     if STORE_REQUEST_DETAILS_IN_DYNAMO:
-        dynamo_response = table.put_item(
-                Item=item
-        )
-    #print("Item created successfully:", dynamo_response)
\ No newline at end of file
+        if writer_task is None or writer_task.done():
+            # No background writer on this loop, write it inline
+            table = await get_request_details_table()
+            await table.put_item(Item=item)
+            return
+        await enqueue_request_detail(item)
+
+async def enqueue_request_detail(item):
+    try:
+        request_details_queue.put_nowait(item)
+        return
+    except asyncio.QueueFull:
+        pass
+    try:
+        # Backpressure: hold the request briefly while the writer catches up
+        await asyncio.wait_for(request_details_queue.put(item), REQUEST_DETAILS_ENQUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        await spill_request_details([item])
+
+async def get_request_details_table():
+    dynamodb = await get_async_dynamo_db_resource()
+    return await dynamodb.Table(REQUEST_DETAILS_TABLE_NAME)
+
+async def start_request_details_writer():
+    global request_details_queue, writer_task, replay_task
+    if not STORE_REQUEST_DETAILS_IN_DYNAMO or writer_task is not None:
+        return
+    request_details_queue = asyncio.Queue(maxsize=REQUEST_DETAILS_QUEUE_SIZE)
+    writer_task = asyncio.create_task(write_request_details())
+    replay_task = asyncio.create_task(replay_spilled_request_details_periodically())
+
+async def stop_request_details_writer():
+    """Give the writer a bounded amount of time to drain the queue, then spill whatever is left."""
+    global request_details_queue, writer_task, replay_task
+    if writer_task is None:
+        return
+    replay_task.cancel()
+    try:
+        await replay_task
+    except asyncio.CancelledError:
+        pass
+    replay_task = None
+    try:
+        await asyncio.wait_for(request_details_queue.join(), REQUEST_DETAILS_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f'Request details writer did not drain within {REQUEST_DETAILS_SHUTDOWN_TIMEOUT}s, spilling the rest')
+    writer_task.cancel()
+    try:
+        await writer_task
+    except asyncio.CancelledError:
+        pass
+    remaining = []
+    while not request_details_queue.empty():
+        remaining.append(request_details_queue.get_nowait())
+    if remaining:
+        await spill_request_details(remaining)
+    writer_task = None
+    request_details_queue = None
+
+async def write_request_details():
+    """Background task writing queued request details with BatchWriteItem, up to 25 items per call."""
+    while True:
+        first_item = await request_details_queue.get()
+        batch = [first_item]
+        while len(batch) < BATCH_WRITE_MAX_ITEMS and not request_details_queue.empty():
+            batch.append(request_details_queue.get_nowait())
+        try:
+            await batch_write_request_details(batch)
+        except asyncio.CancelledError:
+            await spill_request_details(batch)
+            raise
+        except Exception as e:
+            print(f'Failed to write {len(batch)} request details: {e}')
+            await spill_request_details(batch)
+        finally:
+            for _ in batch:
+                request_details_queue.task_done()
+
+def split_unique_keys(items):
+    """
+    BatchWriteItem rejects a whole batch with two items of the same key, e.g. a spilled item replayed along with its
+    earlier copy.
+
+    Returns:
+        list: Groups of the items without a key twice, a later item of a key is in a later group.
+    """
+    groups = []
+    # key -> index of the last group holding it
+    key_groups = {}
+    for item in items:
+        key = (item['username'], item['timestamp'])
+        index = key_groups.get(key, -1) + 1
+        if index == len(groups):
+            groups.append([])
+        groups[index].append(item)
+        key_groups[key] = index
+    return groups
+
+async def batch_write_request_details(items):
+    """
+    Write up to 25 items, retrying unprocessed items with backoff.
+
+    Items still unprocessed after the last attempt are spilled to the local file.
+    """
+    for group in split_unique_keys(items):
+        try:
+            await batch_write_unique_request_details(group)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ValidationException':
+                raise
+            # One invalid item fails the whole batch, write them one by one so only that one is lost
+            print(f'BatchWriteItem rejected {len(group)} request details, writing them one by one: {e}')
+            await put_request_details(group)
+
+async def put_request_details(items):
+    table = await get_request_details_table()
+    for item in items:
+        try:
+            await table.put_item(Item=item)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ValidationException':
+                raise
+            # Spilling it would only fail the same way on every replay
+            print(f'Dropping invalid request detail {item}: {e}')
+
+async def batch_write_unique_request_details(items):
+    table = await get_request_details_table()
+    request_items = {REQUEST_DETAILS_TABLE_NAME: [{'PutRequest': {'Item': item}} for item in items]}
+    for attempt in range(REQUEST_DETAILS_MAX_ATTEMPTS):
+        # The resource's client takes and returns plain Python values
+        response = await table.meta.client.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems')
+        if not request_items:
+            return
+        if attempt + 1 < REQUEST_DETAILS_MAX_ATTEMPTS:
+            await asyncio.sleep(REQUEST_DETAILS_BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random()))
+
+    unprocessed = [request['PutRequest']['Item'] for request in request_items.get(REQUEST_DETAILS_TABLE_NAME, [])]
+    print(f'DynamoDB left {len(unprocessed)} request details unprocessed, spilling them')
+    await spill_request_details(unprocessed)
+
+async def spill_request_details(items):
+    await asyncio.to_thread(append_spilled_request_details, items)
+
+def append_spilled_request_details(items):
+    try:
+        with open(REQUEST_DETAILS_SPILL_PATH, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(item, default=str) + "\n" for item in items))
+    except Exception as e:
+        print(f'Failed to spill {len(items)} request details to {REQUEST_DETAILS_SPILL_PATH}: {e}')
+
+def take_spilled_request_details():
+    """
+    Returns:
+        list: The spilled items, removed from the spill file, None if there is no spill file.
+    """
+    replay_path = REQUEST_DETAILS_SPILL_PATH + ".replaying"
+    try:
+        # Take the whole file, new spills go to a fresh one. Only one worker process wins the rename.
+        os.rename(REQUEST_DETAILS_SPILL_PATH, replay_path)
+    except FileNotFoundError:
+        return None
+
+    items = []
+    with open(replay_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                # Torn write, skip it
+                continue
+            for field in NUMERIC_FIELDS:
+                if field in item:
+                    item[field] = decimal.Decimal(item[field])
+            items.append(item)
+    os.remove(replay_path)
+    return items
+
+async def replay_spilled_request_details_periodically():
+    """Retry what was spilled while DynamoDB was slow, left by a previous process too, whether or not the queue is busy."""
+    while True:
+        try:
+            await replay_spilled_request_details()
+        except Exception as e:
+            print(f'Failed to replay spilled request details: {e}')
+        await asyncio.sleep(REQUEST_DETAILS_SPILL_RETRY_INTERVAL)
+
+async def replay_spilled_request_details():
+    # The spill file can be large, read it off the event loop
+    items = await asyncio.to_thread(take_spilled_request_details)
+    if items is None:
+        return
+
+    print(f'Writing {len(items)} spilled request details')
+    for i in range(0, len(items), BATCH_WRITE_MAX_ITEMS):
+        batch = items[i:i + BATCH_WRITE_MAX_ITEMS]
+        try:
+            await batch_write_request_details(batch)
+        except asyncio.CancelledError:
+            await spill_request_details(items[i:])
+            raise
+        except Exception as e:
+            print(f'Failed to write {len(batch)} spilled request details: {e}')
+            await spill_request_details(batch)
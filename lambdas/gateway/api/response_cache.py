@@ -0,0 +1,234 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+from cachetools import TTLCache
+from api.disk_cache import DiskCache
+from api.metrics import register_collector
+
+# Opt-in cache of Bedrock responses to deterministic (temperature 0) chat requests, by the Converse request args,
+# and of embeddings, by text
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "false").lower() == "true"
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+# "user" keeps each user's cached responses to that user, "shared" lets identical requests of all users share them
+RESPONSE_CACHE_SCOPE = os.environ.get("RESPONSE_CACHE_SCOPE", "user")
+# Optional SQLite file backing the in-memory cache, shared by the workers on the host and kept across restarts
+RESPONSE_CACHE_DISK_PATH = os.environ.get("RESPONSE_CACHE_DISK_PATH")
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# cache key -> JSON encoded response, least recently used entries are evicted beyond the byte budget
+response_cache = TTLCache(maxsize=RESPONSE_CACHE_MAX_BYTES, ttl=RESPONSE_CACHE_TTL, getsizeof=len)
+response_cache_stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+disk_cache = (
+    DiskCache(RESPONSE_CACHE_DISK_PATH, RESPONSE_CACHE_DISK_MAX_BYTES, RESPONSE_CACHE_TTL)
+    if RESPONSE_CACHE and RESPONSE_CACHE_DISK_PATH else None
+)
+
+
+def _encode_value(value):
+    # Image bytes in the messages
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    raise TypeError(f"Cannot encode {type(value).__name__} in a cache key")
+
+
+def get_request_hash(kind, user_name, request):
+    """
+    Returns:
+        str: A hash of the kind and canonical JSON of a request, including the user unless RESPONSE_CACHE_SCOPE is shared.
+    """
+    scope = user_name if RESPONSE_CACHE_SCOPE == "user" else ""
+    canonical = json.dumps([kind, scope, request], sort_keys=True, separators=(",", ":"), default=_encode_value)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_response_cache_key(chat_request, args, user_name):
+    """
+    Returns:
+        str: The cache key of a chat request, or None if its response is not cacheable.
+    """
+    if not RESPONSE_CACHE or chat_request.temperature != 0:
+        return None
+    return get_request_hash("chat", user_name, args)
+
+
+def get_embedding_cache_keys(model_id, input_type, texts, user_name):
+    """
+    Returns:
+        list: The cache key of the embedding of each text, or None if caching is disabled.
+    """
+    if not RESPONSE_CACHE:
+        return None
+    return [get_request_hash("embedding", user_name, [model_id, input_type, text]) for text in texts]
+
+
+async def get_cached_value(cache_key):
+    """
+    Look a key up in memory, then on disk.
+
+    Returns:
+        bytes: The cached value, None on a miss.
+    """
+    if cache_key is None:
+        return None
+    encoded = response_cache.get(cache_key)
+    if encoded is not None:
+        response_cache_stats["hits"] += 1
+        return encoded
+    if disk_cache is not None:
+        encoded = await asyncio.to_thread(disk_cache.get, cache_key)
+        if encoded is not None:
+            response_cache_stats["disk_hits"] += 1
+            if len(encoded) <= RESPONSE_CACHE_MAX_BYTES:
+                response_cache[cache_key] = encoded
+            return encoded
+    response_cache_stats["misses"] += 1
+    return None
+
+
+async def get_cached_values(cache_keys):
+    """
+    Look keys up in memory, then the ones missing there on disk, in one batch.
+
+    Returns:
+        list: The cached value of each key, None where it is missing.
+    """
+    values = [response_cache.get(cache_key) for cache_key in cache_keys]
+    missing = [index for index, value in enumerate(values) if value is None]
+    response_cache_stats["hits"] += len(values) - len(missing)
+    if missing and disk_cache is not None:
+        disk_values = await asyncio.to_thread(disk_cache.get_many, [cache_keys[index] for index in missing])
+        for index, encoded in zip(missing, disk_values):
+            if encoded is not None:
+                values[index] = encoded
+                response_cache_stats["disk_hits"] += 1
+                if len(encoded) <= RESPONSE_CACHE_MAX_BYTES:
+                    response_cache[cache_keys[index]] = encoded
+    response_cache_stats["misses"] += sum(value is None for value in values)
+    return values
+
+
+def store_values(items):
+    """Store (cache key, value) pairs in memory, and on disk in one background write."""
+    for cache_key, encoded in items:
+        if len(encoded) <= RESPONSE_CACHE_MAX_BYTES:
+            response_cache[cache_key] = encoded
+    if disk_cache is not None and items:
+        asyncio.get_running_loop().run_in_executor(None, disk_cache.set_many, items)
+    response_cache_stats["stores"] += len(items)
+
+
+def store_value(cache_key, encoded):
+    if cache_key is None:
+        return
+    if len(encoded) <= RESPONSE_CACHE_MAX_BYTES:
+        response_cache[cache_key] = encoded
+    if disk_cache is not None:
+        # Written in the background, the response does not wait for the disk
+        asyncio.get_running_loop().run_in_executor(None, disk_cache.set, cache_key, encoded)
+    response_cache_stats["stores"] += 1
+
+
+async def get_cached_response(cache_key):
+    """
+    Returns:
+        dict: The cached Converse response with output, stopReason and usage, None on a miss.
+    """
+    encoded = await get_cached_value(cache_key)
+    return json.loads(encoded) if encoded is not None else None
+
+
+def store_response(cache_key, response):
+    if cache_key is None:
+        return
+    encoded = json.dumps(
+        {"output": response["output"], "stopReason": response["stopReason"], "usage": response["usage"]},
+        separators=(",", ":"),
+    ).encode("utf-8")
+    store_value(cache_key, encoded)
+
+
+def to_stream_events(response):
+    """Rebuild the ConverseStream events of a cached Converse response, one delta per content block."""
+    yield {"messageStart": {"role": response["output"]["message"]["role"]}}
+    for index, block in enumerate(response["output"]["message"]["content"]):
+        if "text" in block:
+            yield {"contentBlockDelta": {"delta": {"text": block["text"]}, "contentBlockIndex": index}}
+        elif "toolUse" in block:
+            tool_use = block["toolUse"]
+            yield {"contentBlockStart": {
+                "start": {"toolUse": {"toolUseId": tool_use["toolUseId"], "name": tool_use["name"]}},
+                "contentBlockIndex": index,
+            }}
+            yield {"contentBlockDelta": {"delta": {"toolUse": {"input": json.dumps(tool_use["input"])}}, "contentBlockIndex": index}}
+    yield {"messageStop": {"stopReason": response["stopReason"]}}
+    yield {"metadata": {"usage": response["usage"]}}
+
+
+class StreamResponseAssembler:
+    """Collects the events of a ConverseStream into the equivalent Converse response, so streams fill the cache."""
+
+    def __init__(self):
+        self.role = "assistant"
+        # contentBlockIndex -> content block, with text and tool input collected as lists of JSON text parts
+        self.blocks = {}
+        self.stop_reason = None
+        self.usage = None
+
+    def add(self, chunk):
+        if "messageStart" in chunk:
+            self.role = chunk["messageStart"]["role"]
+        elif "contentBlockStart" in chunk:
+            tool_use = chunk["contentBlockStart"]["start"].get("toolUse")
+            if tool_use:
+                self.blocks[chunk["contentBlockStart"]["contentBlockIndex"]] = {
+                    "toolUse": {"toolUseId": tool_use["toolUseId"], "name": tool_use["name"], "input": []}
+                }
+        elif "contentBlockDelta" in chunk:
+            index = chunk["contentBlockDelta"]["contentBlockIndex"]
+            delta = chunk["contentBlockDelta"]["delta"]
+            if "text" in delta:
+                self.blocks.setdefault(index, {"text": []})["text"].append(delta["text"])
+            elif "toolUse" in delta and index in self.blocks:
+                self.blocks[index]["toolUse"]["input"].append(delta["toolUse"]["input"])
+        elif "messageStop" in chunk:
+            self.stop_reason = chunk["messageStop"]["stopReason"]
+        elif "metadata" in chunk and "usage" in chunk["metadata"]:
+            self.usage = chunk["metadata"]["usage"]
+
+    def get_response(self):
+        """
+        Returns:
+            dict: The Converse response, None if the stream did not complete or its tool input is not valid JSON.
+        """
+        if self.stop_reason is None or self.usage is None:
+            return None
+        content = []
+        for index in sorted(self.blocks):
+            block = self.blocks[index]
+            if "toolUse" in block:
+                tool_use = block["toolUse"]
+                try:
+                    tool_input = json.loads("".join(tool_use["input"]) or "{}")
+                except ValueError:
+                    return None
+                content.append({"toolUse": {**tool_use, "input": tool_input}})
+            else:
+                content.append({"text": "".join(block["text"])})
+        return {
+            "output": {"message": {"role": self.role, "content": content}},
+            "stopReason": self.stop_reason,
+            "usage": self.usage,
+        }
+
+
+def collect_response_cache_metrics():
+    for stat, value in response_cache_stats.items():
+        yield f"gateway_response_cache_{stat}_total", "counter", {}, value
+    yield "gateway_response_cache_bytes", "gauge", {}, response_cache.currsize
+    yield "gateway_response_cache_entries", "gauge", {}, len(response_cache)
+
+
+register_collector(collect_response_cache_metrics)
@@ -1,15 +1,16 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, Body, HTTPException, Request, status
+from fastapi import APIRouter, Depends, Body, HTTPException, Request, Response, status
 from fastapi.responses import StreamingResponse
 
-from api.auth import api_key_auth, get_api_key_name
+from api.auth import api_key_auth
 from api.models.bedrock import BedrockModel
 from api.schema import ChatRequest, ChatResponse, ChatStreamResponse
 from api.setting import DEFAULT_MODEL
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from api.quota import check_quota
+from api.quota import check_quota, release_quota_reservation, release_quota_reservation_on_close
 from api.model_access import check_model_access
+from api.rate_limit import check_rate_limit
 from api.model_enabled import get_model_region_map
 
 router = APIRouter(
@@ -23,7 +24,7 @@ security = HTTPBearer()
 model_region_map = get_model_region_map()
 
 @router.post("/completions", response_model=ChatResponse | ChatStreamResponse, response_model_exclude_unset=True)
-def chat_completions(
+async def chat_completions(
         request: Request,
         chat_request: Annotated[
             ChatRequest,
@@ -39,36 +40,69 @@ def chat_completions(
                 ],
             ),
         ],
-        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]
+        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
+        response: Response
 ):
-    current_path = request.url.path
-    user_name, error_response =  api_key_auth(credentials, current_path)
+    principal, error_response = await api_key_auth(credentials)
     if error_response:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key or JWT Cognito Access Token"
         )
-
-    api_key_name = None
-    if credentials.credentials.startswith("sk-"):
-        api_key_name = get_api_key_name(credentials.credentials)
+    user_name = principal["username"]
+    api_key_name = principal["api_key_name"]
 
     if chat_request.model not in model_region_map:
         raise HTTPException(status_code=400, detail=str("Selected model is not enabled"))
 
-    check_model_access(user_name, api_key_name, chat_request.model)
-    check_quota(user_name, api_key_name, chat_request.model)
+    await check_model_access(user_name, api_key_name, chat_request.model)
 
     if chat_request.model.lower().startswith("gpt-"):
         chat_request.model = DEFAULT_MODEL
+
+    rate_limit_headers = await check_rate_limit(user_name, api_key_name, chat_request.model)
+    response.headers.update(rate_limit_headers)
         
     # Exception will be raised if model not supported.
     model = BedrockModel()
     model.validate(chat_request)
+    reserved_cost = await check_quota(user_name, api_key_name, chat_request.model, model.estimate_cost(chat_request))
     if chat_request.stream:
+        stream = release_quota_reservation_on_close(
+            model.chat_stream(chat_request, user_name, api_key_name), user_name, reserved_cost
+        )
         return StreamingResponse(
-            content=model.chat_stream(chat_request, user_name, api_key_name), media_type="text/event-stream"
+            content=await start_stream(stream),
+            media_type="text/event-stream",
+            headers=rate_limit_headers
         )
     try:
-        return model.chat(chat_request, user_name, api_key_name)
+        return await model.chat(chat_request, user_name, api_key_name)
     except Exception as e:
         print(f'exception: {e}')
+        raise
+    finally:
+        release_quota_reservation(user_name, reserved_cost)
+
+
+async def start_stream(stream):
+    """
+    Wait for the first chunk of a stream before the response starts.
+
+    Errors raised before any output, such as admission rejections, then become HTTP errors instead of a broken stream.
+
+    Returns:
+        AsyncIterable[bytes]: The whole stream, including the first chunk.
+    """
+    try:
+        first_chunk = await anext(stream)
+    except StopAsyncIteration:
+        return stream
+
+    async def resume():
+        try:
+            yield first_chunk
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+    return resume()
@@ -1,14 +1,15 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, Body, HTTPException, Request, status
+from fastapi import APIRouter, Depends, Body, HTTPException, Request, Response, status
 
-from api.auth import api_key_auth, get_api_key_name
-from api.models.bedrock import get_embeddings_model
+from api.auth import api_key_auth
+from api.models.bedrock import EMBEDDINGS_SLICE_SIZE, embeddings_slice, get_embeddings_model
 from api.schema import EmbeddingsRequest, EmbeddingsResponse
 from api.setting import DEFAULT_EMBEDDING_MODEL
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from api.model_access import check_model_access
-from api.quota import check_quota
+from api.rate_limit import check_rate_limit
+from api.quota import check_quota, release_quota_reservation
 from api.model_enabled import get_model_region_map
 
 router = APIRouter(
@@ -20,6 +21,18 @@ security = HTTPBearer()
 
 model_region_map = get_model_region_map()
 
+
+async def encode_embeddings_response(embeddings_response: EmbeddingsResponse) -> str:
+    """JSON encode a response in slices of embeddings_slice, like the rest of the embeddings path."""
+    data = embeddings_response.data
+    parts = []
+    for start in range(0, len(data), EMBEDDINGS_SLICE_SIZE):
+        async with embeddings_slice():
+            parts.append(",".join(embedding.model_dump_json() for embedding in data[start:start + EMBEDDINGS_SLICE_SIZE]))
+    rest = embeddings_response.model_dump_json(exclude={"data"})
+    return '{"data":[' + ",".join(parts) + "]," + rest[1:]
+
+
 @router.post("", response_model=EmbeddingsResponse)
 async def embeddings(
         request: Request,
@@ -36,26 +49,33 @@ async def embeddings(
                 ],
             ),
         ],
-        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]
+        credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
 ):
     if embeddings_request.model.lower().startswith("text-embedding-"):
         embeddings_request.model = DEFAULT_EMBEDDING_MODEL
-    current_path = request.url.path
 
-    user_name, error_response =  api_key_auth(credentials, current_path)
+    principal, error_response = await api_key_auth(credentials)
     if error_response:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key or JWT Cognito Access Token"
         )
-
-    if credentials.credentials.startswith("sk-"):
-        api_key_name = get_api_key_name(credentials.credentials)
+    user_name = principal["username"]
+    api_key_name = principal["api_key_name"]
 
     if embeddings_request.model not in model_region_map:
         raise HTTPException(status_code=400, detail=str("Selected model is not enabled"))
 
-    check_model_access(user_name, api_key_name, embeddings_request.model)
-    check_quota(user_name, api_key_name, embeddings_request.model)
+    await check_model_access(user_name, api_key_name, embeddings_request.model)
+    rate_limit_headers = await check_rate_limit(user_name, api_key_name, embeddings_request.model)
     # Exception will be raised if model not supported.
     model = get_embeddings_model(embeddings_request.model)
-    return model.embed(embeddings_request, user_name, api_key_name)
\ No newline at end of file
+    reserved_cost = await check_quota(user_name, api_key_name, embeddings_request.model, model.estimate_cost(embeddings_request))
+    try:
+        embeddings_response = await model.embed(embeddings_request, user_name, api_key_name)
+    finally:
+        release_quota_reservation(user_name, reserved_cost)
+    return Response(
+        content=await encode_embeddings_response(embeddings_response),
+        media_type="application/json",
+        headers=rate_limit_headers,
+    )
\ No newline at end of file
@@ -28,15 +28,13 @@ async def list_models(
         request: Request,
         credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]
     ):
-    current_path = request.url.path
-
-    user_name, error_response =  api_key_auth(credentials, current_path)
+    principal, error_response = await api_key_auth(credentials)
     if error_response:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key or JWT Cognito Access Token"
         )
 
-    allowed_model_list = get_allowed_model_list(user_name)
+    allowed_model_list = await get_allowed_model_list(principal["username"])
     supported_model_list = chat_model.list_models()
     available_model_list = list(set(allowed_model_list) & set(supported_model_list))
     model_list = [Model(id=model_id) for model_id in available_model_list]
@@ -55,9 +53,7 @@ async def get_model(
         ],
         credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]
 ):
-    current_path = request.url.path
-
-    user_name, error_response =  api_key_auth(credentials, current_path)
+    principal, error_response = await api_key_auth(credentials)
     if error_response:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key or JWT Cognito Access Token"
@@ -0,0 +1,202 @@
+import json
+import os
+import time
+from collections import OrderedDict
+import numpy as np
+from api.metrics import register_collector
+from api.response_cache import RESPONSE_CACHE_TTL, get_request_hash
+
+# Opt-in cache answering single turn chat requests whose user message is close enough in meaning to one answered
+# before with the same model and system prompt.
+SEMANTIC_CACHE = os.environ.get("SEMANTIC_CACHE", "false").lower() == "true"
+# Lowest cosine similarity of the user messages for a hit. A partition key is a hash, so SEMANTIC_CACHE_THRESHOLDS
+# overrides it per model id, the part of the key an operator can name.
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_THRESHOLDS = json.loads(os.environ.get("SEMANTIC_CACHE_THRESHOLDS", "{}"))
+# Budget for the embeddings and responses of a worker, least recently used entries are evicted beyond it. The
+# embeddings are charged by the rows allocated for them, not only the used ones.
+SEMANTIC_CACHE_MAX_BYTES = int(os.environ.get("SEMANTIC_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Every lookup is a billed embeddings call, skipped for messages longer than this, which rarely repeat
+SEMANTIC_CACHE_MAX_PROMPT_CHARS = int(os.environ.get("SEMANTIC_CACHE_MAX_PROMPT_CHARS", "2000"))
+# Rows allocated for a new partition, the matrix doubles whenever it is full and halves when a quarter full, so the
+# partitions of one-off system prompts stay small.
+INITIAL_PARTITION_ROWS = 1
+
+# partition key -> SemanticPartition
+partitions = {}
+# SemanticEntry -> None, least recently used first
+entries_lru = OrderedDict()
+# SemanticEntry -> None, oldest first, so expired entries are purged without scanning
+entries_by_age = OrderedDict()
+# Responses plus the allocated rows of every partition
+semantic_cache_bytes = 0
+semantic_cache_stats = {
+    "hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expirations": 0, "lookups": 0, "lookup_seconds": 0.0,
+}
+
+
+class SemanticEntry:
+    __slots__ = ("partition_key", "row", "response", "created")
+
+    def __init__(self, partition_key, row, response):
+        self.partition_key = partition_key
+        self.row = row
+        self.response = response
+        self.created = time.time()
+
+
+class SemanticPartition:
+    """The normalized embeddings of one model and system prompt as the rows of a matrix, with their entries."""
+    __slots__ = ("vectors", "entries")
+
+    def __init__(self, dimensions):
+        global semantic_cache_bytes
+        self.vectors = np.empty((INITIAL_PARTITION_ROWS, dimensions), dtype=np.float32)
+        self.entries = []
+        semantic_cache_bytes += self.vectors.nbytes
+
+    def add(self, vector, entry):
+        if len(self.entries) == len(self.vectors):
+            self._resize(len(self.vectors) * 2)
+        self.vectors[len(self.entries)] = vector
+        self.entries.append(entry)
+
+    def remove(self, entry):
+        # The last row takes the place of the removed one, so the used rows stay contiguous
+        last = self.entries.pop()
+        if last is not entry:
+            self.vectors[entry.row] = self.vectors[len(self.entries)]
+            self.entries[entry.row] = last
+            last.row = entry.row
+        if len(self.vectors) > INITIAL_PARTITION_ROWS and len(self.entries) <= len(self.vectors) // 4:
+            self._resize(len(self.vectors) // 2)
+
+    def _resize(self, rows):
+        global semantic_cache_bytes
+        vectors = np.empty((rows, self.vectors.shape[1]), dtype=np.float32)
+        vectors[:len(self.entries)] = self.vectors[:len(self.entries)]
+        semantic_cache_bytes += vectors.nbytes - self.vectors.nbytes
+        self.vectors = vectors
+
+    def search(self, vector):
+        """
+        Returns:
+            tuple: The row most similar to vector, with its cosine similarity.
+        """
+        scores = self.vectors[:len(self.entries)] @ vector
+        row = int(np.argmax(scores))
+        return row, float(scores[row])
+
+
+class SemanticQuery:
+    """The user message of a chat request, embedded, within its partition."""
+    __slots__ = ("partition_key", "vector", "threshold")
+
+    def __init__(self, partition_key, vector, model_id):
+        norm = np.linalg.norm(vector)
+        self.partition_key = partition_key
+        self.vector = vector / norm if norm else vector
+        self.threshold = float(SEMANTIC_CACHE_THRESHOLDS.get(model_id, SEMANTIC_CACHE_THRESHOLD))
+
+    def lookup(self):
+        """
+        Returns:
+            dict: The cached Converse response of the most similar earlier request, None if none is similar enough.
+        """
+        _purge_expired()
+        partition = partitions.get(self.partition_key)
+        if partition is None:
+            semantic_cache_stats["misses"] += 1
+            return None
+        start = time.perf_counter()
+        row, score = partition.search(self.vector)
+        semantic_cache_stats["lookups"] += 1
+        semantic_cache_stats["lookup_seconds"] += time.perf_counter() - start
+
+        if score < self.threshold:
+            semantic_cache_stats["misses"] += 1
+            return None
+        entry = partition.entries[row]
+        entries_lru.move_to_end(entry)
+        semantic_cache_stats["hits"] += 1
+        return json.loads(entry.response)
+
+    def store(self, response):
+        global semantic_cache_bytes
+        encoded = json.dumps(
+            {"output": response["output"], "stopReason": response["stopReason"], "usage": response["usage"]},
+            separators=(",", ":"),
+        ).encode("utf-8")
+        if self.vector.nbytes * INITIAL_PARTITION_ROWS + len(encoded) > SEMANTIC_CACHE_MAX_BYTES:
+            return
+        _purge_expired()
+        partition = partitions.get(self.partition_key)
+        if partition is None:
+            partition = partitions[self.partition_key] = SemanticPartition(len(self.vector))
+        entry = SemanticEntry(self.partition_key, len(partition.entries), encoded)
+        partition.add(self.vector, entry)
+        entries_lru[entry] = None
+        entries_by_age[entry] = None
+        semantic_cache_bytes += len(encoded)
+        semantic_cache_stats["stores"] += 1
+        while semantic_cache_bytes > SEMANTIC_CACHE_MAX_BYTES and entries_lru:
+            _remove(next(iter(entries_lru)))
+            semantic_cache_stats["evictions"] += 1
+
+
+def _remove(entry):
+    global semantic_cache_bytes
+    del entries_lru[entry]
+    del entries_by_age[entry]
+    semantic_cache_bytes -= len(entry.response)
+    partition = partitions[entry.partition_key]
+    partition.remove(entry)
+    if not partition.entries:
+        del partitions[entry.partition_key]
+        semantic_cache_bytes -= partition.vectors.nbytes
+
+
+def _purge_expired():
+    expired_before = time.time() - RESPONSE_CACHE_TTL
+    while entries_by_age:
+        entry = next(iter(entries_by_age))
+        if entry.created >= expired_before:
+            return
+        _remove(entry)
+        semantic_cache_stats["expirations"] += 1
+
+
+def get_semantic_cache_prompt(args, user_name):
+    """
+    Split a Converse request into its partition, the model and system prompt, and its user message.
+
+    Only single turn requests without tools are looked up. An answer in a longer conversation depends on the earlier
+    turns, and one with tools may be a tool call, so neither can be answered by a similar question alone.
+
+    Returns:
+        tuple: The partition key and the text of the user message, or None if the request is not cacheable.
+    """
+    if not SEMANTIC_CACHE or len(args["messages"]) != 1 or "toolConfig" in args:
+        return None
+    message = args["messages"][0]
+    if message["role"] != "user" or not all("text" in part for part in message["content"]):
+        return None
+    text = "\n".join(part["text"] for part in message["content"])
+    if not text.strip() or len(text) > SEMANTIC_CACHE_MAX_PROMPT_CHARS:
+        return None
+    partition_key = get_request_hash("semantic", user_name, {"modelId": args["modelId"], "system": args["system"]})
+    return partition_key, text
+
+
+def collect_semantic_cache_metrics():
+    for stat in ("hits", "misses", "stores", "evictions", "expirations", "lookups"):
+        yield f"gateway_semantic_cache_{stat}_total", "counter", {}, semantic_cache_stats[stat]
+    yield "gateway_semantic_cache_lookup_seconds_total", "counter", {}, semantic_cache_stats["lookup_seconds"]
+    requests = semantic_cache_stats["hits"] + semantic_cache_stats["misses"]
+    if requests:
+        yield "gateway_semantic_cache_hit_rate", "gauge", {}, semantic_cache_stats["hits"] / requests
+    yield "gateway_semantic_cache_bytes", "gauge", {}, semantic_cache_bytes
+    yield "gateway_semantic_cache_entries", "gauge", {}, len(entries_lru)
+
+
+register_collector(collect_semantic_cache_metrics)
@@ -26,4 +26,6 @@ DEFAULT_MODEL = os.environ.get(
 )
 DEFAULT_EMBEDDING_MODEL = os.environ.get(
     "DEFAULT_EMBEDDING_MODEL", "cohere.embed-multilingual-v3"
-)
\ No newline at end of file
+)
+# Users allowed to read /metrics, comma separated. The metrics hold per-user and per-model counters.
+METRICS_USERS = {user.strip() for user in os.environ.get("METRICS_USERS", "").split(",") if user.strip()}
\ No newline at end of file
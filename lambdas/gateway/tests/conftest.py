@@ -0,0 +1,19 @@
+import os
+
+GATEWAY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Settings the api modules read on import. No AWS call is made by the tests, the clients they use are replaced.
+os.environ.setdefault("REGION", "us-east-1")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_EC2_METADATA_DISABLED", "true")
+os.environ.setdefault(
+    "ENABLED_MODELS", "anthropic.claude-3-sonnet-20240229-v1:0,cohere.embed-multilingual-v3"
+)
+os.environ.setdefault("BENCHMARK_MODE", "false")
+os.environ.setdefault("LLM_GATEWAY_URL", "http://localhost")
+os.environ.setdefault("STORE_REQUEST_DETAILS_IN_DYNAMO", "false")
+os.environ.setdefault("COST_DB_PATH", os.path.join(GATEWAY_DIR, "api", "data", "cost_db.csv"))
+for table_name in ("API_KEY_TABLE_NAME", "QUOTA_TABLE_NAME", "MODEL_ACCESS_TABLE_NAME", "REQUEST_DETAILS_TABLE_NAME"):
+    os.environ.setdefault(table_name, table_name.lower())
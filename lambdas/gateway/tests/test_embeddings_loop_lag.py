@@ -0,0 +1,207 @@
+import asyncio
+import gc
+import json
+import random
+import time
+
+import httpx
+import pytest
+
+import api.loop_monitor as loop_monitor
+import api.models.bedrock as bedrock
+import api.routers.chat as chat_router
+import api.routers.embeddings as embeddings_router
+from api.app import app
+
+MODEL_ID = "cohere.embed-multilingual-v3"
+CHAT_MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+CHAT_PATH = "/api/v1/chat/completions"
+DIMENSIONS = 1024
+TEXTS_PER_REQUEST = 500
+CONCURRENT_REQUESTS = 5
+CONCURRENT_STREAMS = 3
+BEDROCK_LATENCY_SECONDS = 0.05
+STREAM_EVENT_INTERVAL_SECONDS = 0.01
+# Under this load the loop stalled for about two seconds when the responses were serialized in one piece, and for
+# 0.2 to 0.5 seconds with the decoding in threads or with the slices of concurrent requests running back to back.
+# Now the longest stall is decoding one Bedrock response, 0.05 to 0.1 seconds with a garbage collection in it.
+MAX_LOOP_LAG_SECONDS = 0.15
+MAX_CHEAP_REQUEST_SECONDS = 0.15
+MAX_STREAM_GAP_SECONDS = 0.15
+
+
+class FakeBody:
+    def __init__(self, body):
+        self.body = body
+
+    async def read(self):
+        return self.body
+
+
+class FakeBedrockRuntime:
+    """
+    Answers invoke_model after BEDROCK_LATENCY_SECONDS with full size Cohere embeddings, and streams a text delta
+    every STREAM_EVENT_INTERVAL_SECONDS from converse_stream until the embeddings requests are done.
+    """
+
+    class exceptions:
+        class ValidationException(Exception):
+            pass
+
+    def __init__(self):
+        rng = random.Random(7)
+        vector = [round(rng.uniform(-0.1, 0.1), 9) for _ in range(DIMENSIONS)]
+        # Encoded up front, so building the responses does not count towards the lag being measured
+        self.bodies = {
+            size: json.dumps({"embeddings": [vector] * size}).encode("utf-8")
+            for size in {bedrock.EMBEDDINGS_BATCH_SIZE, TEXTS_PER_REQUEST % bedrock.EMBEDDINGS_BATCH_SIZE}
+        }
+        self.embeddings_done = asyncio.Event()
+
+    async def invoke_model(self, body, modelId, accept, contentType):
+        await asyncio.sleep(BEDROCK_LATENCY_SECONDS)
+        return {"body": FakeBody(self.bodies[len(json.loads(body)["texts"])])}
+
+    async def converse_stream(self, **args):
+        return {"stream": self._stream_events()}
+
+    async def _stream_events(self):
+        yield {"messageStart": {"role": "assistant"}}
+        deltas = 0
+        while not self.embeddings_done.is_set():
+            await asyncio.sleep(STREAM_EVENT_INTERVAL_SECONDS)
+            yield {"contentBlockDelta": {"delta": {"text": "word "}, "contentBlockIndex": 0}}
+            deltas += 1
+        yield {"contentBlockStop": {"contentBlockIndex": 0}}
+        yield {"messageStop": {"stopReason": "end_turn"}}
+        yield {"metadata": {"usage": {"inputTokens": 10, "outputTokens": deltas, "totalTokens": 10 + deltas}}}
+
+
+def record_chat_chunks(app, chunk_times):
+    """
+    Wrap an ASGI app to record when each chat completions response sends a body chunk, as the test client only
+    returns a response once it is complete.
+    """
+    async def recording_app(scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != CHAT_PATH:
+            return await app(scope, receive, send)
+        times = []
+        chunk_times.append(times)
+
+        async def recording_send(message):
+            if message["type"] == "http.response.body" and message.get("body"):
+                times.append(time.monotonic())
+            await send(message)
+        await app(scope, receive, recording_send)
+
+    return recording_app
+
+
+@pytest.fixture
+def bedrock_runtime(monkeypatch):
+    bedrock_runtime = FakeBedrockRuntime()
+
+    async def get_async_region_client(region):
+        return bedrock_runtime
+
+    async def api_key_auth(credentials):
+        return {"username": "user", "api_key_name": "key"}, None
+
+    async def allow(*args, **kwargs):
+        return {}
+
+    async def no_reservation(*args, **kwargs):
+        return 0
+
+    async def create_request_detail(*args):
+        pass
+
+    monkeypatch.setattr(bedrock, "get_async_region_client", get_async_region_client)
+    monkeypatch.setattr(bedrock, "create_request_detail", create_request_detail)
+    for router in (embeddings_router, chat_router):
+        monkeypatch.setattr(router, "api_key_auth", api_key_auth)
+        monkeypatch.setattr(router, "check_model_access", allow)
+        monkeypatch.setattr(router, "check_rate_limit", allow)
+        monkeypatch.setattr(router, "check_quota", no_reservation)
+    monkeypatch.setattr(embeddings_router, "release_quota_reservation", lambda user_name, reserved_cost: None)
+    monkeypatch.setattr(loop_monitor, "EVENT_LOOP_LAG_INTERVAL_SECONDS", 0.01)
+    monkeypatch.setattr(loop_monitor, "EVENT_LOOP_LAG_WARN_SECONDS", MAX_LOOP_LAG_SECONDS)
+    # As the lifespan startup does, which the test client does not run
+    gc.freeze()
+    yield bedrock_runtime
+    gc.unfreeze()
+
+
+def test_large_embeddings_requests_do_not_block_the_event_loop(bedrock_runtime):
+    chunk_times = []
+
+    async def run():
+        transport = httpx.ASGITransport(app=record_chat_chunks(app, chunk_times))
+        async with httpx.AsyncClient(transport=transport, base_url="http://gateway", timeout=60) as client:
+            async def embed(index):
+                response = await client.post(
+                    "/api/v1/embeddings",
+                    json={"model": MODEL_ID, "input": [f"request {index} text {i}" for i in range(TEXTS_PER_REQUEST)]},
+                    headers={"Authorization": "Bearer sk-test"},
+                )
+                assert response.status_code == 200
+                return len(response.content)
+
+            async def chat(index):
+                response = await client.post(
+                    CHAT_PATH,
+                    json={
+                        "model": CHAT_MODEL_ID,
+                        "messages": [{"role": "user", "content": f"Stream {index}"}],
+                        "stream": True,
+                        "temperature": 0.5,
+                    },
+                    headers={"Authorization": "Bearer sk-test"},
+                )
+                assert response.status_code == 200
+                assert response.text.endswith("data: [DONE]\n\n")
+
+            async def cheap_requests():
+                """
+                Send a health check every 10ms while the embeddings requests run.
+
+                Returns:
+                    float: The longest time from when a health check was due to its response.
+                """
+                slowest = 0.0
+                due = time.monotonic()
+                while not bedrock_runtime.embeddings_done.is_set():
+                    response = await client.get("/health")
+                    assert response.status_code == 200
+                    slowest = max(slowest, time.monotonic() - due)
+                    due = time.monotonic() + 0.01
+                    await asyncio.sleep(0.01)
+                return slowest
+
+            async def embed_all():
+                # The streams are flowing before the embeddings requests arrive
+                await asyncio.sleep(0.1)
+                try:
+                    return await asyncio.gather(*[embed(index) for index in range(CONCURRENT_REQUESTS)])
+                finally:
+                    bedrock_runtime.embeddings_done.set()
+
+            await loop_monitor.start_loop_lag_monitor()
+            loop_monitor.loop_lag["max"] = 0.0
+            try:
+                sizes, cheap_request_seconds, *_ = await asyncio.gather(
+                    embed_all(), cheap_requests(), *[chat(index) for index in range(CONCURRENT_STREAMS)]
+                )
+            finally:
+                await loop_monitor.stop_loop_lag_monitor()
+            return sizes, cheap_request_seconds, loop_monitor.loop_lag["max"]
+
+    sizes, cheap_request_seconds, max_lag = asyncio.run(run())
+    assert all(size > TEXTS_PER_REQUEST * DIMENSIONS for size in sizes)
+    assert len(chunk_times) == CONCURRENT_STREAMS
+    # The longest a client waited for the next chunk of its stream
+    stream_gaps = [later - earlier for times in chunk_times for earlier, later in zip(times, times[1:])]
+    assert len(stream_gaps) > CONCURRENT_STREAMS * 10
+    assert max(stream_gaps) < MAX_STREAM_GAP_SECONDS
+    assert max_lag < MAX_LOOP_LAG_SECONDS
+    assert cheap_request_seconds < MAX_CHEAP_REQUEST_SECONDS
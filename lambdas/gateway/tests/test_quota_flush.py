@@ -0,0 +1,116 @@
+import random
+import threading
+import time
+
+import api.quota as quota
+from api.quota_journal import QuotaJournal
+from api.usage_accumulator import UsageAccumulator
+
+USERS = [f"user-{index}" for index in range(20)]
+WRITER_THREADS = 8
+UPDATES_PER_THREAD = 2000
+
+
+class FakeQuotaTable:
+    """Totals written by update_quota_dynamo, failing a share of the writes like a throttled table would."""
+
+    def __init__(self, failure_rate):
+        self.totals = {}
+        self.failure_rate = failure_rate
+        self.random = random.Random(7)
+        self.lock = threading.Lock()
+
+    def update_quota_dynamo(self, user_name, total_cost):
+        time.sleep(0.0001)
+        with self.lock:
+            if self.random.random() < self.failure_rate:
+                return False
+            self.totals[user_name] = self.totals.get(user_name, 0) + total_cost
+            return True
+
+
+def test_concurrent_updates_and_flushes_lose_nothing(monkeypatch, tmp_path):
+    # Few stripes, so the users contend for the same locks
+    usage = UsageAccumulator(4, 3600)
+    journal = QuotaJournal(str(tmp_path))
+    table = FakeQuotaTable(failure_rate=0.2)
+    monkeypatch.setattr(quota, "usage", usage)
+    monkeypatch.setattr(quota, "quota_journal", journal)
+    monkeypatch.setattr(quota, "update_quota_dynamo", table.update_quota_dynamo)
+
+    expected = {}
+    expected_lock = threading.Lock()
+
+    def write(seed):
+        rng = random.Random(seed)
+        totals = {}
+        for _ in range(UPDATES_PER_THREAD):
+            # Most of the spend from one hot user
+            user_name = USERS[0] if rng.random() < 0.5 else rng.choice(USERS)
+            amount = rng.randint(1, 5)
+            quota.update_quota_local(user_name, amount)
+            totals[user_name] = totals.get(user_name, 0) + amount
+        with expected_lock:
+            for user_name, amount in totals.items():
+                expected[user_name] = expected.get(user_name, 0) + amount
+
+    writers_done = threading.Event()
+
+    def flush():
+        while not writers_done.is_set():
+            quota.write_quota_updates_to_dynamo()
+
+    writers = [threading.Thread(target=write, args=(seed,)) for seed in range(WRITER_THREADS)]
+    flusher = threading.Thread(target=flush)
+    flusher.start()
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    writers_done.set()
+    flusher.join()
+    quota.write_quota_updates_to_dynamo()
+
+    # Flushed or not, every increment is counted locally exactly once
+    for user_name in USERS:
+        assert usage.total(user_name) == expected.get(user_name, 0)
+    unflushed = {
+        user_name: expected[user_name] - table.totals.get(user_name, 0)
+        for user_name in expected
+        if expected[user_name] != table.totals.get(user_name, 0)
+    }
+    assert all(amount > 0 for amount in unflushed.values())
+
+    # A process crashing now leaves exactly the unflushed spend in its journal
+    journal.file.close()
+    recovered = QuotaJournal(str(tmp_path)).adopt_orphaned_journals()
+    assert recovered == unflushed
+
+    # And once the table takes every write, it holds every increment exactly once
+    monkeypatch.setattr(quota, "quota_journal", None)
+    table.failure_rate = 0
+    quota.write_quota_updates_to_dynamo()
+    assert table.totals == expected
+
+
+def test_crash_after_failed_flush_does_not_double_count(monkeypatch, tmp_path):
+    usage = UsageAccumulator(4, 3600)
+    journal = QuotaJournal(str(tmp_path))
+    table = FakeQuotaTable(failure_rate=0.5)
+    monkeypatch.setattr(quota, "usage", usage)
+    monkeypatch.setattr(quota, "quota_journal", journal)
+    monkeypatch.setattr(quota, "update_quota_dynamo", table.update_quota_dynamo)
+    for index, user_name in enumerate(USERS):
+        quota.update_quota_local(user_name, index + 1)
+
+    # The process dies after the writes, before the flushing journal is removed
+    monkeypatch.setattr(journal, "finish_flush", lambda: None)
+    quota.write_quota_updates_to_dynamo()
+    assert 0 < len(table.totals) < len(USERS)
+    journal.file.close()
+    journal.flushing_file.close()
+
+    recovered = QuotaJournal(str(tmp_path)).adopt_orphaned_journals()
+    assert recovered == {
+        user_name: index + 1 for index, user_name in enumerate(USERS) if user_name not in table.totals
+    }
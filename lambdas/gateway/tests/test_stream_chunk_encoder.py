@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+import pytest
+
+from api.models.base import StreamChunkEncoder
+from api.models.bedrock import BedrockModel
+from api.schema import ChatRequest
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+MESSAGE_ID = "chatcmpl-1234abcd"
+
+TEXTS = [
+    "",
+    "Hello",
+    'a "quoted" \\ back/slash \n\t\r\b\f',
+    "".join(chr(code) for code in range(0x20)) + "\x7f",
+    "☃ 日本語 \U0001F600    </script>",
+]
+
+
+def delta(text):
+    return {"contentBlockDelta": {"delta": {"text": text}, "contentBlockIndex": 0}}
+
+
+@pytest.fixture(autouse=True)
+def frozen_time(monkeypatch):
+    # Both encoders stamp the chunks with the current second
+    monkeypatch.setattr(time, "time", lambda: 1718000000.5)
+
+
+def pydantic_bytes(model, chunk):
+    return model.stream_response_to_bytes(
+        model._create_response_stream(model_id=MODEL_ID, message_id=MESSAGE_ID, chunk=chunk)
+    )
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_text_delta_matches_pydantic(text):
+    model = BedrockModel()
+    encoder = StreamChunkEncoder(MESSAGE_ID, MODEL_ID)
+    assert encoder.encode_text_delta(text) == pydantic_bytes(model, delta(text))
+
+
+def test_escaped_message_id_and_model():
+    model = BedrockModel()
+    encoder = StreamChunkEncoder('id "with" \\ quotes', "model/☃")
+    expected = model.stream_response_to_bytes(
+        model._create_response_stream(model_id="model/☃", message_id='id "with" \\ quotes', chunk=delta("hi"))
+    )
+    assert encoder.encode_text_delta("hi") == expected
+
+
+def test_stream_matches_pydantic():
+    """A whole stream, role only first chunk and finish reason and usage chunks included, comes out byte for byte
+    as if every chunk went through the pydantic models."""
+    model = BedrockModel()
+    events = [
+        {"messageStart": {"role": "assistant"}},
+        *[delta(text) for text in TEXTS],
+        {"messageStop": {"stopReason": "end_turn"}},
+        {"metadata": {"usage": {"inputTokens": 10, "outputTokens": 5, "totalTokens": 15}}},
+    ]
+    chat_request = ChatRequest(
+        model=MODEL_ID,
+        messages=[{"role": "user", "content": "Hi"}],
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+
+    async def stream():
+        for event in events:
+            yield event
+
+    async def read_stream():
+        queue = asyncio.Queue()
+        await model._read_stream(
+            stream(), queue, chat_request, MESSAGE_ID, "user", "key", "us-east-1", time.monotonic()
+        )
+        chunks = []
+        while (chunk := queue.get_nowait()) is not None:
+            chunks.append(chunk)
+        return chunks
+
+    expected = [pydantic_bytes(model, event) for event in events] + [model.stream_response_to_bytes()]
+    assert asyncio.run(read_stream()) == expected
@@ -0,0 +1,85 @@
+import asyncio
+
+from botocore.exceptions import EventStreamError
+
+import api.models.bedrock as bedrock
+from api.schema import ChatRequest
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+REGIONS = ["us-east-1", "us-west-2"]
+EVENTS = [
+    {"messageStart": {"role": "assistant"}},
+    {"contentBlockDelta": {"delta": {"text": "Hello"}, "contentBlockIndex": 0}},
+    {"messageStop": {"stopReason": "end_turn"}},
+]
+
+
+class FakeEventStream:
+    """Yields the events, then raises the error, like a Bedrock stream reporting an error as an event."""
+
+    def __init__(self, events, error=None):
+        self.events = events
+        self.error = error
+
+    async def __aiter__(self):
+        for event in self.events:
+            yield event
+        if self.error:
+            raise self.error
+
+
+class FakeBedrockRuntime:
+    class exceptions:
+        class ValidationException(Exception):
+            pass
+
+    def __init__(self, error_code=None):
+        self.error_code = error_code
+        self.calls = 0
+
+    async def converse_stream(self, **args):
+        self.calls += 1
+        if self.error_code:
+            error = EventStreamError({"Error": {"Code": self.error_code, "Message": "Try again"}}, "ConverseStream")
+            return {"stream": FakeEventStream([], error)}
+        return {"stream": FakeEventStream(EVENTS)}
+
+
+def invoke_stream(monkeypatch, clients):
+    async def get_async_region_client(region):
+        return clients[region]
+
+    monkeypatch.setattr(bedrock, "get_async_region_client", get_async_region_client)
+
+    async def run():
+        chat_request = ChatRequest(model=MODEL_ID, messages=[{"role": "user", "content": "Hi"}], stream=True)
+        response, region, slot, _ = await bedrock.BedrockModel()._invoke_bedrock(
+            chat_request, {"modelId": MODEL_ID}, "user", stream=True, regions=REGIONS
+        )
+        slot.release()
+        return region, [event async for event in response["stream"]]
+
+    return asyncio.run(run())
+
+
+def test_throttled_first_event_fails_over_to_the_next_region(monkeypatch):
+    clients = {REGIONS[0]: FakeBedrockRuntime("throttlingException"), REGIONS[1]: FakeBedrockRuntime()}
+    region, events = invoke_stream(monkeypatch, clients)
+    assert region == REGIONS[1]
+    assert events == EVENTS
+    assert clients[REGIONS[0]].calls == 1
+
+
+def test_unavailable_first_event_fails_over_to_the_next_region(monkeypatch):
+    clients = {REGIONS[0]: FakeBedrockRuntime("serviceUnavailableException"), REGIONS[1]: FakeBedrockRuntime()}
+    region, events = invoke_stream(monkeypatch, clients)
+    assert region == REGIONS[1]
+    assert events == EVENTS
+
+
+def test_healthy_stream_keeps_its_first_event(monkeypatch):
+    clients = {REGIONS[0]: FakeBedrockRuntime(), REGIONS[1]: FakeBedrockRuntime("throttlingException")}
+    region, events = invoke_stream(monkeypatch, clients)
+    assert region == REGIONS[0]
+    assert events == EVENTS
+    assert clients[REGIONS[1]].calls == 0
@@ -0,0 +1,68 @@
+"""
+Microbenchmark of the per request cost calculation: the indexed price table in api/pricing.py against the
+pandas DataFrame filter it replaced.
+
+Run from the repository root with the gateway requirements installed:
+
+    python3 load_testing/pricing_benchmark.py --iterations 5000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+GATEWAY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas", "gateway")
+COST_DB_PATH = os.path.join(GATEWAY_DIR, "api", "data", "cost_db.csv")
+os.environ.setdefault("COST_DB_PATH", COST_DB_PATH)
+sys.path.insert(0, GATEWAY_DIR)
+
+import pandas as pd
+from api.pricing import get_token_prices, units_to_dollars
+
+cost_df = pd.read_csv(COST_DB_PATH, dtype={'cost_per_token_input': float, 'cost_per_token_output': float})
+
+
+def dataframe_cost(num_tokens, model, region, cost_type):
+    """The previous calculate_cost, a boolean mask over the whole cost table for every call."""
+    filtered_df = cost_df[
+        (cost_df['model_name'] == model) &
+        ((cost_df['region'] == region) | (cost_df['region'].isna()))
+    ]
+    costs_per_token = filtered_df.iloc[0][cost_type]
+    return (num_tokens * costs_per_token) / 1000
+
+
+def dataframe_request_cost(model, region, input_tokens, output_tokens):
+    return (dataframe_cost(input_tokens, model, region, 'cost_per_token_input')
+            + dataframe_cost(output_tokens, model, region, 'cost_per_token_output'))
+
+
+def indexed_request_cost(model, region, input_tokens, output_tokens):
+    input_price, output_price = get_token_prices(model, region)
+    return units_to_dollars(input_tokens * input_price) + units_to_dollars(output_tokens * output_price)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--model", default="anthropic.claude-3-sonnet-20240229-v1:0")
+    parser.add_argument("--region", default="us-east-1")
+    parser.add_argument("--input-tokens", type=int, default=1000)
+    parser.add_argument("--output-tokens", type=int, default=500)
+    args = parser.parse_args()
+    call_args = (args.model, args.region, args.input_tokens, args.output_tokens)
+
+    old_cost = dataframe_request_cost(*call_args)
+    new_cost = indexed_request_cost(*call_args)
+    print(f'Cost of one request: DataFrame filter {old_cost:.10f}, price index {float(new_cost):.10f}')
+
+    results = {}
+    for name, calculate in (("DataFrame filter", dataframe_request_cost), ("price index", indexed_request_cost)):
+        seconds = timeit.timeit(lambda: calculate(*call_args), number=args.iterations)
+        results[name] = seconds / args.iterations * 1e6
+        print(f'{name}: {results[name]:.2f} us per request')
+    print(f'Speedup: {results["DataFrame filter"] / results["price index"]:.0f}x')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Microbenchmark of the striped per-user quota accumulator in api/usage_accumulator.py: update throughput of one hot
+user against updates spread over many users, at several thread counts.
+
+Run from the repository root:
+
+    python3 load_testing/usage_accumulator_benchmark.py --updates 200000
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+GATEWAY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas", "gateway")
+sys.path.insert(0, GATEWAY_DIR)
+
+from api.usage_accumulator import UsageAccumulator
+
+
+def run(usage, user_names, threads, updates):
+    """
+    Returns:
+        float: Seconds for threads threads to make updates add_pending calls between them.
+    """
+    per_thread = updates // threads
+    # Drawn up front, so the clock only measures the accumulator
+    plans = [[random.Random(seed).choice(user_names) for _ in range(per_thread)] for seed in range(threads)]
+    start_barrier = threading.Barrier(threads + 1)
+
+    def update(plan):
+        add_pending = usage.add_pending
+        start_barrier.wait()
+        for user_name in plan:
+            add_pending(user_name, 1)
+
+    workers = [threading.Thread(target=update, args=(plan,)) for plan in plans]
+    for worker in workers:
+        worker.start()
+    start_barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--updates", type=int, default=200000, help="add_pending calls per run, over all threads")
+    parser.add_argument("--threads", default="1,2,4,8,16")
+    parser.add_argument("--users", type=int, default=1000, help="users the spread runs update")
+    parser.add_argument("--stripes", type=int, default=64)
+    args = parser.parse_args()
+    thread_counts = [int(count) for count in args.threads.split(",")]
+    scenarios = (("one hot user", ["hot-user"]), (f"{args.users} users", [f"user-{i}" for i in range(args.users)]))
+
+    print(f'{"threads":>7}  {"scenario":<12}  {"updates/s":>11}  {"us per update":>13}')
+    for threads in thread_counts:
+        for name, user_names in scenarios:
+            seconds = run(UsageAccumulator(args.stripes, 3600), user_names, threads, args.updates)
+            updates = args.updates // threads * threads
+            print(f'{threads:>7}  {name:<12}  {updates / seconds:>11,.0f}  {seconds / updates * 1e6:>13.2f}')
+
+
+if __name__ == "__main__":
+    main()